@@ -0,0 +1,107 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.utils import timezone
+
+HEARTBEAT_KEY = "last_seen:{user_id}"
+SLOT_KEY = "last_seen:slot:{index}"
+SLOT_COUNTER_KEY = "last_seen:slots"
+FLUSHED_COUNTER_KEY = "last_seen:flushed"
+FLUSH_CHUNK_SIZE = 500
+
+
+def get_resolution():
+    return timedelta(seconds=getattr(settings, "LAST_SEEN_RESOLUTION", 60))
+
+
+def get_cache():
+    return caches[getattr(settings, "LAST_SEEN_CACHE", "default")]
+
+
+def cache_is_process_local():
+    """
+    Whether LAST_SEEN_CACHE is only visible to this process, so heartbeats
+    cached by a web worker would never reach the flush_last_seen task.
+    """
+    return isinstance(get_cache(), (LocMemCache, DummyCache))
+
+
+def record_heartbeat(user, now=None):
+    """
+    Note that ``user`` was active. At most one heartbeat per user per
+    LAST_SEEN_RESOLUTION reaches the cache; nothing is written to the database
+    until ``flush_heartbeats`` runs. With a process-local cache nothing could
+    flush it, so the heartbeat is written to the database straight away.
+    """
+    now = now or timezone.now()
+    resolution = get_resolution()
+    if user.last_seen and now - user.last_seen < resolution:
+        return False
+
+    if cache_is_process_local():
+        get_user_model().objects.filter(pk=user.pk).update(last_seen=now)
+        user.last_seen = now
+        return True
+
+    cache = get_cache()
+    key = HEARTBEAT_KEY.format(user_id=user.pk)
+    previous = cache.get(key)
+    if previous and now - previous < resolution:
+        return False
+
+    ttl = int(resolution.total_seconds()) * 10
+    cache.set(key, now, ttl)
+    cache.add(SLOT_COUNTER_KEY, 0, None)
+    index = cache.incr(SLOT_COUNTER_KEY)
+    cache.set(SLOT_KEY.format(index=index), user.pk, ttl)
+    return True
+
+
+def get_last_seen(user):
+    """Last activity of ``user``, accurate to LAST_SEEN_RESOLUTION."""
+    return get_last_seen_many([user])[user.pk]
+
+
+def get_last_seen_many(users):
+    """Map each user's pk to its last activity with a single cache round trip."""
+    keys = {HEARTBEAT_KEY.format(user_id=user.pk): user for user in users}
+    pending = get_cache().get_many(keys)
+    result = {}
+    for key, user in keys.items():
+        heartbeat = pending.get(key)
+        if heartbeat and (user.last_seen is None or heartbeat > user.last_seen):
+            result[user.pk] = heartbeat
+        else:
+            result[user.pk] = user.last_seen
+    return result
+
+
+def flush_heartbeats():
+    """
+    Persist heartbeats recorded since the previous flush with bulk UPDATEs.
+    Returns the number of users updated.
+    """
+    User = get_user_model()
+    cache = get_cache()
+    end = cache.get(SLOT_COUNTER_KEY) or 0
+    start = cache.get(FLUSHED_COUNTER_KEY) or 0
+    if end <= start:
+        return 0
+
+    slot_keys = [SLOT_KEY.format(index=index) for index in range(start + 1, end + 1)]
+    user_ids = set(cache.get_many(slot_keys).values())
+    heartbeats = cache.get_many([HEARTBEAT_KEY.format(user_id=user_id) for user_id in user_ids])
+
+    users = [
+        User(pk=user_id, last_seen=heartbeats[HEARTBEAT_KEY.format(user_id=user_id)])
+        for user_id in user_ids
+        if HEARTBEAT_KEY.format(user_id=user_id) in heartbeats
+    ]
+    User.objects.bulk_update(users, ["last_seen"], batch_size=FLUSH_CHUNK_SIZE)
+    cache.set(FLUSHED_COUNTER_KEY, end, None)
+    cache.delete_many(slot_keys)
+    return len(users)
@@ -1,11 +1,11 @@
-from django.contrib.auth import get_user_model
-from django.utils import timezone
 from django.utils.deprecation import MiddlewareMixin
 
+from .last_seen import record_heartbeat
+
+
 class UpdateLastSeenMiddleware(MiddlewareMixin):
     def process_response(self, request, response):
         user = getattr(request, "user", None)
         if user and user.is_authenticated:
-            User = get_user_model()
-            User.objects.filter(pk=user.pk).update(last_seen=timezone.now())
-        return response
\ No newline at end of file
+            record_heartbeat(user)
+        return response
@@ -3,6 +3,7 @@ from django.core.mail import send_mail
 from django.contrib.auth import get_user_model
 from django.conf import settings
 from chatApi.settings import DEFAULT_FROM_EMAIL
+from .last_seen import flush_heartbeats
 
 User = get_user_model()
 
@@ -21,4 +22,9 @@ def send_welcome_email(user_id):
         )
         return "sent"
     except User.DoesNotExist:
-        return "User not found"
\ No newline at end of file
+        return "User not found"
+
+
+@shared_task
+def flush_last_seen():
+    return flush_heartbeats()
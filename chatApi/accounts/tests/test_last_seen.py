@@ -0,0 +1,71 @@
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from unittest import mock
+
+from django.core.cache import cache
+from django.utils import timezone
+from rest_framework.test import APITestCase
+
+from accounts.last_seen import record_heartbeat
+from accounts.tasks import flush_last_seen
+
+User = get_user_model()
+
+
+# The suite runs on LocMemCache; these tests stand in for a shared cache.
+@mock.patch("accounts.last_seen.cache_is_process_local", lambda: False)
+class LastSeenTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="sam", password="pass123")
+        self.client.force_authenticate(user=self.user)
+
+    def test_requests_do_not_write_last_seen(self):
+        for _ in range(3):
+            self.client.get("/api/me/")
+        self.user.refresh_from_db()
+        self.assertIsNone(self.user.last_seen)
+
+        me = self.client.get("/api/me/")
+        self.assertIsNotNone(me.data["last_seen"])
+
+    def test_flush_persists_heartbeats_in_bulk(self):
+        other = User.objects.create_user(username="alex", password="pass123")
+        self.client.get("/api/me/")
+        record_heartbeat(other)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(flush_last_seen(), 2)
+        self.assertEqual(flush_last_seen(), 0)
+
+        self.user.refresh_from_db()
+        other.refresh_from_db()
+        self.assertIsNotNone(self.user.last_seen)
+        self.assertIsNotNone(other.last_seen)
+
+    def test_heartbeats_are_coalesced_to_resolution(self):
+        now = timezone.now()
+        self.assertTrue(record_heartbeat(self.user, now=now))
+        self.assertFalse(record_heartbeat(self.user, now=now + timedelta(seconds=30)))
+        self.assertTrue(record_heartbeat(self.user, now=now + timedelta(seconds=61)))
+
+
+class ProcessLocalLastSeenTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="sam", password="pass123")
+        self.client.force_authenticate(user=self.user)
+
+    def test_heartbeats_are_written_through_at_resolution(self):
+        self.client.get("/api/me/")
+        self.user.refresh_from_db()
+        first = self.user.last_seen
+        self.assertIsNotNone(first)
+
+        with self.assertNumQueries(0):
+            self.assertFalse(record_heartbeat(self.user, now=first + timedelta(seconds=30)))
+        self.assertTrue(record_heartbeat(self.user, now=first + timedelta(seconds=61)))
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.last_seen, first + timedelta(seconds=61))
+        self.assertEqual(flush_last_seen(), 0)
@@ -4,6 +4,7 @@ from rest_framework.response import Response
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from .serializers import RegisterSerializer
 from .models import User
+from .last_seen import get_last_seen
 from .tasks import send_welcome_email
 
 
@@ -29,7 +30,7 @@ class MeView(APIView):
             "id": user.id,
             "username": user.username,
             "email": user.email,
-            "last_seen": getattr(user, 'last_seen', None)
+            "last_seen": get_last_seen(user)
             },
             status=200
         )
\ No newline at end of file
@@ -1,7 +1,8 @@
 from django.contrib import admin
-from .models import Conversation, ConversationParticipant, Message
+from .models import ArchivedMessage, Conversation, ConversationParticipant, Message
 # Register your models here.
 
 admin.site.register(Conversation)
 admin.site.register(ConversationParticipant)
-admin.site.register(Message)
\ No newline at end of file
+admin.site.register(Message)
+admin.site.register(ArchivedMessage)
@@ -1,6 +1,17 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+
+
+def restore_search_triggers(sender, using, **kwargs):
+    from django.db import connections
+
+    from .search import ensure_sqlite_triggers
+    ensure_sqlite_triggers(connections[using])
 
 
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat'
+
+    def ready(self):
+        post_migrate.connect(restore_search_triggers, sender=self)
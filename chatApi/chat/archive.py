@@ -0,0 +1,111 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q, Value
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+
+from .models import ArchivedMessage, Conversation, Message
+
+
+def get_batch_size():
+    return getattr(settings, "MESSAGE_ARCHIVE_BATCH_SIZE", 500)
+
+
+def retention_plan(now=None):
+    """
+    Yield ``(conversation_id, cutoff)`` for every conversation holding hot
+    messages older than its retention period.
+    """
+    now = now or timezone.now()
+    defaults = getattr(settings, "MESSAGE_RETENTION_DAYS", {})
+    for conversation_type, days in defaults.items():
+        if days is None:
+            continue
+        cutoff = now - timedelta(days=days)
+        conversation_ids = (
+            Conversation.objects
+            .filter(type=conversation_type, retention_days__isnull=True, messages__created_at__lt=cutoff)
+            .values_list("pk", flat=True)
+            .distinct()
+        )
+        for conversation_id in conversation_ids:
+            yield conversation_id, cutoff
+
+    overrides = Conversation.objects.filter(retention_days__isnull=False).values_list("pk", "retention_days")
+    for conversation_id, days in overrides:
+        yield conversation_id, now - timedelta(days=days)
+
+
+def archive_conversation(conversation_id, cutoff, batch_size=None):
+    """
+    Move the conversation's messages older than ``cutoff`` into the archive,
+    newest first, one short transaction per batch. Returns the number moved.
+    """
+    batch_size = batch_size or get_batch_size()
+    candidates = Message.objects.filter(conversation_id=conversation_id, created_at__lt=cutoff)
+    position = None
+    archived = 0
+    while True:
+        batch = candidates
+        if position is not None:
+            created_at, pk = position
+            batch = batch.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=pk))
+        keys = list(batch.order_by("-created_at", "-pk").values_list("created_at", "pk")[:batch_size])
+        if not keys:
+            return archived
+        position = keys[-1]
+        archived += archive_batch(conversation_id, {pk for _, pk in keys})
+
+
+def archive_batch(conversation_id, ids):
+    """
+    Copy ``ids`` to ArchivedMessage and delete them from Message. Messages with
+    replies that stay hot are skipped so reply links survive; a later run
+    picks them up once those replies have been archived.
+    """
+    with transaction.atomic():
+        while True:
+            blocked = set(
+                Message.objects
+                .filter(parent_id__in=ids)
+                .exclude(pk__in=ids)
+                .values_list("parent_id", flat=True)
+            )
+            if not blocked:
+                break
+            ids -= blocked
+        if not ids:
+            return 0
+
+        messages = list(Message.objects.select_for_update().filter(pk__in=ids))
+        if not messages:
+            return 0
+        ArchivedMessage.objects.bulk_create([
+            ArchivedMessage(
+                id=msg.pk,
+                conversation_id=msg.conversation_id,
+                sender_id=msg.sender_id,
+                content=msg.content,
+                parent_id=msg.parent_id,
+                created_at=msg.created_at,
+                seq=msg.seq,
+            )
+            for msg in messages
+        ], ignore_conflicts=True)
+        Message.objects.filter(pk__in=ids).delete()
+
+        newest = Value(max(msg.created_at for msg in messages))
+        Conversation.objects.filter(pk=conversation_id).update(
+            archived_until=Greatest(Coalesce("archived_until", newest), newest)
+        )
+    return len(messages)
+
+
+def archive_old_messages(now=None):
+    """Apply the retention policy to every conversation; returns messages moved."""
+    return sum(
+        archive_conversation(conversation_id, cutoff)
+        for conversation_id, cutoff in retention_plan(now)
+    )
@@ -0,0 +1,54 @@
+import json
+from collections import namedtuple
+
+import msgpack
+from django.conf import settings
+
+try:
+    import cbor2
+except ImportError:  # CBOR frames are optional
+    cbor2 = None
+
+
+Codec = namedtuple("Codec", ["name", "dumps", "loads", "binary"])
+
+JSON = Codec("json", json.dumps, json.loads, binary=False)
+
+CODECS = {
+    "json": JSON,
+    "msgpack": Codec("msgpack", msgpack.packb, msgpack.unpackb, binary=True),
+}
+if cbor2 is not None:
+    CODECS["cbor"] = Codec("cbor", cbor2.dumps, cbor2.loads, binary=True)
+
+# Websocket subprotocol a client offers to pick a frame encoding.
+SUBPROTOCOL_PREFIX = "chat."
+
+
+def enabled_codecs():
+    """Codecs named in CHAT_WS_ENCODINGS that are installed, JSON always first."""
+    names = getattr(settings, "CHAT_WS_ENCODINGS", ["json", "msgpack", "cbor"])
+    return ["json", *(name for name in names if name != "json" and name in CODECS)]
+
+
+def negotiate(subprotocols):
+    """
+    The codec for a client offering ``subprotocols`` (e.g. ["chat.msgpack"]),
+    the first enabled one in the client's order, and the subprotocol to
+    accept. Clients that offer none of ours get JSON and no subprotocol.
+    """
+    enabled = enabled_codecs()
+    for subprotocol in subprotocols:
+        name = subprotocol[len(SUBPROTOCOL_PREFIX):] if subprotocol.startswith(SUBPROTOCOL_PREFIX) else None
+        if name in enabled:
+            return CODECS[name], subprotocol
+    return JSON, None
+
+
+def encode(frame, codec_name):
+    return CODECS[codec_name].dumps(frame)
+
+
+def encode_all(frame):
+    """``frame`` encoded once with every enabled codec, keyed by codec name."""
+    return {name: encode(frame, name) for name in enabled_codecs()}
@@ -0,0 +1,13 @@
+from django.db.models import Aggregate, JSONField
+
+
+class JSONArrayAgg(Aggregate):
+    """
+    Aggregate rows into a JSON array: ``json_group_array`` on SQLite and
+    ``jsonb_agg`` on PostgreSQL.
+    """
+    function = "JSON_GROUP_ARRAY"
+    output_field = JSONField()
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        return super().as_sql(compiler, connection, function="JSONB_AGG", **extra_context)
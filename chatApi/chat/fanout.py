@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import threading
+import time
+import zlib
+from bisect import bisect_left
+
+from django.conf import settings
+
+from .encoding import encode_all
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (milliseconds) of the fan-out latency histogram buckets; the
+# last bucket counts everything slower.
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+# Room events that reach every client unchanged, so their frames can be
+# encoded once here instead of once per socket.
+PASSTHROUGH_TYPES = {
+    "chat_message",
+    "chat_message_updated",
+    "chat_message_deleted",
+    "chat_message_confirmed",
+    "chat_message_failed",
+}
+
+
+def get_shard_count():
+    return max(1, getattr(settings, "ROOM_FANOUT_SHARDS", 1))
+
+
+def room_group_name(room_id):
+    return f"chat_{room_id}"
+
+
+def room_groups(room_id, shards=None):
+    """
+    Channel-layer groups that together hold every socket in ``room_id``: the
+    room group itself, or its ROOM_FANOUT_SHARDS sub-groups.
+    """
+    shards = shards or get_shard_count()
+    if shards == 1:
+        return [room_group_name(room_id)]
+    return [f"{room_group_name(room_id)}.{n}" for n in range(shards)]
+
+
+def member_group(room_id, channel_name, shards=None):
+    """The one group of ``room_id`` that ``channel_name`` joins."""
+    groups = room_groups(room_id, shards)
+    return groups[zlib.crc32(channel_name.encode()) % len(groups)]
+
+
+def batch_event(events):
+    """
+    A single channel-layer event carrying ``events``, in order. Message
+    events come with their client frame pre-encoded under "encoded".
+    """
+    event = events[0] if len(events) == 1 else {"type": "chat.batch", "events": events}
+    if all(inner["type"] in PASSTHROUGH_TYPES for inner in events):
+        frame = events[0] if len(events) == 1 else {"type": "batch", "events": events}
+        event = {**event, "encoded": encode_all(frame)}
+    return event
+
+
+class LatencyHistograms:
+    """Per-room histograms of how long a fan-out took, in this process."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._rooms = {}
+
+    def record(self, room_id, seconds):
+        ms = seconds * 1000
+        with self._lock:
+            room = self._rooms.get(room_id)
+            if room is None:
+                room = self._rooms[room_id] = {"counts": [0] * (len(self.buckets) + 1), "sum_ms": 0.0, "max_ms": 0.0}
+            room["counts"][bisect_left(self.buckets, ms)] += 1
+            room["sum_ms"] += ms
+            room["max_ms"] = max(room["max_ms"], ms)
+
+    def snapshot(self, room_id=None):
+        with self._lock:
+            if room_id is None:
+                rooms = self._rooms
+            else:
+                rooms = {room_id: self._rooms[room_id]} if room_id in self._rooms else {}
+            return {key: self._describe(room) for key, room in rooms.items()}
+
+    def _describe(self, room):
+        count = sum(room["counts"])
+        labels = [f"le_{bound}ms" for bound in self.buckets] + ["inf"]
+        return {
+            "count": count,
+            "mean_ms": round(room["sum_ms"] / count, 3) if count else None,
+            "max_ms": round(room["max_ms"], 3),
+            "buckets": dict(zip(labels, room["counts"])),
+        }
+
+    def reset(self, room_id=None):
+        with self._lock:
+            if room_id is None:
+                self._rooms.clear()
+            else:
+                self._rooms.pop(room_id, None)
+
+
+latency = LatencyHistograms()
+
+
+async def send_to_room(channel_layer, room_id, events, started=None, shards=None):
+    """
+    Send ``events`` to every sub-group of ``room_id`` in parallel as one
+    batched event, and record the fan-out latency measured from ``started``
+    (a time.perf_counter() value, default now).
+    """
+    if started is None:
+        started = time.perf_counter()
+    groups = room_groups(room_id, shards)
+    event = batch_event(events)
+    results = await asyncio.gather(
+        *(channel_layer.group_send(group, event) for group in groups),
+        return_exceptions=True,
+    )
+    for group, result in zip(groups, results):
+        if isinstance(result, Exception):
+            logger.error("Publishing to %s failed", group, exc_info=result)
+    latency.record(room_id, time.perf_counter() - started)
+
+
+class RoomFanout:
+    """
+    Per-process publisher for room events. Events for the same room that
+    arrive within ``interval`` seconds go out as one batch; with
+    ``interval=0`` every event is sent straight away.
+    """
+
+    def __init__(self, interval=0.0):
+        self.interval = interval
+        self.pending = {}
+        self._flusher = None
+
+    async def publish(self, channel_layer, room_id, event):
+        if self.interval <= 0:
+            await send_to_room(channel_layer, room_id, [event])
+            return
+        started, layer, events = self.pending.setdefault(room_id, (time.perf_counter(), channel_layer, []))
+        events.append(event)
+        loop = asyncio.get_running_loop()
+        if self._flusher is None or self._flusher.done() or self._flusher.get_loop() is not loop:
+            self._flusher = loop.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.interval)
+        await self.flush()
+
+    async def flush(self):
+        batch, self.pending = self.pending, {}
+        await asyncio.gather(*(
+            send_to_room(layer, room_id, events, started)
+            for room_id, (started, layer, events) in batch.items()
+        ))
+
+
+_room_fanout = None
+
+
+def get_room_fanout():
+    global _room_fanout
+    if _room_fanout is None:
+        _room_fanout = RoomFanout(interval=getattr(settings, "ROOM_FANOUT_TICK", 0.0))
+    return _room_fanout
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from chat.search import rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = "Rebuild the full-text index used by message search."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--database", default=DEFAULT_DB_ALIAS, help="Database alias to rebuild.")
+
+    def handle(self, *args, **options):
+        conn = connections[options["database"]]
+        rebuild_search_index(conn)
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt message search index on {conn.alias} ({conn.vendor})"))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from chat.utils import rebuild_unread_counts
+
+
+class Command(BaseCommand):
+    help = "Rebuild per-participant unread counters from message history."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--conversation", type=int, action="append", dest="conversation_ids",
+            help="Only rebuild the given conversation id (can be repeated).",
+        )
+
+    def handle(self, *args, **options):
+        updated = rebuild_unread_counts(options["conversation_ids"])
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt unread counts for {updated} participants"))
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-18 18:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_conversationparticipant_unread_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='direct_key',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True),
+        ),
+    ]
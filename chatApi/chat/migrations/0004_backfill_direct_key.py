@@ -0,0 +1,55 @@
+from django.db import migrations
+from django.db.models import F, Max, Q
+
+
+def backfill_direct_keys(apps, schema_editor):
+    Conversation = apps.get_model("chat", "Conversation")
+    ConversationParticipant = apps.get_model("chat", "ConversationParticipant")
+    Message = apps.get_model("chat", "Message")
+
+    members = {}
+    for conversation_id, user_id in (
+        ConversationParticipant.objects
+        .filter(conversation__type="direct")
+        .values_list("conversation_id", "user_id")
+    ):
+        members.setdefault(conversation_id, set()).add(user_id)
+
+    by_key = {}
+    for conversation_id in sorted(members):
+        user_ids = sorted(members[conversation_id])
+        if len(user_ids) > 2:
+            continue
+        low, high = user_ids[0], user_ids[-1]
+        by_key.setdefault(f"{low}:{high}", []).append(conversation_id)
+
+    for key, conversation_ids in by_key.items():
+        keep, duplicates = conversation_ids[0], conversation_ids[1:]
+        if duplicates:
+            Message.objects.filter(conversation_id__in=duplicates).update(conversation_id=keep)
+            for participant in ConversationParticipant.objects.filter(conversation_id__in=duplicates):
+                ConversationParticipant.objects.filter(conversation_id=keep, user_id=participant.user_id).update(
+                    unread_count=F("unread_count") + participant.unread_count
+                )
+                if participant.last_read_at:
+                    (
+                        ConversationParticipant.objects
+                        .filter(conversation_id=keep, user_id=participant.user_id)
+                        .filter(Q(last_read_at__isnull=True) | Q(last_read_at__lt=participant.last_read_at))
+                        .update(last_read_at=participant.last_read_at)
+                    )
+            last_message_at = Message.objects.filter(conversation_id=keep).aggregate(m=Max("created_at"))["m"]
+            Conversation.objects.filter(pk=keep).update(last_message_at=last_message_at)
+            Conversation.objects.filter(pk__in=duplicates).delete()
+        Conversation.objects.filter(pk=keep).update(direct_key=key)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_conversation_direct_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_direct_keys, migrations.RunPython.noop),
+    ]
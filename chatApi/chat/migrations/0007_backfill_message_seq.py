@@ -0,0 +1,32 @@
+from django.db import migrations
+
+BATCH_SIZE = 1000
+
+
+def backfill_message_seq(apps, schema_editor):
+    Conversation = apps.get_model("chat", "Conversation")
+    Message = apps.get_model("chat", "Message")
+
+    for conversation_id in Conversation.objects.values_list("pk", flat=True).iterator():
+        seq = 0
+        pending = []
+        for msg in Message.objects.filter(conversation_id=conversation_id).order_by("created_at", "id").only("id").iterator():
+            seq += 1
+            msg.seq = seq
+            pending.append(msg)
+            if len(pending) >= BATCH_SIZE:
+                Message.objects.bulk_update(pending, ["seq"])
+                pending = []
+        Message.objects.bulk_update(pending, ["seq"])
+        Conversation.objects.filter(pk=conversation_id).update(last_seq=seq)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_message_seq'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_message_seq, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_backfill_message_seq'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('conversation', 'seq'), name='chat_message_conversation_seq_uniq'),
+        ),
+    ]
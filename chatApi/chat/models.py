@@ -1,10 +1,51 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import F, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce, JSONObject, Left
 from django.conf import settings
-from django.utils import timezone
-import datetime
+
+from .expressions import JSONArrayAgg
 
 User = settings.AUTH_USER_MODEL
 
+PREVIEW_LENGTH = 120
+
+
+class ConversationQuerySet(models.QuerySet):
+    def inbox_for(self, user):
+        """
+        Conversations of ``user`` annotated with everything the inbox renders
+        (unread count, last message preview, participants) in one query.
+        """
+        membership = ConversationParticipant.objects.filter(conversation=OuterRef("pk"))
+        last_message = (
+            Message.objects
+            .filter(conversation=OuterRef("pk"))
+            .order_by("-created_at", "-id")
+        )
+        participant_list = (
+            membership
+            .order_by()
+            .values("conversation")
+            .annotate(users=JSONArrayAgg(JSONObject(id="user_id", username="user__username")))
+            .values("users")
+        )
+        return (
+            self.filter(participants=user)
+            .annotate(
+                my_unread_count=Coalesce(
+                    Subquery(membership.filter(user=user).values("unread_count")[:1]), Value(0)
+                ),
+                last_message_id=Subquery(last_message.values("id")[:1]),
+                last_message_preview=Subquery(
+                    last_message.annotate(preview=Left("content", PREVIEW_LENGTH)).values("preview")[:1]
+                ),
+                last_message_sender_id=Subquery(last_message.values("sender_id")[:1]),
+                last_message_created_at=Subquery(last_message.values("created_at")[:1]),
+                participant_list=Subquery(participant_list),
+            )
+        )
+
+
 class Conversation(models.Model):
     TYPE_DIRECT = "direct"
     TYPE_ROOM = "room"
@@ -18,12 +59,21 @@ class Conversation(models.Model):
     title = models.CharField(max_length=255, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     last_message_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    last_seq = models.PositiveBigIntegerField(default=0, editable=False)
+    direct_key = models.CharField(max_length=64, null=True, blank=True, unique=True, editable=False)
+    # Overrides MESSAGE_RETENTION_DAYS for this conversation's type.
+    retention_days = models.PositiveIntegerField(null=True, blank=True)
+    # Newest created_at moved to ArchivedMessage; history reads older than this
+    # also look in the archive.
+    archived_until = models.DateTimeField(null=True, blank=True, editable=False)
     participants = models.ManyToManyField(
         settings.AUTH_USER_MODEL,
         through="ConversationParticipant",
         related_name="conversations"
     )
 
+    objects = ConversationQuerySet.as_manager()
+
     class Meta:
         indexes = [
             models.Index(fields=["type", "last_message_at"])
@@ -33,30 +83,38 @@ class Conversation(models.Model):
         return f"{self.get_type_display()} #{self.pk} {self.title}"
 
     def unread_count_for(self, user):
-        try:
-            cp = self.participants_through.get(user=user)
-            last_read = cp.last_read_at or timezone.make_aware(datetime.datetime.min)
-        except ConversationParticipant.DoesNotExist:
-            return 0
-        return self.messages.exclude(sender=user).filter(created_at__gt=last_read).count()
+        count = (
+            self.participants_through
+            .filter(user=user)
+            .values_list("unread_count", flat=True)
+            .first()
+        )
+        return count or 0
+
+    @staticmethod
+    def direct_key_for(user1, user2):
+        """Canonical key of the direct conversation between two users: "<low id>:<high id>"."""
+        low, high = sorted((getattr(user1, "pk", user1), getattr(user2, "pk", user2)))
+        return f"{low}:{high}"
 
     @classmethod
     def get_or_create_direct(cls, user1, user2):
-        convo = (
-            cls.objects
-            .filter(type=cls.TYPE_DIRECT)
-            .filter(participants=user1)
-            .filter(participants=user2)
-            .distinct()
-            .first()
-        )
-        created = False
-        if not convo:
-            convo = cls.objects.create(type=cls.TYPE_DIRECT)
-            ConversationParticipant.objects.create(conversation=convo, user=user1)
-            ConversationParticipant.objects.create(conversation=convo, user=user2)
-            created = True
-        return convo, created
+        key = cls.direct_key_for(user1, user2)
+        convo = cls.objects.filter(direct_key=key).first()
+        if convo:
+            return convo, False
+
+        try:
+            with transaction.atomic():
+                convo = cls.objects.create(type=cls.TYPE_DIRECT, direct_key=key)
+                user_ids = {getattr(user1, "pk", user1), getattr(user2, "pk", user2)}
+                ConversationParticipant.objects.bulk_create([
+                    ConversationParticipant(conversation=convo, user_id=user_id) for user_id in user_ids
+                ])
+        except IntegrityError:
+            # Lost the race against a concurrent first message; the winner's row is there now.
+            return cls.objects.get(direct_key=key), False
+        return convo, True
 
 
 class ConversationParticipant(models.Model):
@@ -68,6 +126,7 @@ class ConversationParticipant(models.Model):
     )
     joined_at = models.DateTimeField(auto_now_add=True)
     last_read_at = models.DateTimeField(null=True, blank=True)
+    unread_count = models.PositiveIntegerField(default=0)
 
     class Meta:
         unique_together = (("conversation", "user"),)
@@ -91,16 +150,122 @@ class Message(models.Model):
         "self", null=True, blank=True, on_delete=models.SET_NULL, related_name="replies"
     )
     created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    # Position in the conversation, allocated from Conversation.last_seq on insert.
+    seq = models.PositiveBigIntegerField(null=True, blank=True, editable=False)
 
     class Meta:
         ordering = ["created_at"]
         indexes = [
             models.Index(fields=["conversation", "created_at"])
         ]
+        constraints = [
+            models.UniqueConstraint(fields=["conversation", "seq"], name="chat_message_conversation_seq_uniq")
+        ]
 
     def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        Conversation.objects.filter(pk=self.conversation_id).update(last_message_at=self.created_at)
+        created = self._state.adding
+        unsequenced = [self] if created and self.seq is None else []
+        try:
+            with transaction.atomic():
+                if created:
+                    Message.assign_seqs([self])
+                super().save(*args, **kwargs)
+                if created:
+                    Message.touch_conversations([self])
+        except Exception:
+            Message.forget_seqs(unsequenced)
+            raise
+
+    @staticmethod
+    def assign_seqs(messages):
+        """
+        Reserve consecutive sequence numbers for unsaved ``messages``, one
+        UPDATE per conversation. Must run inside the inserting transaction.
+        """
+        per_conversation = {}
+        for msg in messages:
+            if msg.seq is None:
+                per_conversation.setdefault(msg.conversation_id, []).append(msg)
+
+        for conversation_id, pending in per_conversation.items():
+            Conversation.objects.filter(pk=conversation_id).update(last_seq=F("last_seq") + len(pending))
+            last_seq = Conversation.objects.filter(pk=conversation_id).values_list("last_seq", flat=True).get()
+            for offset, msg in enumerate(pending, start=last_seq - len(pending) + 1):
+                msg.seq = offset
+
+    @staticmethod
+    def forget_seqs(messages):
+        """
+        Clear the seqs assign_seqs put on instances whose insert was rolled
+        back, so a retry reserves fresh numbers. Only touches the instances:
+        the last_seq reservation itself is undone by the rollback.
+        """
+        for msg in messages:
+            msg.seq = None
+
+    @staticmethod
+    def touch_conversations(messages):
+        """
+        Bump last_message_at and the unread counters of every non-sender
+        participant, once per affected conversation.
+        """
+        per_conversation = {}
+        for msg in messages:
+            senders, last = per_conversation.setdefault(msg.conversation_id, ({}, msg.created_at))
+            senders[msg.sender_id] = senders.get(msg.sender_id, 0) + 1
+            per_conversation[msg.conversation_id] = (senders, max(last, msg.created_at))
+
+        for conversation_id, (senders, last) in per_conversation.items():
+            Conversation.objects.filter(pk=conversation_id).update(last_message_at=last)
+            participants = ConversationParticipant.objects.filter(conversation_id=conversation_id)
+            for sender_id, count in senders.items():
+                participants.exclude(user_id=sender_id).update(unread_count=F("unread_count") + count)
+
+    @staticmethod
+    def discount_unread(messages):
+        """
+        Take deleted ``messages`` back out of the unread counters of the
+        non-sender participants who had not read them yet.
+        """
+        for msg in messages:
+            (
+                ConversationParticipant.objects
+                .filter(conversation_id=msg.conversation_id, unread_count__gt=0)
+                .filter(Q(last_read_at__isnull=True) | Q(last_read_at__lt=msg.created_at))
+                .exclude(user_id=msg.sender_id)
+                .update(unread_count=F("unread_count") - 1)
+            )
 
     def __str__(self):
         return f"Msg#{self.pk} by User#{self.sender_id} in Conv#{self.conversation_id}"
+
+
+class ArchivedMessage(models.Model):
+    """
+    A message moved out of the hot Message table by the retention job. Keeps
+    the original id, timestamps and sequence number.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    conversation = models.ForeignKey(
+        Conversation, on_delete=models.CASCADE, related_name="archived_messages"
+    )
+    sender = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="chat_archived_messages"
+    )
+    content = models.TextField(blank=True)
+    # The parent may still be hot or already archived, so this is not enforced.
+    parent = models.ForeignKey(
+        "self", null=True, blank=True, on_delete=models.DO_NOTHING, db_constraint=False, related_name="+"
+    )
+    created_at = models.DateTimeField()
+    seq = models.PositiveBigIntegerField(null=True, blank=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["created_at"]
+        indexes = [
+            models.Index(fields=["conversation", "created_at"])
+        ]
+
+    def __str__(self):
+        return f"Archived msg#{self.pk} by User#{self.sender_id} in Conv#{self.conversation_id}"
@@ -0,0 +1,168 @@
+import base64
+import json
+from collections import OrderedDict
+
+from django.db.models import F, Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetCursorPagination(BasePagination):
+    """
+    Opaque-cursor keyset pagination over ``(ordering_field, pk)``, newest first.
+
+    ``next`` walks towards older rows ("load older") and ``previous`` towards
+    newer rows ("load newer"). Every page is a single indexed range scan, so
+    page N costs the same as page 1.
+
+    Views with a cold archive implement ``get_archive_queryset()`` and
+    ``get_archive_horizon()`` (newest archived value, or None); pages reaching
+    back past the horizon are merged with the archive.
+    """
+    ordering_field = "created_at"
+    page_size = 50
+    page_size_query_param = "page_size"
+    max_page_size = 200
+    cursor_query_param = "cursor"
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        self.nullable = queryset.model._meta.get_field(self.ordering_field).null
+
+        cursor = self.decode_cursor(request)
+        reverse = bool(cursor and cursor["r"])
+
+        results = self.fetch(queryset, cursor, reverse)
+        if self.reaches_archive(view, results, cursor, reverse):
+            archived = self.fetch(view.get_archive_queryset(), cursor, reverse)
+            results = sorted(
+                results + archived,
+                key=lambda obj: (getattr(obj, self.ordering_field), obj.pk),
+                reverse=not reverse,
+            )[:self.page_size + 1]
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if reverse:
+            results.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, cursor is not None
+
+        self.page = results
+        return results
+
+    def fetch(self, queryset, cursor, reverse):
+        queryset = queryset.order_by(*self.get_ordering(reverse))
+        if cursor:
+            queryset = queryset.filter(self.get_keyset_filter(cursor, reverse))
+        return list(queryset[:self.page_size + 1])
+
+    def reaches_archive(self, view, results, cursor, reverse):
+        if not hasattr(view, "get_archive_queryset"):
+            return False
+        horizon = view.get_archive_horizon()
+        if horizon is None:
+            return False
+        if reverse:
+            return cursor["v"] is None or cursor["v"] <= horizon
+        if len(results) <= self.page_size:
+            return True
+        return getattr(results[-1], self.ordering_field) <= horizon
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def get_ordering(self, reverse):
+        field = F(self.ordering_field)
+        if reverse:
+            return field.asc(nulls_first=True), "pk"
+        return field.desc(nulls_last=True), "-pk"
+
+    def get_keyset_filter(self, cursor, reverse):
+        name, value, pk = self.ordering_field, cursor["v"], cursor["pk"]
+        if reverse:
+            if value is None:
+                return Q(**{f"{name}__isnull": True, "pk__gt": pk}) | Q(**{f"{name}__isnull": False})
+            return Q(**{f"{name}__gt": value}) | Q(**{name: value, "pk__gt": pk})
+
+        if value is None:
+            return Q(**{f"{name}__isnull": True, "pk__lt": pk})
+        condition = Q(**{f"{name}__lt": value}) | Q(**{name: value, "pk__lt": pk})
+        if self.nullable:
+            condition |= Q(**{f"{name}__isnull": True})
+        return condition
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(encoded.encode("ascii")))
+            value = payload["v"]
+            if value is not None:
+                value = parse_datetime(value)
+                if value is None:
+                    raise ValueError
+            return {"v": value, "pk": int(payload["pk"]), "r": bool(payload["r"])}
+        except (TypeError, ValueError, KeyError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, obj, reverse):
+        value = getattr(obj, self.ordering_field)
+        payload = {
+            "v": value.isoformat() if value is not None else None,
+            "pk": obj.pk,
+            "r": int(reverse),
+        }
+        encoded = base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode())
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded.decode("ascii"))
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ("next", self.get_next_link()),
+            ("previous", self.get_previous_link()),
+            ("results", data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "required": ["results"],
+            "properties": {
+                "next": {"type": "string", "nullable": True, "format": "uri"},
+                "previous": {"type": "string", "nullable": True, "format": "uri"},
+                "results": schema,
+            },
+        }
+
+
+class ConversationCursorPagination(KeysetCursorPagination):
+    ordering_field = "last_message_at"
+    page_size = 30
+
+
+class MessageCursorPagination(KeysetCursorPagination):
+    ordering_field = "created_at"
+    page_size = 50
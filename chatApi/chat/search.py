@@ -0,0 +1,159 @@
+import re
+
+from django.db import connection, connections, router
+
+from .models import ConversationParticipant, Message
+
+SEARCH_CONFIG = "english"
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+
+# SQLite: an external-content FTS5 table over chat_message kept in sync by
+# triggers, so bulk_create and queryset updates are indexed too.
+SQLITE_FTS_TABLE = "chat_message_fts"
+SQLITE_CREATE_TABLE = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS chat_message_fts USING fts5("
+    "content, content='chat_message', content_rowid='id', tokenize='porter unicode61')"
+)
+SQLITE_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS chat_message_fts_ai AFTER INSERT ON chat_message BEGIN
+        INSERT INTO chat_message_fts(rowid, content) VALUES (new.id, new.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS chat_message_fts_ad AFTER DELETE ON chat_message BEGIN
+        INSERT INTO chat_message_fts(chat_message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS chat_message_fts_au AFTER UPDATE OF content ON chat_message BEGIN
+        INSERT INTO chat_message_fts(chat_message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO chat_message_fts(rowid, content) VALUES (new.id, new.content);
+    END""",
+]
+SQLITE_DROP = [
+    "DROP TRIGGER IF EXISTS chat_message_fts_ai",
+    "DROP TRIGGER IF EXISTS chat_message_fts_ad",
+    "DROP TRIGGER IF EXISTS chat_message_fts_au",
+    "DROP TABLE IF EXISTS chat_message_fts",
+]
+
+# PostgreSQL: a stored generated tsvector column with a GIN index; the
+# database keeps it current on every insert and update.
+POSTGRES_CREATE = [
+    f"ALTER TABLE chat_message ADD COLUMN IF NOT EXISTS search_vector tsvector "
+    f"GENERATED ALWAYS AS (to_tsvector('{SEARCH_CONFIG}', coalesce(content, ''))) STORED",
+    "CREATE INDEX IF NOT EXISTS chat_message_search_idx ON chat_message USING GIN (search_vector)",
+]
+POSTGRES_DROP = [
+    "DROP INDEX IF EXISTS chat_message_search_idx",
+    "ALTER TABLE chat_message DROP COLUMN IF EXISTS search_vector",
+]
+
+
+def install_search_index(conn):
+    with conn.cursor() as cursor:
+        if conn.vendor == "sqlite":
+            cursor.execute(SQLITE_CREATE_TABLE)
+            for sql in SQLITE_TRIGGERS:
+                cursor.execute(sql)
+            cursor.execute("INSERT INTO chat_message_fts(chat_message_fts) VALUES ('rebuild')")
+        elif conn.vendor == "postgresql":
+            for sql in POSTGRES_CREATE:
+                cursor.execute(sql)
+
+
+def drop_search_index(conn):
+    statements = {"sqlite": SQLITE_DROP, "postgresql": POSTGRES_DROP}.get(conn.vendor, [])
+    with conn.cursor() as cursor:
+        for sql in statements:
+            cursor.execute(sql)
+
+
+def ensure_sqlite_triggers(conn):
+    """
+    Recreate the FTS triggers if the index exists. SQLite schema changes that
+    rebuild chat_message drop its triggers along with the old table.
+    """
+    if conn.vendor != "sqlite" or SQLITE_FTS_TABLE not in conn.introspection.table_names():
+        return
+    with conn.cursor() as cursor:
+        for sql in SQLITE_TRIGGERS:
+            cursor.execute(sql)
+
+
+def rebuild_search_index(conn=connection):
+    """Rebuild the full-text index from chat_message."""
+    with conn.cursor() as cursor:
+        if conn.vendor == "sqlite":
+            ensure_sqlite_triggers(conn)
+            cursor.execute("INSERT INTO chat_message_fts(chat_message_fts) VALUES ('rebuild')")
+        elif conn.vendor == "postgresql":
+            cursor.execute("REINDEX INDEX chat_message_search_idx")
+
+
+def parse_terms(query):
+    return re.findall(r"\w+", query.lower())
+
+
+def search_message_ids(user, query, conversation_id=None, limit=SEARCH_PAGE_SIZE, offset=0):
+    """
+    Ids of messages matching ``query`` in conversations ``user`` participates
+    in, best match first. Every term must match; the last one as a prefix.
+    """
+    terms = parse_terms(query)
+    if not terms:
+        return []
+
+    conn = connections[router.db_for_read(Message)]
+    message_table = Message._meta.db_table
+    participant_table = ConversationParticipant._meta.db_table
+    scope = ""
+    scope_params = []
+    if conversation_id is not None:
+        scope = "AND m.conversation_id = %s"
+        scope_params = [conversation_id]
+
+    if conn.vendor == "sqlite":
+        match = " ".join(f'"{term}"' for term in terms) + "*"
+        sql = f"""
+            SELECT m.id FROM {SQLITE_FTS_TABLE}
+            JOIN {message_table} m ON m.id = {SQLITE_FTS_TABLE}.rowid
+            JOIN {participant_table} p ON p.conversation_id = m.conversation_id AND p.user_id = %s
+            WHERE {SQLITE_FTS_TABLE} MATCH %s {scope}
+            ORDER BY bm25({SQLITE_FTS_TABLE}), m.id DESC
+            LIMIT %s OFFSET %s
+        """
+        params = [user.pk, match, *scope_params, limit, offset]
+    elif conn.vendor == "postgresql":
+        tsquery = " & ".join(terms) + ":*"
+        sql = f"""
+            SELECT m.id FROM {message_table} m
+            JOIN {participant_table} p ON p.conversation_id = m.conversation_id AND p.user_id = %s
+            WHERE m.search_vector @@ to_tsquery('{SEARCH_CONFIG}', %s) {scope}
+            ORDER BY ts_rank(m.search_vector, to_tsquery('{SEARCH_CONFIG}', %s)) DESC, m.id DESC
+            LIMIT %s OFFSET %s
+        """
+        params = [user.pk, tsquery, *scope_params, tsquery, limit, offset]
+    else:
+        return unindexed_message_ids(conn, user, terms, conversation_id, limit, offset)
+
+    with conn.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
+
+
+def unindexed_message_ids(conn, user, terms, conversation_id, limit, offset):
+    """
+    Fallback for backends without a full-text index: every term must appear
+    in the content, newest first. Scans the caller's conversations.
+    """
+    messages = Message.objects.using(conn.alias).filter(conversation__participants=user)
+    if conversation_id is not None:
+        messages = messages.filter(conversation_id=conversation_id)
+    for term in terms:
+        messages = messages.filter(content__icontains=term)
+    return list(messages.order_by("-id").values_list("id", flat=True)[offset:offset + limit])
+
+
+def search_messages(user, query, conversation_id=None, limit=SEARCH_PAGE_SIZE, offset=0):
+    """Matching Message instances (with sender loaded) in rank order."""
+    ids = search_message_ids(user, query, conversation_id, limit, offset)
+    found = Message.objects.select_related("sender").in_bulk(ids)
+    return [found[pk] for pk in ids if pk in found]
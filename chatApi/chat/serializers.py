@@ -1,6 +1,6 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
-from .models import Conversation, Message
+from .models import PREVIEW_LENGTH, Conversation, Message
 from django.utils import timezone
 User = get_user_model()
 
@@ -12,17 +12,46 @@ class UserLiteSerializer(serializers.ModelSerializer):
 
 
 class ConversationSerializer(serializers.ModelSerializer):
-    participants = UserLiteSerializer(many=True, read_only=True)
+    participants = serializers.SerializerMethodField()
     unread_count = serializers.SerializerMethodField()
+    last_message = serializers.SerializerMethodField()
 
     class Meta:
         model = Conversation
-        fields = ["id", "type", "title", "participants", "last_message_at", "unread_count"]
+        fields = ["id", "type", "title", "participants", "last_message_at", "unread_count", "last_message"]
+
+    def get_participants(self, obj):
+        annotated = getattr(obj, "participant_list", None)
+        if annotated is not None:
+            return sorted(annotated, key=lambda p: p["id"])
+        return UserLiteSerializer(obj.participants.all(), many=True).data
+
+    def get_last_message(self, obj):
+        if hasattr(obj, "last_message_id"):
+            message_id, content = obj.last_message_id, obj.last_message_preview
+            sender_id, created_at = obj.last_message_sender_id, obj.last_message_created_at
+        else:
+            last = obj.messages.order_by("-created_at", "-id").first()
+            if last is None:
+                return None
+            message_id, content = last.id, last.content[:PREVIEW_LENGTH]
+            sender_id, created_at = last.sender_id, last.created_at
+        if message_id is None:
+            return None
+        return {
+            "id": message_id,
+            "content": content,
+            "sender_id": sender_id,
+            "created_at": serializers.DateTimeField().to_representation(created_at),
+        }
 
     def get_unread_count(self, obj):
         user = self.context["request"].user
         if not user.is_authenticated:
             return 0
+        annotated = getattr(obj, "my_unread_count", None)
+        if annotated is not None:
+            return annotated
         return obj.unread_count_for(user)
 
 
@@ -37,27 +66,55 @@ class ConversationCreateSerializer(serializers.Serializer):
 
 class MessageSerializer(serializers.ModelSerializer):
     sender = UserLiteSerializer(read_only=True)
-    conversation_id = serializers.IntegerField(source="conversation.id", read_only=True)
+    conversation_id = serializers.IntegerField(read_only=True)
+    parent_id = serializers.IntegerField(read_only=True)
 
     class Meta:
         model = Message
-        fields = ("id", "conversation_id", "sender", "content", "created_at")
-        read_only_fields = ("id", "sender", "conversation_id", "created_at")
+        fields = ("id", "conversation_id", "seq", "sender", "content", "parent_id", "created_at")
+        read_only_fields = ("id", "sender", "conversation_id", "seq", "parent_id", "created_at")
 
 
 class MessageCreateSerializer(serializers.ModelSerializer):
+    conversation = serializers.PrimaryKeyRelatedField(
+        queryset=Conversation.objects.all(), required=False
+    )
     recipient_id = serializers.IntegerField(required=False)
 
     class Meta:
         model = Message
         fields = ("conversation", "recipient_id", "content", "parent")
-        read_only_fields = ("conversation", "parent")
+
+    def get_fields(self):
+        fields = super().get_fields()
+        request = self.context.get("request")
+        if request is not None and request.user.is_authenticated:
+            fields["conversation"].queryset = Conversation.objects.filter(participants=request.user)
+            fields["parent"].queryset = Message.objects.filter(conversation__participants=request.user)
+        return fields
+
+    def validate_recipient_id(self, value):
+        if not User.objects.filter(pk=value).exists():
+            raise serializers.ValidationError("User does not exist")
+        return value
 
     def validate(self, attrs):
         if not attrs.get("conversation") and not attrs.get("recipient_id"):
             raise serializers.ValidationError(
                 "You must provide either conversation_id or recipient_id"
             )
+        parent = attrs.get("parent")
+        convo = attrs.get("conversation")
+        if parent is None:
+            return attrs
+        if convo is not None:
+            same_conversation = parent.conversation_id == convo.pk
+        else:
+            request = self.context.get("request")
+            direct_key = Conversation.direct_key_for(request.user, attrs["recipient_id"])
+            same_conversation = parent.conversation.direct_key == direct_key
+        if not same_conversation:
+            raise serializers.ValidationError({"parent": "Parent message belongs to another conversation"})
         return attrs
 
 
@@ -0,0 +1,187 @@
+import asyncio
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.dispatch import Signal
+
+from .encoding import encode_all
+from .fanout import send_to_room
+from .models import Conversation, ConversationParticipant, Message
+
+logger = logging.getLogger(__name__)
+
+BULK_MESSAGE_LIMIT = 500
+
+# Sent after commit with ``messages`` and ``action`` for every message change
+# that goes through publish_on_commit, before it is fanned out.
+messages_committed = Signal()
+
+
+EVENT_TYPES = {
+    "created": "chat_message",
+    "updated": "chat_message_updated",
+    "deleted": "chat_message_deleted",
+}
+
+
+def inbox_group_name(user_id):
+    """Channel-layer group of one user's inbox sockets."""
+    return f"inbox_{user_id}"
+
+
+def message_event(message, action="created"):
+    """Channel-layer event announcing a message change to a room group."""
+    return {
+        "type": EVENT_TYPES[action],
+        "id": message.pk,
+        "conversation_id": message.conversation_id,
+        "parent_id": message.parent_id,
+        "seq": message.seq,
+        "message": message.content,
+        "sender": message.sender.username,
+        "timestamp": message.created_at.isoformat(),
+    }
+
+
+def inbox_frame(event, action):
+    """What an inbox socket receives for a message event."""
+    message = {key: value for key, value in event.items() if key != "type"}
+    return {"type": f"message.{action}", **message}
+
+
+def publish_messages(messages, action="created"):
+    """
+    Group-send message changes to the websocket group of the room they belong
+    to and, for direct conversations, to the inbox group of both participants.
+    Room messages stay off member inboxes: one send per member would grow with
+    the room, while the room group fans out in a bounded number of sends.
+    Failures are logged: by the time this runs the change is already committed.
+    """
+    channel_layer = get_channel_layer()
+    if channel_layer is None or not messages:
+        return
+    conversations = {
+        pk: (kind, room_id)
+        for pk, kind, room_id in (
+            Conversation.objects
+            .filter(pk__in={msg.conversation_id for msg in messages})
+            .values_list("pk", "type", "room__id")
+        )
+    }
+    direct_ids = [pk for pk, (kind, _) in conversations.items() if kind == Conversation.TYPE_DIRECT]
+    members = {}
+    if direct_ids:
+        for conversation_id, user_id in (
+            ConversationParticipant.objects
+            .filter(conversation_id__in=direct_ids)
+            .values_list("conversation_id", "user_id")
+        ):
+            members.setdefault(conversation_id, []).append(user_id)
+
+    sends = []
+    room_events = {}
+    for msg in messages:
+        event = message_event(msg, action)
+        room_id = conversations.get(msg.conversation_id, (None, None))[1]
+        if room_id is not None:
+            room_events.setdefault(room_id, []).append(event)
+        if msg.conversation_id not in members:
+            continue
+        # Encoded once here and forwarded as-is by every participant's socket.
+        frame = inbox_frame(event, action)
+        inbox_event = {"type": "inbox.message", "frame": frame, "encoded": encode_all(frame)}
+        for user_id in members[msg.conversation_id]:
+            sends.append((inbox_group_name(user_id), inbox_event))
+
+    async_to_sync(_publish_all)(channel_layer, room_events, sends)
+
+
+async def _publish_all(channel_layer, room_events, sends):
+    # Each room gets its messages as one batch across its fan-out sub-groups.
+    await asyncio.gather(
+        _group_send_all(channel_layer, sends),
+        *(send_to_room(channel_layer, room_id, events) for room_id, events in room_events.items()),
+    )
+
+
+async def _group_send_all(channel_layer, sends):
+    results = await asyncio.gather(
+        *(channel_layer.group_send(group, event) for group, event in sends),
+        return_exceptions=True,
+    )
+    for (group, _), result in zip(sends, results):
+        if isinstance(result, Exception):
+            logger.error("Publishing to %s failed", group, exc_info=result)
+
+
+def publish_on_commit(messages, action="created", publish=True):
+    messages = list(messages)
+
+    def committed():
+        for receiver, result in messages_committed.send_robust(sender=Message, messages=messages, action=action):
+            if isinstance(result, Exception):
+                logger.error("%r failed on committed messages", receiver, exc_info=result)
+        if publish:
+            publish_messages(messages, action)
+
+    # The messages are committed by the time this runs: a failed publish is
+    # logged rather than surfacing as an error for a saved write.
+    transaction.on_commit(committed, robust=True)
+
+
+def persist_messages(messages, publish=True):
+    """
+    The single write path for chat messages: insert ``messages`` (unsaved
+    Message instances) in one statement, update last_message_at and unread
+    counters once per conversation and, after commit, publish them.
+    ``publish=False`` is for callers that publish the returned messages from
+    their own event loop, such as the websocket write buffer, whose inserts
+    run on the shared database thread.
+    """
+    if not messages:
+        return []
+    unsequenced = [msg for msg in messages if msg.seq is None]
+    try:
+        with transaction.atomic():
+            Message.assign_seqs(messages)
+            messages = Message.objects.bulk_create(messages)
+            Message.touch_conversations(messages)
+            publish_on_commit(messages, publish=publish)
+    except Exception:
+        Message.forget_seqs(unsequenced)
+        raise
+    return messages
+
+
+def send_message(sender, conversation, content="", parent=None):
+    """Persist and publish a single message."""
+    (msg,) = persist_messages(
+        [Message(conversation=conversation, sender=sender, content=content, parent=parent)]
+    )
+    return msg
+
+
+def bulk_send_messages(sender, entries):
+    """
+    Insert messages from validated ``MessageCreateSerializer`` data with a single
+    bulk INSERT, then update conversation bookkeeping once per conversation.
+    """
+    direct = {}
+    messages = []
+    for entry in entries:
+        convo = entry.get("conversation")
+        if convo is None:
+            recipient_id = entry["recipient_id"]
+            if recipient_id not in direct:
+                direct[recipient_id], _ = Conversation.get_or_create_direct(sender, recipient_id)
+            convo = direct[recipient_id]
+        messages.append(Message(
+            conversation=convo,
+            sender=sender,
+            content=entry.get("content", ""),
+            parent=entry.get("parent"),
+        ))
+
+    return persist_messages(messages)
@@ -0,0 +1,8 @@
+from celery import shared_task
+
+from .archive import archive_old_messages
+
+
+@shared_task
+def archive_messages():
+    return archive_old_messages()
@@ -1,7 +1,18 @@
-from django.test import TestCase
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import patch
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError, connection, connections, transaction
+from django.db.models import QuerySet
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth import get_user_model
+from django.utils import timezone
 from rest_framework.test import APIClient
-from chat.models import Conversation
+from chatApi.routers import PrimaryReplicaRouter, pin_cache_key, replica_reads
+from chat.archive import archive_old_messages
+from chat.models import ArchivedMessage, Conversation, Message
 from chat.models import ConversationParticipant
 
 User = get_user_model()
@@ -71,3 +82,398 @@ class MessagingTestCase(TestCase):
         after = self.client.get(f"/api/conversations/{conv_id}/unread_count/")
         self.assertEqual(after.data["unread_count"], 0)
 
+    def test_conversation_list_uses_unread_counters(self):
+        self.login_as(self.kenny)
+        self.client.post("/api/messages/", {"recipient_id": self.kevin.id, "content": "one"}, format="json")
+        msg = self.client.post("/api/messages/", {"recipient_id": self.kevin.id, "content": "two"}, format="json")
+        conv_id = msg.data["conversation_id"]
+
+        cp = ConversationParticipant.objects.get(conversation_id=conv_id, user=self.kevin)
+        self.assertEqual(cp.unread_count, 2)
+
+        self.login_as(self.kevin)
+        listing = self.client.get("/api/conversations/")
+        self.assertEqual(listing.status_code, 200)
+        self.assertEqual(listing.data["results"][0]["unread_count"], 2)
+
+        self.client.post(f"/api/conversations/{conv_id}/mark_read/")
+        cp.refresh_from_db()
+        self.assertEqual(cp.unread_count, 0)
+
+    def test_deleting_a_message_updates_unread_counts(self):
+        self.login_as(self.kenny)
+        first = self.client.post("/api/messages/", {"recipient_id": self.kevin.id, "content": "read"}, format="json")
+        conv_id = first.data["conversation_id"]
+        self.login_as(self.kevin)
+        self.client.post(f"/api/conversations/{conv_id}/mark_read/")
+
+        self.login_as(self.kenny)
+        second = self.client.post("/api/messages/", {"recipient_id": self.kevin.id, "content": "unread"}, format="json")
+        self.client.post("/api/messages/", {"recipient_id": self.kevin.id, "content": "kept"}, format="json")
+        kevin = ConversationParticipant.objects.get(conversation_id=conv_id, user=self.kevin)
+        self.assertEqual(kevin.unread_count, 2)
+
+        self.assertEqual(self.client.delete(f"/api/messages/{first.data['id']}/").status_code, 204)
+        kevin.refresh_from_db()
+        self.assertEqual(kevin.unread_count, 2)
+
+        self.assertEqual(self.client.delete(f"/api/messages/{second.data['id']}/").status_code, 204)
+        kevin.refresh_from_db()
+        self.assertEqual(kevin.unread_count, 1)
+
+    def test_rebuild_unread_counts_command(self):
+        self.login_as(self.kenny)
+        msg = self.client.post("/api/messages/", {"recipient_id": self.kevin.id, "content": "hi"}, format="json")
+        self.client.post("/api/messages/", {"recipient_id": self.kevin.id, "content": "again"}, format="json")
+        conv_id = msg.data["conversation_id"]
+
+        ConversationParticipant.objects.filter(conversation_id=conv_id).update(unread_count=42)
+        call_command("rebuild_unread_counts", stdout=StringIO())
+
+        counts = dict(
+            ConversationParticipant.objects
+            .filter(conversation_id=conv_id)
+            .values_list("user__username", "unread_count")
+        )
+        self.assertEqual(counts, {"kenny": 0, "kevin": 2})
+
+    def test_message_listing_walks_cursors_both_ways(self):
+        self.login_as(self.kenny)
+        ids = []
+        for i in range(5):
+            resp = self.client.post("/api/messages/", {"recipient_id": self.kevin.id, "content": f"m{i}"}, format="json")
+            ids.append(resp.data["id"])
+        conv_id = resp.data["conversation_id"]
+
+        page1 = self.client.get(f"/api/messages/?conversation={conv_id}&page_size=2")
+        self.assertEqual([m["id"] for m in page1.data["results"]], ids[:-3:-1])
+        self.assertIsNone(page1.data["previous"])
+
+        page2 = self.client.get(page1.data["next"])
+        self.assertEqual([m["id"] for m in page2.data["results"]], [ids[2], ids[1]])
+
+        page3 = self.client.get(page2.data["next"])
+        self.assertEqual([m["id"] for m in page3.data["results"]], [ids[0]])
+        self.assertIsNone(page3.data["next"])
+
+        newer = self.client.get(page3.data["previous"])
+        self.assertEqual([m["id"] for m in newer.data["results"]], [ids[2], ids[1]])
+        self.assertIsNotNone(newer.data["previous"])
+
+    def test_conversation_listing_is_paginated(self):
+        others = [User.objects.create_user(username=f"u{i}", password="1234") for i in range(3)]
+        self.login_as(self.kenny)
+        for other in others:
+            self.client.post("/api/messages/", {"recipient_id": other.id, "content": "yo"}, format="json")
+        self.client.post("/api/conversations/direct/", {"other_user_id": self.kevin.id}, format="json")
+
+        seen = []
+        url = "/api/conversations/?page_size=2"
+        while url:
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, 200)
+            seen.extend(c["id"] for c in resp.data["results"])
+            url = resp.data["next"]
+        self.assertEqual(len(seen), 4)
+        self.assertEqual(len(set(seen)), 4)
+
+    def test_invalid_cursor_is_rejected(self):
+        self.login_as(self.kenny)
+        resp = self.client.get("/api/messages/?cursor=not-a-cursor")
+        self.assertEqual(resp.status_code, 404)
+
+    def test_inbox_annotates_preview_and_participants(self):
+        self.login_as(self.kenny)
+        self.client.post("/api/messages/", {"recipient_id": self.kevin.id, "content": "first"}, format="json")
+        last = self.client.post("/api/messages/", {"recipient_id": self.kevin.id, "content": "x" * 500}, format="json")
+
+        self.login_as(self.kevin)
+        convo = self.client.get("/api/conversations/").data["results"][0]
+        self.assertEqual(convo["unread_count"], 2)
+        self.assertEqual(convo["last_message"]["id"], last.data["id"])
+        self.assertEqual(convo["last_message"]["sender_id"], self.kenny.id)
+        self.assertEqual(len(convo["last_message"]["content"]), 120)
+        self.assertEqual(
+            convo["participants"],
+            [{"id": self.kenny.id, "username": "kenny"}, {"id": self.kevin.id, "username": "kevin"}],
+        )
+
+    def test_inbox_query_count_is_constant(self):
+        # A fresh last_seen keeps the heartbeat write out of the counts.
+        self.kenny.last_seen = timezone.now()
+        self.client.force_authenticate(user=self.kenny)
+
+        def inbox_queries():
+            with CaptureQueriesContext(connection) as ctx:
+                resp = self.client.get("/api/conversations/")
+            self.assertEqual(resp.status_code, 200)
+            return len(ctx.captured_queries)
+
+        def add_conversations(n):
+            for _ in range(n):
+                other = User.objects.create_user(username=f"peer{User.objects.count()}", password="1234")
+                convo, _ = Conversation.get_or_create_direct(self.kenny, other)
+                Message.objects.create(conversation=convo, sender=other, content="ping")
+
+        add_conversations(2)
+        baseline = inbox_queries()
+        add_conversations(8)
+        self.assertEqual(inbox_queries(), baseline)
+
+    def test_direct_conversation_has_unique_canonical_key(self):
+        convo, created = Conversation.get_or_create_direct(self.kevin, self.kenny)
+        self.assertTrue(created)
+        self.assertEqual(convo.direct_key, f"{self.kenny.id}:{self.kevin.id}")
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Conversation.objects.create(type=Conversation.TYPE_DIRECT, direct_key=convo.direct_key)
+
+    def test_direct_conversation_race_returns_existing_row(self):
+        existing, _ = Conversation.get_or_create_direct(self.kenny, self.kevin)
+
+        # Pretend the lookup ran before the concurrent insert committed.
+        with patch.object(QuerySet, "first", return_value=None):
+            convo, created = Conversation.get_or_create_direct(self.kevin, self.kenny)
+
+        self.assertFalse(created)
+        self.assertEqual(convo.pk, existing.pk)
+        self.assertEqual(Conversation.objects.filter(type=Conversation.TYPE_DIRECT).count(), 1)
+
+    def test_bulk_send_reports_partial_failures(self):
+        self.login_as(self.kenny)
+        convo, _ = Conversation.get_or_create_direct(self.kenny, self.kevin)
+        stranger = User.objects.create_user(username="stranger", password="1234")
+        foreign, _ = Conversation.get_or_create_direct(self.kevin, stranger)
+
+        payload = [
+            {"conversation": convo.id, "content": "one"},
+            {"conversation": foreign.id, "content": "not mine"},
+            {"recipient_id": self.kevin.id, "content": "two"},
+            {"content": "nowhere"},
+            {"recipient_id": stranger.id, "content": "hello stranger"},
+        ]
+        resp = self.client.post("/api/messages/bulk/", payload, format="json")
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual([c["index"] for c in resp.data["created"]], [0, 2, 4])
+        self.assertEqual([e["index"] for e in resp.data["errors"]], [1, 3])
+
+        convo.refresh_from_db()
+        last = Message.objects.filter(conversation=convo).order_by("-created_at").first()
+        self.assertEqual(last.content, "two")
+        self.assertEqual(convo.last_message_at, last.created_at)
+        self.assertEqual(convo.unread_count_for(self.kevin), 2)
+        self.assertEqual(convo.unread_count_for(self.kenny), 0)
+        self.assertEqual(Message.objects.filter(conversation=foreign).count(), 0)
+
+    def test_bulk_send_rejects_non_list_payload(self):
+        self.login_as(self.kenny)
+        resp = self.client.post("/api/messages/bulk/", {"content": "hi"}, format="json")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_reply_by_recipient_must_stay_in_the_direct_conversation(self):
+        other = User.objects.create_user(username="other", password="1234")
+        convo, _ = Conversation.get_or_create_direct(self.kenny, self.kevin)
+        elsewhere, _ = Conversation.get_or_create_direct(self.kenny, other)
+        local = Message.objects.create(conversation=convo, sender=self.kevin, content="here")
+        foreign = Message.objects.create(conversation=elsewhere, sender=other, content="there")
+
+        self.login_as(self.kenny)
+        ok = self.client.post(
+            "/api/messages/", {"recipient_id": self.kevin.id, "content": "re", "parent": local.id}, format="json"
+        )
+        self.assertEqual(ok.status_code, 201)
+        rejected = self.client.post(
+            "/api/messages/", {"recipient_id": self.kevin.id, "content": "re", "parent": foreign.id}, format="json"
+        )
+        self.assertEqual(rejected.status_code, 400)
+        self.assertIn("parent", rejected.data)
+
+        bulk = self.client.post(
+            "/api/messages/bulk/", [{"recipient_id": self.kevin.id, "content": "re", "parent": foreign.id}], format="json"
+        )
+        self.assertEqual([e["index"] for e in bulk.data["errors"]], [0])
+        self.assertFalse(Message.objects.filter(parent=foreign).exists())
+
+    def test_thread_endpoint_loads_subtree_in_pages(self):
+        convo, _ = Conversation.get_or_create_direct(self.kenny, self.kevin)
+        root = Message.objects.create(conversation=convo, sender=self.kenny, content="root")
+        parent = root
+        chain = []
+        for i in range(4):
+            parent = Message.objects.create(conversation=convo, sender=self.kevin, content=f"c{i}", parent=parent)
+            chain.append(parent.id)
+        sibling = Message.objects.create(conversation=convo, sender=self.kenny, content="side", parent=root)
+
+        self.login_as(self.kenny)
+        with CaptureQueriesContext(connection) as ctx:
+            full = self.client.get(f"/api/messages/{root.id}/thread/")
+        self.assertEqual(full.status_code, 200)
+        thread_queries = [q for q in ctx.captured_queries if "RECURSIVE" in q["sql"]]
+        self.assertEqual(len(thread_queries), 1)
+        self.assertIsNone(full.data["next"])
+        top = full.data["replies"]
+        self.assertEqual([n["id"] for n in top], [chain[0], sibling.id])
+        node, depth = top[0], 1
+        while node["replies"]:
+            node = node["replies"][0]
+            depth += 1
+        self.assertEqual(depth, 4)
+        self.assertEqual(node["depth"], 4)
+
+        shallow = self.client.get(f"/api/messages/{root.id}/thread/?depth=1")
+        self.assertEqual([n["id"] for n in shallow.data["replies"]], [chain[0], sibling.id])
+
+        page1 = self.client.get(f"/api/messages/{root.id}/thread/?limit=3")
+        self.assertEqual(page1.data["replies"][0]["id"], chain[0])
+        page2 = self.client.get(page1.data["next"])
+        self.assertEqual([n["id"] for n in page2.data["replies"]], [chain[3], sibling.id])
+        self.assertEqual(page2.data["replies"][0]["parent_id"], chain[2])
+        self.assertIsNone(page2.data["next"])
+
+    def test_thread_does_not_follow_replies_from_other_conversations(self):
+        other = User.objects.create_user(username="other", password="1234")
+        convo, _ = Conversation.get_or_create_direct(self.kenny, self.kevin)
+        private, _ = Conversation.get_or_create_direct(self.kevin, other)
+        root = Message.objects.create(conversation=convo, sender=self.kenny, content="root")
+        reply = Message.objects.create(conversation=convo, sender=self.kevin, content="reply", parent=root)
+        # Written directly: the API refuses such parents, older rows may not.
+        Message.objects.create(conversation=private, sender=self.kevin, content="secret DM", parent=root)
+        Message.objects.create(conversation=private, sender=self.kevin, content="secret DM", parent=reply)
+
+        self.login_as(self.kenny)
+        thread = self.client.get(f"/api/messages/{root.id}/thread/")
+        self.assertEqual([n["id"] for n in thread.data["replies"]], [reply.id])
+        self.assertEqual(thread.data["replies"][0]["replies"], [])
+        self.assertNotIn("secret DM", str(thread.data))
+
+    def test_search_is_ranked_scoped_and_incremental(self):
+        outsider = User.objects.create_user(username="outsider", password="1234")
+        convo, _ = Conversation.get_or_create_direct(self.kenny, self.kevin)
+        hidden, _ = Conversation.get_or_create_direct(self.kevin, outsider)
+        once = Message.objects.create(conversation=convo, sender=self.kevin, content="deploy the release tonight")
+        twice = Message.objects.create(conversation=convo, sender=self.kenny, content="release release notes")
+        Message.objects.create(conversation=hidden, sender=outsider, content="secret release plans")
+        Message.objects.create(conversation=convo, sender=self.kenny, content="unrelated")
+
+        self.login_as(self.kenny)
+        resp = self.client.get("/api/messages/search/?q=releas")
+        self.assertEqual([m["id"] for m in resp.data["results"]], [twice.id, once.id])
+
+        page = self.client.get("/api/messages/search/?q=release&limit=1")
+        self.assertEqual([m["id"] for m in page.data["results"]], [twice.id])
+        self.assertEqual([m["id"] for m in self.client.get(page.data["next"]).data["results"]], [once.id])
+
+        once.content = "deploy tonight"
+        once.save()
+        twice.delete()
+        self.assertEqual(self.client.get("/api/messages/search/?q=release").data["results"], [])
+        self.assertEqual(len(self.client.get("/api/messages/search/?q=tonight").data["results"]), 1)
+        self.assertEqual(self.client.get("/api/messages/search/?q=").status_code, 400)
+
+    def test_search_falls_back_to_a_scan_without_an_index(self):
+        convo, _ = Conversation.get_or_create_direct(self.kenny, self.kevin)
+        older = Message.objects.create(conversation=convo, sender=self.kevin, content="Release notes")
+        newer = Message.objects.create(conversation=convo, sender=self.kenny, content="the release is out")
+        Message.objects.create(conversation=convo, sender=self.kenny, content="unrelated")
+
+        self.login_as(self.kenny)
+        with patch.object(connection, "vendor", "mysql"):
+            resp = self.client.get("/api/messages/search/?q=release")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([m["id"] for m in resp.data["results"]], [newer.id, older.id])
+
+    def test_rebuild_search_index_command(self):
+        convo, _ = Conversation.get_or_create_direct(self.kenny, self.kevin)
+        msg = Message.objects.create(conversation=convo, sender=self.kevin, content="needle")
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO chat_message_fts(chat_message_fts) VALUES ('delete-all')")
+        call_command("rebuild_search_index", stdout=StringIO())
+
+        self.login_as(self.kenny)
+        resp = self.client.get("/api/messages/search/?q=needle")
+        self.assertEqual([m["id"] for m in resp.data["results"]], [msg.id])
+
+    def test_archive_moves_old_messages_and_listing_falls_through(self):
+        convo, _ = Conversation.get_or_create_direct(self.kenny, self.kevin)
+        now = timezone.now()
+        messages = []
+        for days_ago in (40, 35, 32, 31, 1):
+            msg = Message.objects.create(conversation=convo, sender=self.kenny, content=f"{days_ago}d")
+            Message.objects.filter(pk=msg.pk).update(created_at=now - timedelta(days=days_ago))
+            messages.append(msg)
+        # A hot reply keeps its old parent in the hot table.
+        parent = messages[1]
+        Message.objects.create(conversation=convo, sender=self.kevin, content="late reply", parent=parent)
+
+        with self.settings(MESSAGE_RETENTION_DAYS={"direct": 30}, MESSAGE_ARCHIVE_BATCH_SIZE=2):
+            moved = archive_old_messages(now)
+        self.assertEqual(moved, 3)
+        self.assertEqual(
+            set(ArchivedMessage.objects.values_list("content", flat=True)), {"40d", "32d", "31d"}
+        )
+        self.assertTrue(Message.objects.filter(pk=parent.pk).exists())
+        convo.refresh_from_db()
+        self.assertEqual(convo.archived_until, now - timedelta(days=31))
+
+        self.login_as(self.kenny)
+        page = self.client.get(f"/api/messages/?conversation={convo.id}&page_size=2")
+        seen = [m["content"] for m in page.data["results"]]
+        while page.data["next"]:
+            page = self.client.get(page.data["next"])
+            seen += [m["content"] for m in page.data["results"]]
+        self.assertEqual(seen, ["late reply", "1d", "31d", "32d", "35d", "40d"])
+
+        back = self.client.get(page.data["previous"])
+        self.assertEqual([m["content"] for m in back.data["results"]], ["31d", "32d"])
+
+    def test_reads_use_replicas_until_the_user_writes(self):
+        cache.clear()
+        router = PrimaryReplicaRouter()
+        with self.settings(DATABASE_REPLICAS=["replica"]):
+            self.assertEqual(router.db_for_read(Message), "default")
+            token = replica_reads.set(True)
+            try:
+                self.assertEqual(router.db_for_read(Message), "replica")
+                self.assertEqual(router.db_for_write(Message), "default")
+            finally:
+                replica_reads.reset(token)
+
+        self.login_as(self.kenny)
+        with patch("chatApi.routers.choose_replica", return_value="default") as choose:
+            self.client.get("/api/conversations/")
+            self.assertTrue(choose.called)
+
+            choose.reset_mock()
+            self.client.post("/api/messages/", {"recipient_id": self.kevin.id, "content": "hi"}, format="json")
+            self.assertFalse(choose.called)
+            self.client.get("/api/conversations/")
+            self.assertFalse(choose.called)
+
+            cache.delete(pin_cache_key(self.kenny.pk))
+            self.client.get("/api/conversations/")
+            self.assertTrue(choose.called)
+
+
+class ReplicaRoutingTestCase(TransactionTestCase):
+    databases = {"default", "replica"}
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.kenny = User.objects.create_user(username="kenny", password="1234")
+        self.kevin = User.objects.create_user(username="kevin", password="1234")
+        self.client.force_authenticate(user=self.kenny)
+
+    def test_reads_hit_the_replica_alias_until_the_user_writes(self):
+        Conversation.get_or_create_direct(self.kenny, self.kevin)
+        with self.settings(DATABASE_REPLICAS=["replica"]):
+            with CaptureQueriesContext(connections["replica"]) as replica:
+                listing = self.client.get("/api/conversations/")
+            self.assertEqual(len(listing.data["results"]), 1)
+            self.assertTrue(replica.captured_queries)
+
+            self.client.post("/api/messages/", {"recipient_id": self.kevin.id, "content": "hi"}, format="json")
+            with CaptureQueriesContext(connections["replica"]) as replica:
+                listing = self.client.get("/api/conversations/")
+            self.assertEqual(listing.data["results"][0]["last_message"]["content"], "hi")
+            self.assertEqual(replica.captured_queries, [])
@@ -1,5 +1,11 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Count, IntegerField, OuterRef, Q, Subquery, prefetch_related_objects
+from django.db.models.functions import Coalesce
+from django.db.models.lookups import IsNull
 from django.utils import timezone
-from .models import Conversation, Message
+from .models import Conversation, ConversationParticipant, Message
 from django.contrib.auth import get_user_model
 
 
@@ -10,28 +16,136 @@ def get_unread_count(conversation: Conversation, user: User) -> int:
     """
     Return the number of unread messages in a conversation for a specific user.
     """
-    return conversation.messages.exclude(sender=user).filter(is_read=False).count()
+    return conversation.unread_count_for(user)
 
 
 def mark_conversation_as_read(conversation: Conversation, user: User):
     """
     Mark all messages in a conversation as read for the current user.
     """
-    conversation.messages.exclude(sender=user).filter(is_read=False).update(is_read=True)
+    now = timezone.now()
+    # Repeated calls with nothing new to read (e.g. on every scroll) skip the row write.
+    window = timedelta(seconds=getattr(settings, "READ_RECEIPT_DEBOUNCE", 2.0))
+    (
+        ConversationParticipant.objects
+        .filter(conversation=conversation, user=user)
+        .filter(Q(unread_count__gt=0) | Q(last_read_at__isnull=True) | Q(last_read_at__lt=now - window))
+        .update(last_read_at=now, unread_count=0)
+    )
+    return now
+
+
+def mark_read_until(conversation_id, user_id, read_at):
+    """
+    Move a participant's read marker forward to ``read_at`` and recount the
+    messages that arrived after it.
+    """
+    unread = (
+        Message.objects
+        .filter(conversation_id=conversation_id, created_at__gt=read_at)
+        .exclude(sender_id=user_id)
+        .order_by()
+        .values("conversation")
+        .annotate(c=Count("id"))
+        .values("c")
+    )
+    return (
+        ConversationParticipant.objects
+        .filter(conversation_id=conversation_id, user_id=user_id)
+        .filter(Q(last_read_at__isnull=True) | Q(last_read_at__lt=read_at))
+        .update(last_read_at=read_at, unread_count=Coalesce(Subquery(unread, output_field=IntegerField()), 0))
+    )
+
+
+def rebuild_unread_counts(conversation_ids=None) -> int:
+    """
+    Recompute ConversationParticipant.unread_count from Message history.
+    Returns the number of participant rows updated.
+    """
+    unread = (
+        Message.objects
+        .filter(conversation=OuterRef("conversation"))
+        .exclude(sender=OuterRef("user"))
+        .filter(Q(created_at__gt=OuterRef("last_read_at")) | Q(IsNull(OuterRef("last_read_at"), True)))
+        .order_by()
+        .values("conversation")
+        .annotate(c=Count("id"))
+        .values("c")
+    )
+    participants = ConversationParticipant.objects.all()
+    if conversation_ids is not None:
+        participants = participants.filter(conversation_id__in=conversation_ids)
+    return participants.update(
+        unread_count=Coalesce(Subquery(unread, output_field=IntegerField()), 0)
+    )
+
+
+THREAD_MAX_DEPTH = 50
+THREAD_PAGE_SIZE = 200
+
+THREAD_SQL = """
+WITH RECURSIVE thread(id, depth) AS (
+    SELECT id, 0 FROM {table} WHERE id = %s
+    UNION ALL
+    SELECT m.id, t.depth + 1 FROM {table} m JOIN thread t ON m.parent_id = t.id
+    WHERE t.depth < %s AND m.conversation_id = %s
+)
+SELECT m.*, t.depth AS depth
+FROM thread t
+JOIN {table} m ON m.id = t.id
+LEFT JOIN {table} c ON c.id = %s
+WHERE t.depth > 0 AND m.conversation_id = %s
+  AND (c.id IS NULL OR m.created_at > c.created_at OR (m.created_at = c.created_at AND m.id > c.id))
+ORDER BY m.created_at, m.id
+LIMIT %s
+"""
+
+
+def get_thread_page(message: Message, max_depth=THREAD_MAX_DEPTH, limit=THREAD_PAGE_SIZE, after=None):
+    """
+    Return up to ``limit`` replies below ``message`` (at most ``max_depth`` levels
+    deep) in creation order, starting after the reply with id ``after``.
+    The whole subtree is walked by one recursive CTE; each row carries ``depth``.
+    Replies from other conversations are never followed. Also returns whether
+    more replies follow.
+    """
+    sql = THREAD_SQL.format(table=Message._meta.db_table)
+    params = [message.pk, max_depth, message.conversation_id, after, message.conversation_id, limit + 1]
+    replies = list(Message.objects.raw(sql, params))
+    has_more = len(replies) > limit
+    replies = replies[:limit]
+    prefetch_related_objects(replies, "sender")
+    return replies, has_more
 
 
-def get_message_thread(message: Message):
+def build_thread_tree(replies, render=lambda message: {"message": message}):
     """
-    Return all replies to a message, recursively.
+    Nest a creation-ordered list of replies under their parents without recursion.
+    Replies whose parent is not in the list become top-level nodes.
     """
-    replies = message.replies.all().order_by("created_at")
-    thread = []
+    nodes = {}
+    tree = []
     for reply in replies:
-        thread.append({
-            "message": reply,
-            "replies": get_message_thread(reply)
-        })
-    return thread
+        node = render(reply)
+        node["replies"] = []
+        nodes[reply.pk] = node
+        parent = nodes.get(reply.parent_id)
+        (parent["replies"] if parent else tree).append(node)
+    return tree
+
+
+def get_message_thread(message: Message, max_depth=THREAD_MAX_DEPTH):
+    """
+    Return all replies to a message as a nested tree.
+    """
+    replies, after = [], None
+    while True:
+        page, has_more = get_thread_page(message, max_depth=max_depth, after=after)
+        replies.extend(page)
+        if not has_more:
+            break
+        after = page[-1].pk
+    return build_thread_tree(replies)
 
 
 def get_user_last_seen_in_conversation(conversation: Conversation, user: User):
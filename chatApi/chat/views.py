@@ -1,41 +1,52 @@
+import copy
+
+from django.db import transaction
+from django.db.models import Max
 from django.shortcuts import get_object_or_404
-from django.utils import timezone
 from rest_framework import viewsets, mixins, status
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 from django.contrib.auth import get_user_model
 
-from .models import Conversation, ConversationParticipant, Message
+from chatApi.routers import ReplicaReadsMixin
+
+from .models import ArchivedMessage, Conversation, Message
 from .serializers import (
     ConversationSerializer, MessageSerializer,
     ConversationCreateSerializer,
     MessageCreateSerializer, MessageUpdateSerializer
 )
+from .pagination import ConversationCursorPagination, MessageCursorPagination
 from .permissions import IsConversationParticipant
+from .search import SEARCH_MAX_PAGE_SIZE, SEARCH_PAGE_SIZE, search_messages
+from .services import BULK_MESSAGE_LIMIT, bulk_send_messages, publish_on_commit, send_message
+from .utils import (
+    THREAD_MAX_DEPTH, THREAD_PAGE_SIZE,
+    build_thread_tree, get_thread_page, mark_conversation_as_read
+)
 
 User = get_user_model()
 
 
-class ConversationViewSet(viewsets.GenericViewSet, mixins.ListModelMixin):
+class ConversationViewSet(ReplicaReadsMixin, viewsets.GenericViewSet, mixins.ListModelMixin):
     permission_classes = [IsAuthenticated]
     serializer_class = ConversationSerializer
+    pagination_class = ConversationCursorPagination
 
     def get_queryset(self):
         if getattr(self, "swagger_fake_view", False) or self.request.user.is_anonymous:
             return Conversation.objects.none()
 
-        return (
-            Conversation.objects
-            .filter(participants=self.request.user)
-            .prefetch_related("participants")
-            .order_by("-last_message_at", "-id")
-        )
+        return Conversation.objects.inbox_for(self.request.user)
 
     def list(self, request, *args, **kwargs):
         queryset = self.get_queryset()
-        serializer = self.get_serializer(queryset, many=True, context={"request": request})
-        return Response(serializer.data)
+        page = self.paginate_queryset(queryset)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
 
     @action(detail=False, methods=["post"])
     def direct(self, request):
@@ -51,14 +62,14 @@ class ConversationViewSet(viewsets.GenericViewSet, mixins.ListModelMixin):
 
         other_user = get_object_or_404(User, pk=other_id)
         convo, created = Conversation.get_or_create_direct(request.user, other_user)
+        convo = self.get_queryset().get(pk=convo.pk)
         data = ConversationSerializer(convo, context={"request": request}).data
         return Response(data, status=status.HTTP_201_CREATED if created else 200)
 
     @action(detail=True, methods=["post"], permission_classes=[IsAuthenticated, IsConversationParticipant])
     def mark_read(self, request, pk=None):
         convo = self.get_object()
-        now = timezone.now()
-        ConversationParticipant.objects.filter(conversation=convo, user=request.user).update(last_read_at=now)
+        now = mark_conversation_as_read(convo, request.user)
         return Response({"status": "ok", "last_read_at": now})
 
     @action(detail=True, methods=["get"], permission_classes=[IsAuthenticated, IsConversationParticipant])
@@ -68,8 +79,9 @@ class ConversationViewSet(viewsets.GenericViewSet, mixins.ListModelMixin):
         return Response({"unread_count": count})
 
 
-class MessageViewSet(viewsets.ModelViewSet):
+class MessageViewSet(ReplicaReadsMixin, viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
+    pagination_class = MessageCursorPagination
 
     def get_serializer_class(self):
         if self.action in ["create"]:
@@ -79,7 +91,28 @@ class MessageViewSet(viewsets.ModelViewSet):
         return MessageSerializer
 
     def get_queryset(self):
-        return Message.objects.filter(conversation__participants=self.request.user)
+        return self.filter_by_conversation(
+            Message.objects.filter(conversation__participants=self.request.user)
+        ).select_related("sender")
+
+    def filter_by_conversation(self, queryset, field="conversation_id"):
+        conversation_id = self.request.query_params.get("conversation")
+        if conversation_id:
+            if not conversation_id.isdigit():
+                raise ValidationError({"conversation": "A valid integer is required."})
+            queryset = queryset.filter(**{field: conversation_id})
+        return queryset
+
+    def get_archive_queryset(self):
+        return self.filter_by_conversation(
+            ArchivedMessage.objects.filter(conversation__participants=self.request.user)
+        ).select_related("sender")
+
+    def get_archive_horizon(self):
+        conversations = self.filter_by_conversation(
+            Conversation.objects.filter(participants=self.request.user), field="pk"
+        )
+        return conversations.aggregate(horizon=Max("archived_until"))["horizon"]
 
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
@@ -98,11 +131,110 @@ class MessageViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        msg = Message.objects.create(
-            conversation=convo,
+        msg = send_message(
             sender=request.user,
+            conversation=convo,
             content=serializer.validated_data.get("content", ""),
             parent=serializer.validated_data.get("parent")
         )
 
         return Response(MessageSerializer(msg).data, status=status.HTTP_201_CREATED)
+
+    def perform_update(self, serializer):
+        msg = serializer.save()
+        publish_on_commit([msg], action="updated")
+
+    def perform_destroy(self, instance):
+        snapshot = copy.copy(instance)
+        with transaction.atomic():
+            instance.delete()
+            Message.discount_unread([snapshot])
+        publish_on_commit([snapshot], action="deleted")
+
+    @action(detail=False, methods=["post"])
+    def bulk(self, request):
+        items = request.data
+        if not isinstance(items, list):
+            return Response(
+                {"detail": "Expected a list of messages"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if len(items) > BULK_MESSAGE_LIMIT:
+            return Response(
+                {"detail": f"At most {BULK_MESSAGE_LIMIT} messages per request"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        valid, indexes, errors = [], [], []
+        for index, item in enumerate(items):
+            serializer = MessageCreateSerializer(data=item, context=self.get_serializer_context())
+            if serializer.is_valid():
+                valid.append(serializer.validated_data)
+                indexes.append(index)
+            else:
+                errors.append({"index": index, "errors": serializer.errors})
+
+        messages = bulk_send_messages(request.user, valid)
+        created = [
+            {"index": index, "message": data}
+            for index, data in zip(indexes, MessageSerializer(messages, many=True).data)
+        ]
+        return Response(
+            {"created": created, "errors": errors},
+            status=status.HTTP_201_CREATED if created or not errors else status.HTTP_400_BAD_REQUEST,
+        )
+
+    @action(detail=False, methods=["get"])
+    def search(self, request):
+        params = request.query_params
+        query = params.get("q", "").strip()
+        if not query:
+            raise ValidationError({"q": "A search query is required."})
+        try:
+            limit = min(int(params.get("limit", SEARCH_PAGE_SIZE)), SEARCH_MAX_PAGE_SIZE)
+            offset = int(params.get("offset", 0))
+            conversation_id = int(params["conversation"]) if params.get("conversation") else None
+        except ValueError:
+            raise ValidationError({"detail": "limit, offset and conversation must be integers."})
+        if limit < 1 or offset < 0:
+            raise ValidationError({"detail": "limit must be positive and offset non-negative."})
+
+        messages = search_messages(request.user, query, conversation_id, limit=limit + 1, offset=offset)
+        url = request.build_absolute_uri()
+        next_url = previous_url = None
+        if len(messages) > limit:
+            next_url = replace_query_param(url, "offset", offset + limit)
+        if offset:
+            previous_url = replace_query_param(url, "offset", max(offset - limit, 0))
+        return Response({
+            "next": next_url,
+            "previous": previous_url,
+            "results": MessageSerializer(messages[:limit], many=True).data,
+        })
+
+    @action(detail=True, methods=["get"])
+    def thread(self, request, pk=None):
+        root = self.get_object()
+        params = request.query_params
+        try:
+            max_depth = min(int(params.get("depth", THREAD_MAX_DEPTH)), THREAD_MAX_DEPTH)
+            limit = min(int(params.get("limit", THREAD_PAGE_SIZE)), THREAD_PAGE_SIZE)
+            after = int(params["after"]) if params.get("after") else None
+        except ValueError:
+            raise ValidationError({"detail": "depth, limit and after must be integers."})
+        if max_depth < 1 or limit < 1:
+            raise ValidationError({"detail": "depth and limit must be positive."})
+
+        replies, has_more = get_thread_page(root, max_depth=max_depth, limit=limit, after=after)
+
+        def render(message):
+            return {**MessageSerializer(message).data, "depth": message.depth}
+
+        next_url = None
+        if has_more:
+            next_url = replace_query_param(request.build_absolute_uri(), "after", replies[-1].pk)
+        return Response({
+            "root": MessageSerializer(root).data,
+            "replies": build_thread_tree(replies, render=render),
+            "next": next_url,
+        })
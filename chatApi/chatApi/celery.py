@@ -5,4 +5,15 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatApi.settings')
 app = Celery('chatApi')
 
 app.config_from_object('django.conf:settings', namespace='CELERY')
-app.autodiscover_tasks()
\ No newline at end of file
+app.autodiscover_tasks()
+
+app.conf.beat_schedule = {
+    'flush-last-seen': {
+        'task': 'accounts.tasks.flush_last_seen',
+        'schedule': 60.0,
+    },
+    'archive-messages': {
+        'task': 'chat.tasks.archive_messages',
+        'schedule': 60.0 * 60,
+    },
+}
@@ -0,0 +1,60 @@
+import threading
+from collections import Counter
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+_lock = threading.Lock()
+_opened = Counter()
+
+
+def count_connection(sender, connection, **kwargs):
+    with _lock:
+        _opened[connection.alias] += 1
+
+
+connection_created.connect(count_connection)
+
+
+def connections_opened(alias="default"):
+    """Physical connections this process has opened to ``alias``."""
+    with _lock:
+        return _opened[alias]
+
+
+def pool_stats(alias="default"):
+    """
+    Connection stats for ``alias``. With PostgreSQL's built-in pool
+    (OPTIONS["pool"]) these come from psycopg_pool; otherwise they describe
+    Django's own per-thread connections.
+    """
+    conn = connections[alias]
+    stats = {
+        "alias": alias,
+        "vendor": conn.vendor,
+        "connections_opened": connections_opened(alias),
+    }
+    pool = getattr(conn, "pool", None)
+    if pool is None:
+        stats.update({
+            "pooled": False,
+            "conn_max_age": conn.settings_dict["CONN_MAX_AGE"],
+            "health_checks": conn.settings_dict["CONN_HEALTH_CHECKS"],
+        })
+        return stats
+
+    raw = pool.get_stats()
+    stats.update({
+        "pooled": True,
+        "size": raw.get("pool_size", 0),
+        "available": raw.get("pool_available", 0),
+        "in_use": raw.get("pool_size", 0) - raw.get("pool_available", 0),
+        "min_size": raw.get("pool_min"),
+        "max_size": raw.get("pool_max"),
+        "waiting": raw.get("requests_waiting", 0),
+        "waits": raw.get("requests_queued", 0),
+        "wait_ms": raw.get("requests_wait_ms", 0),
+        "timeouts": raw.get("requests_errors", 0),
+        "connections_lost": raw.get("connections_lost", 0),
+    })
+    return stats
@@ -0,0 +1,82 @@
+import random
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from rest_framework.permissions import SAFE_METHODS
+
+# True while serving a read-only API request that may use a replica. Anything
+# else (writes, websocket consumers, Celery tasks, commands) reads the primary.
+replica_reads = ContextVar("replica_reads", default=False)
+
+
+def pin_cache_key(user_id):
+    return f"db:pinned:{user_id}"
+
+
+def pin_to_primary(user_id):
+    """Send ``user_id``'s reads to the primary for REPLICA_PIN_SECONDS."""
+    cache.set(pin_cache_key(user_id), True, getattr(settings, "REPLICA_PIN_SECONDS", 5))
+
+
+def is_pinned(user_id):
+    return bool(cache.get(pin_cache_key(user_id)))
+
+
+def choose_replica():
+    replicas = getattr(settings, "DATABASE_REPLICAS", [])
+    return random.choice(replicas) if replicas else None
+
+
+class PrimaryReplicaRouter:
+    """
+    Route reads made under ``replica_reads`` to one of DATABASE_REPLICAS and
+    everything else, writes included, to the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        if not replica_reads.get():
+            return DEFAULT_DB_ALIAS
+        return choose_replica() or DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        aliases = {DEFAULT_DB_ALIAS, *getattr(settings, "DATABASE_REPLICAS", [])}
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+
+class ReplicaReadsMixin:
+    """
+    For API views: serve GET/HEAD/OPTIONS from a replica unless the caller
+    wrote recently, and pin callers to the primary after a successful write
+    so they read their own writes.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        token = replica_reads.set(False)
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            replica_reads.reset(token)
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if request.method in SAFE_METHODS and not (
+            request.user.is_authenticated and is_pinned(request.user.pk)
+        ):
+            replica_reads.set(True)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if (
+            request.method not in SAFE_METHODS
+            and response.status_code < 400
+            and request.user.is_authenticated
+        ):
+            pin_to_primary(request.user.pk)
+        return response
@@ -10,9 +10,13 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
+import sys
 from pathlib import Path
 from datetime import timedelta
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -86,12 +90,50 @@ WSGI_APPLICATION = 'chatApi.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# How this process holds database connections, chosen per process with the
+# CHAT_DB_CONNECTIONS environment variable:
+#   "close" (default): one connection per request, closed afterwards. Use it
+#       for processes serving ASGI HTTP - Django's ASGI handler runs every
+#       request in a fresh thread, so a persistent connection is never reused
+#       there and is only closed once it has aged out (Django ticket #33497).
+#   "persistent": keep connections for CONN_MAX_AGE seconds, health-checked
+#       before reuse. For websocket-only (Channels) and Celery worker
+#       processes: database_sync_to_async runs on one thread-sensitive
+#       executor thread and Celery closes obsolete connections per task, so
+#       one connection serves every call.
+#   "pool": Django's built-in PostgreSQL pool (psycopg 3 with psycopg[pool]);
+#       every close hands the connection back to the pool.
+# /api/internal/db-pool/ and `manage.py db_loadtest` report what is in use.
+DB_CONNECTIONS = os.environ.get("CHAT_DB_CONNECTIONS", "close")
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'CONN_MAX_AGE': 0,
     }
 }
+if DB_CONNECTIONS == "persistent":
+    DATABASES['default'].update({'CONN_MAX_AGE': 60, 'CONN_HEALTH_CHECKS': True})
+elif DB_CONNECTIONS == "pool":
+    if DATABASES['default']['ENGINE'] != 'django.db.backends.postgresql':
+        raise ImproperlyConfigured('CHAT_DB_CONNECTIONS="pool" needs the PostgreSQL backend')
+    DATABASES['default']['OPTIONS'] = {'pool': {'min_size': 2, 'max_size': 20, 'timeout': 10}}
+elif DB_CONNECTIONS != "close":
+    raise ImproperlyConfigured(f'Unknown CHAT_DB_CONNECTIONS mode "{DB_CONNECTIONS}"')
+
+# Read-only API requests are served from one of DATABASE_REPLICAS; users who
+# wrote in the last REPLICA_PIN_SECONDS keep reading from the primary.
+# 'replica' is a second connection to the primary's database, so the routing
+# can be exercised locally and in tests (where it mirrors the test database);
+# it only serves reads once listed in DATABASE_REPLICAS. In production point
+# it at a real replica.
+DATABASES['replica'] = {
+    **DATABASES['default'],
+    'TEST': {'MIRROR': 'default'},
+}
+DATABASE_ROUTERS = ['chatApi.routers.PrimaryReplicaRouter']
+DATABASE_REPLICAS = []
+REPLICA_PIN_SECONDS = 5
 
 
 # Password validation
@@ -163,6 +205,95 @@ CHANNEL_LAYERS = {
     }
 }
 
+# Websocket messages are inserted in batches every CHAT_WRITE_BUFFER_INTERVAL
+# seconds. With CHAT_OPTIMISTIC_BROADCAST the consumer fans a message out
+# before its batch has been written, as a provisional frame without id or seq;
+# a chat_message_confirmed frame with the same client_id carries the stored
+# id, seq and timestamp once the write is done.
+CHAT_WRITE_BUFFER_INTERVAL = 0.005
+CHAT_WRITE_BUFFER_MAX_BATCH = 200
+CHAT_OPTIMISTIC_BROADCAST = False
+
+# A socket reconnecting with ?since=<seq> gets at most this many missed
+# messages replayed; beyond that it is told to resync over REST.
+CHAT_RESYNC_LIMIT = 500
+
+# Websocket read receipts are coalesced per user and room, then persisted
+# once per READ_RECEIPT_DEBOUNCE seconds.
+READ_RECEIPT_DEBOUNCE = 2.0
+
+# Seconds a websocket room-membership check stays cached.
+ROOM_MEMBERSHIP_CACHE_TTL = 300
+
+# Room membership changes touching more users than this run in the
+# chat_room.tasks.change_room_membership Celery task, ROOM_MEMBERSHIP_BATCH_SIZE
+# users per transaction, with progress kept in the cache for
+# ROOM_MEMBERSHIP_TASK_TTL seconds.
+ROOM_MEMBERSHIP_ASYNC_THRESHOLD = 500
+ROOM_MEMBERSHIP_BATCH_SIZE = 500
+ROOM_MEMBERSHIP_TASK_TTL = 3600
+
+# Room events are published to ROOM_FANOUT_SHARDS channel-layer sub-groups per
+# room in parallel; each socket joins one, picked by a hash of its channel
+# name. Events for a room arriving within ROOM_FANOUT_TICK seconds are sent as
+# one batch (0 sends each event immediately).
+ROOM_FANOUT_SHARDS = 1
+ROOM_FANOUT_TICK = 0.0
+
+# Frame encodings websocket clients may pick with the "chat.<name>"
+# subprotocol; JSON is always available. "cbor" needs the cbor2 package.
+# permessage-deflate is negotiated by the ASGI server, not the application
+# (uvicorn enables it by default; daphne does not offer it).
+CHAT_WS_ENCODINGS = ["json", "msgpack", "cbor"]
+
+# Each room socket has its own outbound queue. A client more than
+# CHAT_OUTBOUND_HIGH_WATER frames behind is a slow consumer: with "resync" its
+# backlog is dropped for one "resync_required" notice counting the missed
+# messages, with "close" it is disconnected with close code 4429.
+CHAT_OUTBOUND_HIGH_WATER = 200
+CHAT_OUTBOUND_OVERFLOW = "resync"
+
+# The default cache holds state every web, websocket and Celery process has
+# to agree on: last-seen heartbeats, presence refcounts, replica pins, room
+# ACLs, membership task progress and the recent-messages cache. It must be
+# shared; only the test suite runs on a process-local cache. With a
+# process-local LAST_SEEN_CACHE heartbeats are written straight to
+# User.last_seen instead of being flushed by accounts.tasks.flush_last_seen.
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": "redis://127.0.0.1:6379/1",
+    }
+}
+if sys.argv[1:2] == ["test"]:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+LAST_SEEN_CACHE = "default"
+LAST_SEEN_RESOLUTION = 60
+
+# Websocket connection refcounts live in PRESENCE_CACHE; a user is announced
+# offline only after PRESENCE_OFFLINE_GRACE seconds without any socket.
+PRESENCE_CACHE = "default"
+PRESENCE_OFFLINE_GRACE = 5
+
+# The newest RECENT_MESSAGES_LIMIT messages of each room are kept pre-rendered
+# in RECENT_MESSAGES_CACHE and serve the first page of room history.
+RECENT_MESSAGES_CACHE = "default"
+RECENT_MESSAGES_LIMIT = 50
+RECENT_MESSAGES_TTL = 600
+
+# Messages older than this many days (per conversation type, None = forever)
+# are moved to chat.ArchivedMessage by the chat.tasks.archive_messages beat
+# task. Conversation.retention_days overrides the default per conversation.
+MESSAGE_RETENTION_DAYS = {
+    "direct": None,
+    "room": None,
+}
+MESSAGE_ARCHIVE_BATCH_SIZE = 500
+
 CELERY_BROKER_URL = 'redis://localhost:6379/0'
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
@@ -2,6 +2,7 @@ from django.contrib import admin
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 from django.urls import path, include, re_path
 from accounts.views import MeView
+from .views import DatabasePoolStatsView
 from rest_framework import permissions
 from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
@@ -25,6 +26,7 @@ urlpatterns = [
     path('login/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('api/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
     path('api/me/', MeView.as_view(), name='me'),
+    path('api/internal/db-pool/', DatabasePoolStatsView.as_view(), name='db-pool-stats'),
     path('api/', include('chat.urls')),
     path("api/", include("chat_room.urls")),  # include chat app URLs
     re_path(r'^swagger(?P<format>\.json|\.yaml)$', schema_view.without_ui(cache_timeout=0), name='schema-json'),
@@ -0,0 +1,13 @@
+from django.conf import settings
+from rest_framework import permissions
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from .db import pool_stats
+
+
+class DatabasePoolStatsView(APIView):
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        return Response({"results": [pool_stats(alias) for alias in settings.DATABASES]})
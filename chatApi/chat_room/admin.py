@@ -1,7 +1,6 @@
 from django.contrib import admin
-from .models import Room, RoomParticipant, Message
+from .models import Room, RoomParticipant
 # Register your models here.
 
 admin.site.register(Room)
 admin.site.register(RoomParticipant)
-admin.site.register(Message)
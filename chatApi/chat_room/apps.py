@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class ChatRoomConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat_room'
+
+    def ready(self):
+        from . import signals  # noqa: F401
+        # Start counting database connections before the first consumer runs.
+        import chatApi.db  # noqa: F401
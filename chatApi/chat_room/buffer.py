@@ -0,0 +1,138 @@
+import asyncio
+import logging
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBuffer:
+    """
+    Per-process buffer that coalesces inserts from many consumers into one
+    ``insert_batch`` call every ``interval`` seconds (or every ``max_batch`` rows).
+
+    ``write`` queues an unsaved instance and returns a future that resolves to
+    the saved instance once its batch has been flushed.
+    """
+
+    def __init__(self, insert_batch, interval=0.005, max_batch=200):
+        self.insert_batch = insert_batch
+        self.interval = interval
+        self.max_batch = max_batch
+        self.pending = []
+        self._flusher = None
+
+    def write(self, instance):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((instance, future))
+        if len(self.pending) >= self.max_batch:
+            loop.create_task(self.flush())
+        elif self._flusher is None or self._flusher.done() or self._flusher.get_loop() is not loop:
+            self._flusher = loop.create_task(self._flush_later())
+        return future
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.interval)
+        await self.flush()
+
+    async def flush(self):
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        results = await database_sync_to_async(self._insert)([instance for instance, _ in batch])
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def _insert(self, instances):
+        try:
+            return self.insert_batch(instances)
+        except Exception:
+            logger.exception("Batched insert of %d rows failed, retrying one by one", len(instances))
+
+        results = []
+        for instance in instances:
+            try:
+                results.extend(self.insert_batch([instance]))
+            except Exception as exc:
+                results.append(exc)
+        return results
+
+
+class CoalescingBuffer:
+    """
+    Keeps only the latest value per key and hands the collected batch to
+    ``flush_batch`` (a sync callable run off the event loop) every
+    ``interval`` seconds.
+    """
+
+    def __init__(self, flush_batch, interval=2.0):
+        self.flush_batch = flush_batch
+        self.interval = interval
+        self.pending = {}
+        self._flusher = None
+
+    def put(self, key, value):
+        self.pending[key] = value
+        loop = asyncio.get_running_loop()
+        if self._flusher is None or self._flusher.done() or self._flusher.get_loop() is not loop:
+            self._flusher = loop.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.interval)
+        await self.flush()
+
+    async def flush(self):
+        batch, self.pending = self.pending, {}
+        if not batch:
+            return
+        try:
+            await database_sync_to_async(self.flush_batch)(batch)
+        except Exception:
+            logger.exception("Flushing %d coalesced updates failed", len(batch))
+
+
+def log_write_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("Buffered message write failed", exc_info=future.exception())
+
+
+_message_buffer = None
+
+
+def get_message_buffer():
+    global _message_buffer
+    if _message_buffer is None:
+        from chat.services import persist_messages
+        _message_buffer = WriteBuffer(
+            lambda messages: persist_messages(messages, publish=False),
+            interval=getattr(settings, "CHAT_WRITE_BUFFER_INTERVAL", 0.005),
+            max_batch=getattr(settings, "CHAT_WRITE_BUFFER_MAX_BATCH", 200),
+        )
+    return _message_buffer
+
+
+def persist_read_receipts(batch):
+    from chat.utils import mark_read_until
+
+    for (conversation_id, user_id), read_at in batch.items():
+        mark_read_until(conversation_id, user_id, read_at)
+
+
+_read_receipt_buffer = None
+
+
+def get_read_receipt_buffer():
+    global _read_receipt_buffer
+    if _read_receipt_buffer is None:
+        _read_receipt_buffer = CoalescingBuffer(
+            persist_read_receipts,
+            interval=getattr(settings, "READ_RECEIPT_DEBOUNCE", 2.0),
+        )
+    return _read_receipt_buffer
@@ -1,43 +1,387 @@
-import json
+import asyncio
+import time
+import uuid
+from urllib.parse import parse_qs
+from channels.consumer import get_handler_name
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from .models import Room, Message
+from django.utils import timezone
+from chatApi.routers import pin_to_primary
+from .buffer import get_message_buffer, get_read_receipt_buffer, log_write_failure
+from .membership import MEMBERSHIP_REVOKED_CLOSE_CODE, is_room_member, user_group_name
+from chat import encoding
+from chat.fanout import PASSTHROUGH_TYPES, get_room_fanout, member_group
+from chat.models import Conversation, Message
+from chat.services import inbox_group_name, message_event
+from .models import Room
+from .outbound import SLOW_CONSUMER_CLOSE_CODE, OutboundQueue, stop_queue
+from . import presence
 
 User = get_user_model()
 
-class ChatConsumer(AsyncWebsocketConsumer):
+class FrameEncodingMixin:
+    """
+    Frames go out in the encoding the client negotiated through the websocket
+    subprotocol ("chat.msgpack", "chat.cbor"; JSON otherwise). Events that
+    carry pre-encoded frames are forwarded without re-encoding.
+    """
+    codec = encoding.JSON
+
+    async def accept_negotiated(self):
+        self.codec, subprotocol = encoding.negotiate(self.scope.get("subprotocols", []))
+        await self.accept(subprotocol)
+
+    def decode_frame(self, text_data=None, bytes_data=None):
+        if bytes_data is not None and self.codec.binary:
+            return self.codec.loads(bytes_data)
+        return encoding.JSON.loads(text_data if text_data is not None else bytes_data)
+
+    async def write_encoded(self, payload):
+        if self.codec.binary:
+            await self.send(bytes_data=payload)
+        else:
+            await self.send(text_data=payload)
+
+    async def send_encoded(self, payload, seqs=()):
+        await self.write_encoded(payload)
+
+    async def send_frame(self, frame, seqs=()):
+        await self.send_encoded(encoding.encode(frame, self.codec.name), seqs)
+
+    def pre_encoded(self, event):
+        return (event.get("encoded") or {}).get(self.codec.name)
+
+
+class ChatConsumer(FrameEncodingMixin, AsyncWebsocketConsumer):
+    # Collects outgoing frames while a chat.batch event is being handled.
+    batch_frames = None
+    # Bounded queue between the channel layer and a possibly slow client;
+    # set up once the connection is accepted and any replay is done.
+    outbound = None
+    writer = None
+    closed_slow = False
+
     async def connect(self):
         self.room_id = self.scope["url_route"]["kwargs"]["room_id"]
-        self.room_group_name = f"chat_{self.room_id}"
+        self.user = self.scope["user"]
+        self.groups_joined = []
 
-        await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-        await self.accept()
+        self.room, self.is_member = await self.load_room()
+        if self.room is None:
+            await self.close(code=4404)
+            return
+        if not self.is_member:
+            await self.close(code=MEMBERSHIP_REVOKED_CLOSE_CODE)
+            return
+
+        # Large rooms are split into ROOM_FANOUT_SHARDS sub-groups; each socket
+        # joins one of them and room events are published to all.
+        self.groups_joined = [
+            member_group(self.room.id, self.channel_name),
+            user_group_name(self.room_id, self.user.pk),
+        ]
+        for group in self.groups_joined:
+            await self.channel_layer.group_add(group, self.channel_name)
+        await self.accept_negotiated()
+
+        # Live events queue up behind connect, so replaying here after joining
+        # the group leaves no gap; replayed seqs are skipped when they arrive live.
+        self.replayed_up_to = None
+        self.pinned_until = 0
+        since = self.get_since()
+        if since is not None:
+            await self.replay_since(since)
+        self.outbound = OutboundQueue(
+            self.write_encoded,
+            self.notify_missed,
+            labels={"channel": self.channel_name, "user_id": self.user.pk, "room_id": self.room.id},
+        )
+        self.writer = asyncio.get_running_loop().create_task(self.outbound.run())
+
+        if await database_sync_to_async(presence.connection_opened)(self.user.pk):
+            await self.broadcast_presence(online=True)
 
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        if self.writer is not None:
+            await stop_queue(self.outbound, self.writer)
+        for group in self.groups_joined:
+            await self.channel_layer.group_discard(group, self.channel_name)
+        if not self.groups_joined:
+            return
+
+        remaining = await database_sync_to_async(presence.connection_closed)(self.user.pk)
+        if remaining == 0:
+            # Debounce: a client that reconnects within the grace period never goes offline.
+            grace = getattr(settings, "PRESENCE_OFFLINE_GRACE", 5)
+            asyncio.get_running_loop().create_task(self.announce_offline_after(grace))
 
-    async def receive(self, text_data):
-        data = json.loads(text_data)
-        message_content = data.get("message")
-        user = self.scope["user"]
+    def get_since(self):
+        values = parse_qs(self.scope.get("query_string", b"").decode()).get("since")
+        if values and values[0].isdigit():
+            return int(values[0])
+        return None
 
-        msg = await self.save_message(user, message_content)
+    async def replay_since(self, since):
+        limit = getattr(settings, "CHAT_RESYNC_LIMIT", 500)
+        missed, last_seq = await self.load_missed_messages(since, limit)
+        if len(missed) > limit:
+            await self.send_frame({"type": "resync_required", "last_seq": last_seq})
+            return
+        for msg in missed:
+            await self.send_frame(message_event(msg))
+        self.replayed_up_to = last_seq
+        await self.send_frame({"type": "resync_complete", "last_seq": last_seq})
+
+    @database_sync_to_async
+    def load_missed_messages(self, since, limit):
+        last_seq = Conversation.objects.filter(pk=self.room.conversation_id).values_list("last_seq", flat=True).get()
+        missed = list(
+            Message.objects
+            .filter(conversation_id=self.room.conversation_id, seq__gt=since)
+            .select_related("sender")
+            .order_by("seq")[:limit + 1]
+        )
+        if missed:
+            last_seq = max(last_seq, missed[-1].seq)
+        return missed, last_seq
+
+    async def announce_offline_after(self, delay):
+        await asyncio.sleep(delay)
+        if await database_sync_to_async(presence.claim_offline_transition)(self.user.pk):
+            await self.broadcast_presence(online=False)
+
+    async def broadcast_presence(self, online):
+        groups = await database_sync_to_async(presence.presence_groups)(self.user.pk)
+        event = {"type": "presence.update", "user_id": self.user.pk, "online": online}
+        await asyncio.gather(*(self.channel_layer.group_send(group, event) for group in groups))
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            data = self.decode_frame(text_data, bytes_data)
+        except ValueError:
+            await self.send_frame({"type": "error", "detail": "Malformed frame."})
+            return
+        if not isinstance(data, dict):
+            await self.send_frame({"type": "error", "detail": "Frames must be objects."})
+            return
+        frame_type = data.get("type", "message")
+        handler = self.frame_handlers.get(frame_type)
+        if handler is None:
+            await self.send_frame({"type": "error", "detail": f"Unknown frame type: {frame_type}"})
+            return
+        await handler(self, data)
+
+    async def receive_message(self, data):
+        msg, written = self.save_message(self.user, data.get("message"))
+        if getattr(settings, "CHAT_OPTIMISTIC_BROADCAST", False):
+            await self.broadcast_provisional(msg, written)
+        else:
+            try:
+                msg = await written
+            except Exception:
+                log_write_failure(written)
+                await self.send_frame({"type": "error", "detail": "Message could not be saved."})
+                return
+            await self.publish_to_room(message_event(msg))
+        await self.pin_sender()
+
+    async def broadcast_provisional(self, msg, written):
+        """
+        Fan ``msg`` out before its batch is written. The frame is marked
+        provisional and has no id or seq yet; a chat_message_confirmed frame
+        with the same client_id follows once the row exists (or
+        chat_message_failed if the write failed).
+        """
+        client_id = uuid.uuid4().hex
+        await self.publish_to_room({**message_event(msg), "provisional": True, "client_id": client_id})
+        asyncio.get_running_loop().create_task(self.confirm_write(written, client_id))
+
+    async def confirm_write(self, written, client_id):
+        try:
+            msg = await written
+        except Exception:
+            log_write_failure(written)
+            await self.publish_to_room({"type": "chat_message_failed", "client_id": client_id})
+            return
+        await self.publish_to_room({**message_event(msg), "type": "chat_message_confirmed", "client_id": client_id})
+
+    async def pin_sender(self):
+        """Keep the sender's REST reads on the primary while they are writing."""
+        now = time.monotonic()
+        if now < self.pinned_until:
+            return
+        await database_sync_to_async(pin_to_primary)(self.user.pk)
+        self.pinned_until = now + getattr(settings, "REPLICA_PIN_SECONDS", 5) / 2
+
+    async def publish_to_room(self, event):
+        await get_room_fanout().publish(self.channel_layer, self.room.id, event)
+
+    async def receive_typing(self, data):
+        await self.publish_to_room(
+            {
+                "type": "chat_typing",
+                "user_id": self.user.pk,
+                "username": self.user.username,
+                "is_typing": bool(data.get("is_typing", True)),
+                "origin": self.channel_name,
+            },
+        )
 
-        await self.channel_layer.group_send(
-            self.room_group_name,
+    async def receive_read(self, data):
+        read_at = timezone.now()
+        get_read_receipt_buffer().put((self.room.conversation_id, self.user.pk), read_at)
+        await self.publish_to_room(
             {
-                "type": "chat_message",
-                "message": msg.content,
-                "sender": user.username,
-                "timestamp": msg.created_at.isoformat(),
+                "type": "chat_read",
+                "user_id": self.user.pk,
+                "message_id": data.get("message_id"),
+                "read_at": read_at.isoformat(),
+                "origin": self.channel_name,
             },
         )
 
+    frame_handlers = {
+        "message": receive_message,
+        "typing": receive_typing,
+        "read": receive_read,
+    }
+
+    async def send_encoded(self, payload, seqs=()):
+        if self.closed_slow:
+            return
+        if self.outbound is None:
+            await self.write_encoded(payload)
+        elif not self.outbound.put(payload, seqs):
+            self.closed_slow = True
+            await self.close(code=SLOW_CONSUMER_CLOSE_CODE)
+
+    async def notify_missed(self, missed, last_seq):
+        """Sent once a client that fell too far behind has caught up again."""
+        frame = {"type": "resync_required", "missed": missed, "last_seq": last_seq}
+        await self.write_encoded(encoding.encode(frame, self.codec.name))
+
+    async def send_frame(self, frame, seqs=()):
+        if self.batch_frames is not None:
+            self.batch_frames.append(frame)
+        else:
+            await super().send_frame(frame, seqs)
+
+    async def send_event(self, event):
+        """Send a room event that clients receive unchanged."""
+        payload = self.pre_encoded(event)
+        seqs = [event.get("seq")]
+        if payload is not None and self.batch_frames is None:
+            await self.send_encoded(payload, seqs)
+        else:
+            await self.send_frame({key: value for key, value in event.items() if key != "encoded"}, seqs)
+
+    def already_replayed(self, event):
+        seq = event.get("seq")
+        return seq is not None and self.replayed_up_to is not None and seq <= self.replayed_up_to
+
+    async def chat_batch(self, event):
+        """A burst of room events coalesced by the publisher: sent as one frame."""
+        payload = self.pre_encoded(event)
+        seqs = [inner.get("seq") for inner in event["events"] if inner["type"] in PASSTHROUGH_TYPES]
+        if payload is not None and not any(self.already_replayed(inner) for inner in event["events"]):
+            await self.send_encoded(payload, seqs)
+            return
+
+        self.batch_frames = []
+        try:
+            for inner in event["events"]:
+                await getattr(self, get_handler_name(inner))(inner)
+        finally:
+            frames, self.batch_frames = self.batch_frames, None
+        if len(frames) == 1:
+            await self.send_frame(frames[0], seqs)
+        elif frames:
+            await self.send_frame({"type": "batch", "events": frames}, seqs)
+
     async def chat_message(self, event):
-        await self.send(text_data=json.dumps(event))
+        if self.already_replayed(event):
+            return
+        await self.send_event(event)
+
+    async def chat_message_updated(self, event):
+        await self.send_event(event)
+
+    async def chat_message_deleted(self, event):
+        await self.send_event(event)
+
+    async def chat_message_confirmed(self, event):
+        if self.already_replayed(event):
+            return
+        await self.send_event(event)
+
+    async def chat_message_failed(self, event):
+        await self.send_event(event)
+
+    async def chat_typing(self, event):
+        if event["origin"] == self.channel_name:
+            return
+        await self.send_frame({
+            "type": "typing",
+            "user_id": event["user_id"],
+            "username": event["username"],
+            "is_typing": event["is_typing"],
+        })
+
+    async def chat_read(self, event):
+        if event["origin"] == self.channel_name:
+            return
+        await self.send_frame({
+            "type": "read",
+            "user_id": event["user_id"],
+            "message_id": event["message_id"],
+            "read_at": event["read_at"],
+        })
+
+    async def presence_update(self, event):
+        await self.send_frame({"type": "presence", "user_id": event["user_id"], "online": event["online"]})
+
+    async def membership_revoked(self, event):
+        await self.close(code=MEMBERSHIP_REVOKED_CLOSE_CODE)
 
     @database_sync_to_async
+    def load_room(self):
+        room = Room.objects.filter(id=self.room_id).first()
+        if room is None or not self.user.is_authenticated:
+            return room, False
+        return room, is_room_member(room.id, self.user.pk)
+
     def save_message(self, user, content):
-        room = Room.objects.get(id=self.room_id)
-        return Message.objects.create(sender=user, room=room, content=content)
+        """
+        Queue a message for the next batched insert. Returns the unsaved
+        instance, stamped with a provisional created_at, and the future
+        resolving to the saved one.
+        """
+        msg = Message(
+            conversation_id=self.room.conversation_id, sender=user, content=content or "", created_at=timezone.now()
+        )
+        return msg, get_message_buffer().write(msg)
+
+
+class InboxConsumer(FrameEncodingMixin, AsyncWebsocketConsumer):
+    """
+    Per-user feed of message changes in the user's direct conversations; room
+    messages reach members through the room sockets.
+    """
+
+    async def connect(self):
+        self.user = self.scope["user"]
+        if not self.user.is_authenticated:
+            await self.close(code=MEMBERSHIP_REVOKED_CLOSE_CODE)
+            return
+        self.group_name = inbox_group_name(self.user.pk)
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept_negotiated()
+
+    async def disconnect(self, close_code):
+        if hasattr(self, "group_name"):
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    async def inbox_message(self, event):
+        await self.send_encoded(self.pre_encoded(event) or encoding.encode(event["frame"], self.codec.name))
@@ -0,0 +1,52 @@
+import asyncio
+import json
+import time
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from chatApi.db import connections_opened, pool_stats
+
+
+class Command(BaseCommand):
+    help = (
+        "Run many concurrent database_sync_to_async calls, the way ChatConsumer does, "
+        "and report how many database connections they needed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--calls", type=int, default=1000, help="Total consumer-style calls.")
+        parser.add_argument("--concurrency", type=int, default=50, help="Calls in flight at once.")
+        parser.add_argument("--database", default=DEFAULT_DB_ALIAS, help="Database alias to query.")
+
+    def handle(self, *args, **options):
+        calls, concurrency, alias = options["calls"], options["concurrency"], options["database"]
+        opened_before = connections_opened(alias)
+        started = time.perf_counter()
+        async_to_sync(self.run)(calls, concurrency, alias)
+        elapsed = time.perf_counter() - started
+
+        report = {
+            "calls": calls,
+            "concurrency": concurrency,
+            "seconds": round(elapsed, 3),
+            "connections_opened": connections_opened(alias) - opened_before,
+            "pool": pool_stats(alias),
+        }
+        self.stdout.write(json.dumps(report, indent=2, default=str))
+
+    async def run(self, calls, concurrency, alias):
+        def query():
+            with connections[alias].cursor() as cursor:
+                cursor.execute("SELECT 1")
+
+        query = database_sync_to_async(query)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def invoke():
+            async with semaphore:
+                await query()
+
+        await asyncio.gather(*(invoke() for _ in range(calls)))
@@ -0,0 +1,56 @@
+import json
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+
+from chat.fanout import latency, member_group, send_to_room
+
+
+class Command(BaseCommand):
+    help = (
+        "Join many sockets to one synthetic room on the configured channel layer, "
+        "publish messages to it with each sub-group count and report the fan-out "
+        "latency histograms."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sockets", type=int, default=10000, help="Channels joined to the room.")
+        parser.add_argument("--messages", type=int, default=20, help="Messages published per run.")
+        parser.add_argument(
+            "--shards", type=int, nargs="+", default=[1, 16], help="Sub-group counts to compare."
+        )
+
+    def handle(self, *args, **options):
+        report = []
+        for shards in options["shards"]:
+            room_id = f"loadtest-{shards}"
+            latency.reset(room_id)
+            started = time.perf_counter()
+            async_to_sync(self.run)(room_id, shards, options["sockets"], options["messages"])
+            report.append({
+                "shards": shards,
+                "sockets": options["sockets"],
+                "messages": options["messages"],
+                "seconds": round(time.perf_counter() - started, 3),
+                "latency": latency.snapshot(room_id).get(room_id),
+            })
+            latency.reset(room_id)
+        self.stdout.write(json.dumps(report, indent=2))
+
+    async def run(self, room_id, shards, sockets, messages):
+        channel_layer = get_channel_layer()
+        joined = []
+        for _ in range(sockets):
+            channel = await channel_layer.new_channel()
+            group = member_group(room_id, channel, shards)
+            await channel_layer.group_add(group, channel)
+            joined.append((group, channel))
+        try:
+            for n in range(messages):
+                event = {"type": "chat.message", "message": f"load {n}"}
+                await send_to_room(channel_layer, room_id, [event], shards=shards)
+        finally:
+            for group, channel in joined:
+                await channel_layer.group_discard(group, channel)
@@ -0,0 +1,194 @@
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from chat.models import ConversationParticipant
+from .models import RoomParticipant
+
+MEMBERSHIP_REVOKED_CLOSE_CODE = 4403
+
+_mirroring = ContextVar("chat_room_membership_mirroring", default=False)
+
+
+@contextmanager
+def mirroring_membership():
+    """
+    Within this block the RoomParticipant signal receivers leave the
+    conversation participants and the ACL cache alone: the caller updates
+    them once for the whole batch.
+    """
+    token = _mirroring.set(True)
+    try:
+        yield
+    finally:
+        _mirroring.reset(token)
+
+
+def is_mirroring_membership():
+    return _mirroring.get()
+
+
+def membership_cache_key(room_id, user_id):
+    return f"chat_room:member:{room_id}:{user_id}"
+
+
+def user_group_name(room_id, user_id):
+    """Channel-layer group holding one user's sockets in one room."""
+    return f"chat_{room_id}_user_{user_id}"
+
+
+def is_room_member(room_id, user_id):
+    """
+    Return whether ``user_id`` participates in ``room_id``, cached for
+    ROOM_MEMBERSHIP_CACHE_TTL seconds. The cache is shared, so the answer is
+    always read from the primary, never from a lagging replica.
+    """
+    key = membership_cache_key(room_id, user_id)
+    member = cache.get(key)
+    if member is None:
+        member = RoomParticipant.objects.using(DEFAULT_DB_ALIAS).filter(room_id=room_id, user_id=user_id).exists()
+        cache.set(key, member, getattr(settings, "ROOM_MEMBERSHIP_CACHE_TTL", 300))
+    return member
+
+
+def membership_changed(room_id, added=(), removed=()):
+    """
+    Drop cached ACL entries once the surrounding transaction commits, and force
+    removed users' sockets in the room to disconnect.
+    """
+    def publish():
+        cache.delete_many([membership_cache_key(room_id, user_id) for user_id in (*added, *removed)])
+        if not removed:
+            return
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            return
+        for user_id in removed:
+            async_to_sync(channel_layer.group_send)(
+                user_group_name(room_id, user_id), {"type": "membership.revoked"}
+            )
+
+    transaction.on_commit(publish, robust=True)
+
+
+def unknown_user_ids(user_ids):
+    """The ids in ``user_ids`` with no matching user, checked in one query."""
+    wanted = set(user_ids)
+    found = set(get_user_model().objects.filter(pk__in=wanted).values_list("pk", flat=True))
+    return sorted(wanted - found)
+
+
+def add_members(room, user_ids):
+    """
+    Add ``user_ids`` to ``room`` with one INSERT per table and return the ids
+    that were not members yet. bulk_create skips the RoomParticipant signals,
+    so the conversation participants are written here as well.
+    """
+    wanted = set(user_ids)
+    existing = set(
+        RoomParticipant.objects.filter(room=room, user_id__in=wanted).values_list("user_id", flat=True)
+    )
+    added = sorted(wanted - existing)
+    if not added:
+        return []
+    with transaction.atomic():
+        RoomParticipant.objects.bulk_create(
+            [RoomParticipant(room=room, user_id=user_id) for user_id in added], ignore_conflicts=True
+        )
+        ConversationParticipant.objects.bulk_create(
+            [ConversationParticipant(conversation_id=room.conversation_id, user_id=user_id) for user_id in added],
+            ignore_conflicts=True,
+        )
+        membership_changed(room.id, added=added)
+    return added
+
+
+def remove_members(room, user_ids):
+    """
+    Remove ``user_ids`` from ``room`` with one DELETE per table and return the
+    ids that were members. The per-row post_delete receivers are muted, so the
+    conversation participants and caches are updated here for the batch.
+    """
+    participants = RoomParticipant.objects.filter(room=room, user_id__in=set(user_ids))
+    removed = sorted(participants.values_list("user_id", flat=True))
+    if not removed:
+        return []
+    with transaction.atomic(), mirroring_membership():
+        participants.delete()
+        ConversationParticipant.objects.filter(
+            conversation_id=room.conversation_id, user_id__in=removed
+        ).delete()
+        membership_changed(room.id, removed=removed)
+    return removed
+
+
+def membership_task_key(task_id):
+    return f"chat_room:membership_task:{task_id}"
+
+
+def set_membership_progress(task_id, room_id, **progress):
+    key = membership_task_key(task_id)
+    state = cache.get(key) or {"task_id": task_id, "room_id": room_id}
+    state.update(progress)
+    cache.set(key, state, getattr(settings, "ROOM_MEMBERSHIP_TASK_TTL", 3600))
+    return state
+
+
+def get_membership_progress(task_id):
+    return cache.get(membership_task_key(task_id))
+
+
+def apply_membership_change(room, user_ids, action, batch_size=None, task_id=None):
+    """
+    Add or remove ``user_ids`` in batches of ROOM_MEMBERSHIP_BATCH_SIZE,
+    recording progress under ``task_id`` when given.
+    """
+    change = {"add": add_members, "remove": remove_members}[action]
+    batch_size = batch_size or getattr(settings, "ROOM_MEMBERSHIP_BATCH_SIZE", 500)
+    user_ids = sorted(set(user_ids))
+    changed = []
+    for start in range(0, len(user_ids), batch_size):
+        changed += change(room, user_ids[start:start + batch_size])
+        if task_id is not None:
+            set_membership_progress(
+                task_id, room.id, state="running", processed=min(start + batch_size, len(user_ids)), changed=len(changed)
+            )
+    if task_id is not None:
+        set_membership_progress(task_id, room.id, state="done", changed=len(changed))
+    return changed
+
+
+def change_membership(room, user_ids, action):
+    """
+    Apply a membership change now, or hand it to a Celery task when it covers
+    more than ROOM_MEMBERSHIP_ASYNC_THRESHOLD users. Returns
+    ``{"<action>ed": ids}`` or ``{"task_id": ...}`` respectively.
+    """
+    user_ids = sorted(set(user_ids))
+    if len(user_ids) <= getattr(settings, "ROOM_MEMBERSHIP_ASYNC_THRESHOLD", 500):
+        changed = apply_membership_change(room, user_ids, action)
+        return {"added" if action == "add" else "removed": changed}
+
+    from .tasks import change_room_membership
+
+    task_id = str(uuid.uuid4())
+    set_membership_progress(task_id, room.id, action=action, state="pending", total=len(user_ids), processed=0, changed=0)
+
+    def enqueue():
+        try:
+            change_room_membership.apply_async((room.id, user_ids, action), task_id=task_id)
+        except Exception:
+            set_membership_progress(task_id, room.id, state="failed")
+            raise
+
+    # The membership change itself is committed; a broker outage only marks
+    # the task failed instead of failing the request.
+    transaction.on_commit(enqueue, robust=True)
+    return {"task_id": task_id}
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-18 18:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_room', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='roomparticipant',
+            name='last_read_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
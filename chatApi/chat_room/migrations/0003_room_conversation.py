@@ -0,0 +1,18 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_conversation_direct_key_unique'),
+        ('chat_room', '0002_roomparticipant_last_read_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='conversation',
+            field=models.OneToOneField(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='room', to='chat.conversation'),
+        ),
+    ]
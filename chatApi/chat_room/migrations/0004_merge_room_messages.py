@@ -0,0 +1,74 @@
+from django.db import migrations
+from django.db.models import Count, Max
+
+BATCH_SIZE = 1000
+
+
+def merge_room_messages(apps, schema_editor):
+    Room = apps.get_model("chat_room", "Room")
+    RoomParticipant = apps.get_model("chat_room", "RoomParticipant")
+    RoomMessage = apps.get_model("chat_room", "Message")
+    Conversation = apps.get_model("chat", "Conversation")
+    ConversationParticipant = apps.get_model("chat", "ConversationParticipant")
+    ChatMessage = apps.get_model("chat", "Message")
+
+    # Keep the original timestamps of migrated messages.
+    created_at = ChatMessage._meta.get_field("created_at")
+    created_at.auto_now_add = False
+    try:
+        _merge(Room, RoomParticipant, RoomMessage, Conversation, ConversationParticipant, ChatMessage)
+    finally:
+        created_at.auto_now_add = True
+
+
+def _merge(Room, RoomParticipant, RoomMessage, Conversation, ConversationParticipant, ChatMessage):
+    for room in Room.objects.filter(conversation__isnull=True).iterator():
+        convo = Conversation.objects.create(type="room", title=room.name or "")
+        Conversation.objects.filter(pk=convo.pk).update(created_at=room.created_at)
+        room.conversation = convo
+        room.save(update_fields=["conversation"])
+
+        participants = list(RoomParticipant.objects.filter(room=room))
+        ConversationParticipant.objects.bulk_create([
+            ConversationParticipant(conversation=convo, user_id=p.user_id, last_read_at=p.last_read_at)
+            for p in participants
+        ])
+
+        new_ids = {}
+        replies = []
+        old_messages = RoomMessage.objects.filter(room=room).order_by("created_at", "id")
+        for start in range(0, old_messages.count(), BATCH_SIZE):
+            batch = list(old_messages[start:start + BATCH_SIZE])
+            created = ChatMessage.objects.bulk_create([
+                ChatMessage(conversation=convo, sender_id=m.sender_id, content=m.content, created_at=m.created_at)
+                for m in batch
+            ])
+            for old, new in zip(batch, created):
+                new_ids[old.id] = new.id
+                if old.reply_to_id:
+                    replies.append((new.id, old.reply_to_id))
+
+        for new_id, old_parent_id in replies:
+            if old_parent_id in new_ids:
+                ChatMessage.objects.filter(pk=new_id).update(parent_id=new_ids[old_parent_id])
+
+        last = ChatMessage.objects.filter(conversation=convo).aggregate(m=Max("created_at"))["m"]
+        Conversation.objects.filter(pk=convo.pk).update(last_message_at=last)
+        for p in participants:
+            unread = ChatMessage.objects.filter(conversation=convo).exclude(sender_id=p.user_id)
+            if p.last_read_at:
+                unread = unread.filter(created_at__gt=p.last_read_at)
+            ConversationParticipant.objects.filter(conversation=convo, user_id=p.user_id).update(
+                unread_count=unread.aggregate(c=Count("id"))["c"]
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_room', '0003_room_conversation'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_room_messages, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_room', '0004_merge_room_messages'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='roomparticipant',
+            name='last_read_at',
+        ),
+        migrations.DeleteModel(
+            name='Message',
+        ),
+    ]
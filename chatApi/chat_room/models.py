@@ -1,19 +1,84 @@
 from django.db import models
+from django.db.models import Count, F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Left
 from django.conf import settings
 
 User = settings.AUTH_USER_MODEL
 
 
+class RoomQuerySet(models.QuerySet):
+    def listing_for(self, user):
+        """Rooms ``user`` belongs to, with their summaries, most recently active first."""
+        return (
+            self.filter(participants__user=user)
+            .with_summary(user)
+            .order_by(F("conversation__last_message_at").desc(nulls_last=True), "-pk")
+        )
+
+    def with_summary(self, user):
+        """
+        Annotate member count, last message and ``user``'s unread count, one
+        query for any number of rooms.
+        """
+        from chat.models import PREVIEW_LENGTH, ConversationParticipant, Message
+
+        member_count = (
+            RoomParticipant.objects
+            .filter(room=OuterRef("pk"))
+            .order_by()
+            .values("room")
+            .annotate(c=Count("id"))
+            .values("c")
+        )
+        last_message = (
+            Message.objects
+            .filter(conversation=OuterRef("conversation_id"))
+            .order_by("-created_at", "-id")
+        )
+        unread = ConversationParticipant.objects.filter(conversation=OuterRef("conversation_id"), user=user)
+        return self.annotate(
+            participant_count=Coalesce(Subquery(member_count), Value(0)),
+            last_message_id=Subquery(last_message.values("id")[:1]),
+            last_message_preview=Subquery(
+                last_message.annotate(preview=Left("content", PREVIEW_LENGTH)).values("preview")[:1]
+            ),
+            last_message_sender_id=Subquery(last_message.values("sender_id")[:1]),
+            last_message_created_at=Subquery(last_message.values("created_at")[:1]),
+            my_unread_count=Coalesce(Subquery(unread.values("unread_count")[:1]), Value(0)),
+        )
+
+
 class Room(models.Model):
     name = models.CharField(max_length=255, blank=True, null=True)
     is_group = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Only the creator may remove other members; anyone may leave.
+    created_by = models.ForeignKey(
+        User, null=True, blank=True, editable=False,
+        on_delete=models.SET_NULL, related_name="created_rooms"
+    )
+    # Messages and read state of a room live on its conversation (chat app).
+    conversation = models.OneToOneField(
+        "chat.Conversation", null=True, blank=True, editable=False,
+        on_delete=models.SET_NULL, related_name="room"
+    )
+
+    objects = RoomQuerySet.as_manager()
 
     def __str__(self):
         if self.is_group:
             return self.name or f"Group Room {self.id}"
         return f"Private Room {self.id}"
 
+    def save(self, *args, **kwargs):
+        from chat.models import Conversation
+
+        if self.conversation_id is None:
+            self.conversation = Conversation.objects.create(type=Conversation.TYPE_ROOM, title=self.name or "")
+        elif self.conversation.title != (self.name or ""):
+            Conversation.objects.filter(pk=self.conversation_id).update(title=self.name or "")
+        super().save(*args, **kwargs)
+
 
 class RoomParticipant(models.Model):
     room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name="participants")
@@ -24,16 +89,3 @@ class RoomParticipant(models.Model):
 
     def __str__(self):
         return f"{self.user} in {self.room}"
-
-
-class Message(models.Model):
-    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name="messages")
-    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name="chat_room_sent_messages")
-    content = models.TextField()
-    created_at = models.DateTimeField(auto_now_add=True)
-    reply_to = models.ForeignKey(
-        "self", null=True, blank=True, on_delete=models.SET_NULL, related_name="replies"
-    )
-
-    def __str__(self):
-        return f"{self.sender} in {self.room}: {self.content[:20]}"
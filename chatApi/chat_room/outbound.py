@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import threading
+import weakref
+from collections import deque
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+SLOW_CONSUMER_CLOSE_CODE = 4429
+
+_live = weakref.WeakSet()
+_lock = threading.Lock()
+_totals = {"overflows": 0, "closed": 0}
+
+
+def get_high_water():
+    return getattr(settings, "CHAT_OUTBOUND_HIGH_WATER", 200)
+
+
+def get_overflow_policy():
+    return getattr(settings, "CHAT_OUTBOUND_OVERFLOW", "resync")
+
+
+class OutboundQueue:
+    """
+    Bounded queue of encoded frames for one websocket, drained by ``run``
+    through ``write``. Once more than ``high_water`` frames are waiting the
+    socket is too slow to keep up: with the "resync" policy the queue is
+    dropped and, as soon as the socket catches up, replaced by a single
+    ``notify(missed, last_seq)`` covering everything it did not get; with
+    "close" ``put`` returns False and the caller disconnects the socket.
+    """
+
+    def __init__(self, write, notify, high_water=None, policy=None, labels=None):
+        self.write = write
+        self.notify = notify
+        self.high_water = high_water or get_high_water()
+        self.policy = policy or get_overflow_policy()
+        self.labels = labels or {}
+        self.frames = deque()
+        self.ready = asyncio.Event()
+        self.overflowing = False
+        self.missed = 0
+        self.missed_up_to = None
+        self.sent = 0
+        self.dropped = 0
+        self.overflows = 0
+        with _lock:
+            _live.add(self)
+
+    @property
+    def depth(self):
+        return len(self.frames)
+
+    def put(self, payload, seqs=()):
+        """Queue ``payload`` carrying the message ``seqs``; False means disconnect."""
+        if self.overflowing:
+            self._miss(seqs)
+            return True
+        self.frames.append((payload, seqs))
+        self.ready.set()
+        if len(self.frames) <= self.high_water:
+            return True
+
+        self.overflows += 1
+        with _lock:
+            _totals["overflows"] += 1
+        if self.policy == "close":
+            with _lock:
+                _totals["closed"] += 1
+            return False
+        # The client has to resync anyway, so nothing queued is worth sending.
+        self.overflowing = True
+        while self.frames:
+            self._miss(self.frames.popleft()[1])
+        return True
+
+    def _miss(self, seqs):
+        self.dropped += 1
+        seqs = [seq for seq in seqs if seq is not None]
+        self.missed += len(seqs)
+        if seqs:
+            self.missed_up_to = max(self.missed_up_to or 0, *seqs)
+
+    async def run(self):
+        while True:
+            if self.frames:
+                payload, _ = self.frames.popleft()
+                await self.write(payload)
+                self.sent += 1
+            elif self.overflowing:
+                missed, last_seq = self.missed, self.missed_up_to
+                self.overflowing, self.missed, self.missed_up_to = False, 0, None
+                await self.notify(missed, last_seq)
+            else:
+                self.ready.clear()
+                await self.ready.wait()
+
+    def stats(self):
+        return {
+            **self.labels,
+            "depth": self.depth,
+            "high_water": self.high_water,
+            "overflowing": self.overflowing,
+            "missed": self.missed,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "overflows": self.overflows,
+        }
+
+
+def queue_stats(top=20):
+    """Outbound queue depths of the live sockets in this process, deepest first."""
+    with _lock:
+        queues = list(_live)
+        totals = dict(_totals)
+    sockets = sorted((queue.stats() for queue in queues), key=lambda s: s["depth"], reverse=True)
+    return {
+        "sockets": len(sockets),
+        "depth_total": sum(s["depth"] for s in sockets),
+        "depth_max": sockets[0]["depth"] if sockets else 0,
+        "overflowing": sum(1 for s in sockets if s["overflowing"]),
+        "overflows_total": totals["overflows"],
+        "closed_total": totals["closed"],
+        "deepest": sockets[:top],
+    }
+
+
+async def stop_queue(queue, task):
+    """Cancel the writer ``task`` of ``queue`` and forget the queue."""
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    except Exception:
+        logger.exception("Outbound writer for %s failed", queue.labels)
+    with _lock:
+        _live.discard(queue)
@@ -0,0 +1,74 @@
+from django.conf import settings
+from django.core.cache import caches
+
+from chat.fanout import room_groups
+from .models import RoomParticipant
+
+CONNECTIONS_KEY = "presence:connections:{user_id}"
+ANNOUNCED_KEY = "presence:announced:{user_id}"
+
+
+def get_cache():
+    return caches[getattr(settings, "PRESENCE_CACHE", "default")]
+
+
+def get_ttl():
+    return getattr(settings, "PRESENCE_TTL", 60 * 60 * 24)
+
+
+def connection_opened(user_id):
+    """
+    Count one more socket for ``user_id`` (across all workers). Returns True
+    when the user just came online and the transition should be announced.
+    """
+    cache, ttl = get_cache(), get_ttl()
+    key = CONNECTIONS_KEY.format(user_id=user_id)
+    cache.add(key, 0, ttl)
+    count = cache.incr(key)
+    cache.touch(key, ttl)
+    if count == 1 and not cache.get(ANNOUNCED_KEY.format(user_id=user_id)):
+        cache.set(ANNOUNCED_KEY.format(user_id=user_id), True, ttl)
+        return True
+    return False
+
+
+def connection_closed(user_id):
+    """Count one socket less for ``user_id``; returns the sockets left."""
+    cache = get_cache()
+    key = CONNECTIONS_KEY.format(user_id=user_id)
+    try:
+        count = cache.decr(key)
+    except ValueError:
+        return 0
+    if count <= 0:
+        cache.set(key, 0, get_ttl())
+        return 0
+    return count
+
+
+def claim_offline_transition(user_id):
+    """
+    Return True exactly once after the last socket of an announced-online user
+    has gone away, so only one worker broadcasts the offline event.
+    """
+    cache = get_cache()
+    if cache.get(CONNECTIONS_KEY.format(user_id=user_id)):
+        return False
+    key = ANNOUNCED_KEY.format(user_id=user_id)
+    if not cache.get(key):
+        return False
+    cache.delete(key)
+    return True
+
+
+def get_online(user_ids):
+    """Map each of ``user_ids`` to whether it has an open socket."""
+    keys = {CONNECTIONS_KEY.format(user_id=user_id): user_id for user_id in user_ids}
+    counts = get_cache().get_many(keys)
+    return {user_id: bool(counts.get(key)) for key, user_id in keys.items()}
+
+
+def presence_groups(user_id):
+    """Room groups that should hear about ``user_id``'s transitions."""
+    room_ids = RoomParticipant.objects.filter(user_id=user_id).values_list("room_id", flat=True)
+    return [group for room_id in room_ids for group in room_groups(room_id)]
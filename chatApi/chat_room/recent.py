@@ -0,0 +1,182 @@
+import json
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
+from rest_framework.renderers import JSONRenderer
+
+from chat.models import Message
+from .models import Room
+
+ENTRY_KEY = "chat_room:recent:{room_id}"
+LOCK_KEY = "chat_room:recent:{room_id}:lock"
+HITS_KEY = "chat_room:recent:hits"
+MISSES_KEY = "chat_room:recent:misses"
+LOCK_TIMEOUT = 5
+LOCK_WAIT = 0.05
+
+
+def get_cache():
+    return caches[getattr(settings, "RECENT_MESSAGES_CACHE", "default")]
+
+
+def get_limit():
+    return getattr(settings, "RECENT_MESSAGES_LIMIT", 50)
+
+
+def get_ttl():
+    return getattr(settings, "RECENT_MESSAGES_TTL", 600)
+
+
+@contextmanager
+def room_lock(room_id):
+    """
+    Serialize rebuilds and write-throughs of one room's entry across workers.
+    Yields False if the lock could not be taken within LOCK_WAIT seconds.
+    """
+    cache = get_cache()
+    key = LOCK_KEY.format(room_id=room_id)
+    deadline = time.monotonic() + LOCK_WAIT
+    while not cache.add(key, True, LOCK_TIMEOUT):
+        if time.monotonic() >= deadline:
+            yield False
+            return
+        time.sleep(0.002)
+    try:
+        yield True
+    finally:
+        cache.delete(key)
+
+
+def render_messages(room, messages):
+    """Pre-render ``messages`` the way MessageListCreateView serializes them."""
+    from .serializers import MessageSerializer
+
+    renderer = JSONRenderer()
+    return [
+        (msg.created_at, msg.pk, renderer.render(MessageSerializer(msg, context={"room": room}).data))
+        for msg in messages
+    ]
+
+
+def load_entry(room):
+    """
+    Build a room's entry from the database: the newest RECENT_MESSAGES_LIMIT
+    hot messages as ``(created_at, pk, json_bytes)``, newest first, whether
+    that is the room's whole history, and the archive horizon.
+    """
+    limit = get_limit()
+    # Shared by every reader, so never built from a lagging replica.
+    messages = list(
+        Message.objects
+        .using(DEFAULT_DB_ALIAS)
+        .filter(conversation_id=room.conversation_id)
+        .order_by("-created_at", "-pk")[:limit + 1]
+    )
+    archived_until = room.conversation.archived_until if room.conversation_id else None
+    return {
+        "items": render_messages(room, messages[:limit]),
+        "complete": len(messages) <= limit and archived_until is None,
+        "archived_until": archived_until,
+    }
+
+
+def get_entry(room_id):
+    """
+    Return the cached entry for ``room_id``, rebuilding it on a miss. Returns
+    None when the room does not exist or another worker is busy rebuilding it.
+    """
+    cache = get_cache()
+    key = ENTRY_KEY.format(room_id=room_id)
+    entry = cache.get(key)
+    if entry is not None:
+        count(HITS_KEY)
+        return entry
+
+    count(MISSES_KEY)
+    room = (
+        Room.objects
+        .using(DEFAULT_DB_ALIAS)
+        .filter(pk=room_id)
+        .select_related("conversation")
+        .only("id", "conversation_id", "conversation__archived_until")
+        .first()
+    )
+    if room is None:
+        return None
+    with room_lock(room_id) as locked:
+        if not locked:
+            return None
+        entry = load_entry(room)
+        cache.set(key, entry, get_ttl())
+    return entry
+
+
+def add_messages(conversation_ids, messages):
+    """
+    Write newly created messages through to the entries of the rooms they
+    belong to. Rooms without an entry are left alone; the next read builds it.
+    """
+    rooms = Room.objects.filter(conversation_id__in=conversation_ids).only("id", "conversation_id")
+    cache = get_cache()
+    limit = get_limit()
+    for room in rooms:
+        key = ENTRY_KEY.format(room_id=room.id)
+        new = [msg for msg in messages if msg.conversation_id == room.conversation_id]
+        with room_lock(room.id) as locked:
+            if not locked:
+                cache.delete(key)
+                continue
+            entry = cache.get(key)
+            if entry is None:
+                continue
+            seen = {pk for _, pk, _ in entry["items"]}
+            items = entry["items"] + [item for item in render_messages(room, new) if item[1] not in seen]
+            items.sort(key=lambda item: (item[0], item[1]), reverse=True)
+            cache.set(key, {
+                **entry,
+                "items": items[:limit],
+                "complete": entry["complete"] and len(items) <= limit,
+            }, get_ttl())
+
+
+def invalidate(room_ids):
+    get_cache().delete_many([ENTRY_KEY.format(room_id=room_id) for room_id in room_ids])
+
+
+def invalidate_conversations(conversation_ids):
+    invalidate(Room.objects.filter(conversation_id__in=conversation_ids).values_list("id", flat=True))
+
+
+def covers_page(entry, page_size):
+    """Whether the newest ``page_size`` messages are all in ``entry`` rather than the archive."""
+    if entry["archived_until"] is None:
+        return True
+    items = entry["items"]
+    return len(items) >= page_size and items[page_size - 1][0] > entry["archived_until"]
+
+
+def render_page(entry, page_size, next_link):
+    """The JSON body of MessageCursorPagination's newest page, built from ``entry``."""
+    items = entry["items"][:page_size]
+    head = {"next": next_link, "previous": None}
+    envelope = json.dumps(head, separators=(",", ":"))[:-1].encode()
+    return envelope + b',"results":[' + b",".join(body for _, _, body in items) + b"]}"
+
+
+def count(key):
+    cache = get_cache()
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, None)
+
+
+def get_stats():
+    values = get_cache().get_many([HITS_KEY, MISSES_KEY])
+    hits, misses = values.get(HITS_KEY, 0), values.get(MISSES_KEY, 0)
+    total = hits + misses
+    return {"hits": hits, "misses": misses, "hit_ratio": hits / total if total else None}
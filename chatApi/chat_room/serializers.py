@@ -1,5 +1,9 @@
 from rest_framework import serializers, generics, permissions
-from .models import Room, RoomParticipant, Message
+from chat.models import Message
+from chat.serializers import UserLiteSerializer
+from chat.services import send_message
+from .membership import unknown_user_ids
+from .models import Room, RoomParticipant
 
 
 class RoomParticipantSerializer(serializers.ModelSerializer):
@@ -8,24 +12,72 @@ class RoomParticipantSerializer(serializers.ModelSerializer):
         fields = ["id", "user", "room"]
 
 
+class RoomMemberSerializer(serializers.ModelSerializer):
+    user = UserLiteSerializer(read_only=True)
+
+    class Meta:
+        model = RoomParticipant
+        fields = ["id", "user"]
+
+
 class RoomSerializer(serializers.ModelSerializer):
-    participants = RoomParticipantSerializer(many=True, read_only=True)
+    """
+    A room summary. Members are listed separately by RoomParticipantListView;
+    counts and the last message come from ``Room.objects.with_summary``.
+    """
     participant_ids = serializers.ListField(
         child=serializers.IntegerField(), write_only=True, required=False
     )
+    participant_count = serializers.SerializerMethodField()
+    unread_count = serializers.SerializerMethodField()
+    last_message = serializers.SerializerMethodField()
 
     class Meta:
         model = Room
-        fields = ["id", "name", "is_group", "created_at", "participants", "participant_ids"]
+        fields = [
+            "id", "name", "is_group", "created_at",
+            "participant_count", "unread_count", "last_message", "participant_ids",
+        ]
+
+    def get_participant_count(self, obj):
+        annotated = getattr(obj, "participant_count", None)
+        if annotated is not None:
+            return annotated
+        return obj.participants.count()
+
+    def get_unread_count(self, obj):
+        return getattr(obj, "my_unread_count", 0)
+
+    def get_last_message(self, obj):
+        if getattr(obj, "last_message_id", None) is None:
+            return None
+        return {
+            "id": obj.last_message_id,
+            "content": obj.last_message_preview,
+            "sender_id": obj.last_message_sender_id,
+            "created_at": serializers.DateTimeField().to_representation(obj.last_message_created_at),
+        }
+
+    def validate_participant_ids(self, value):
+        unknown = unknown_user_ids(value)
+        if unknown:
+            raise serializers.ValidationError(f"Unknown user ids: {unknown}")
+        return value
 
     def create(self, validated_data):
-        participant_ids = validated_data.pop("participant_ids", [])
-        room = Room.objects.create(**validated_data)
+        # Members are added by the view through chat_room.membership.
+        validated_data.pop("participant_ids", None)
+        return Room.objects.create(**validated_data)
+
 
-        for user_id in participant_ids:
-            RoomParticipant.objects.create(room=room, user_id=user_id)
+class MembershipChangeSerializer(serializers.Serializer):
+    user_ids = serializers.ListField(child=serializers.IntegerField(), allow_empty=False)
 
-        return room
+    def validate_user_ids(self, value):
+        unknown = unknown_user_ids(value)
+        if unknown:
+            raise serializers.ValidationError(f"Unknown user ids: {unknown}")
+        return value
 
 class RoomListCreateView(generics.ListCreateAPIView):
     queryset = Room.objects.all()
@@ -39,14 +91,34 @@ class RoomListCreateView(generics.ListCreateAPIView):
 
 
 class MessageSerializer(serializers.ModelSerializer):
+    room = serializers.SerializerMethodField()
+    reply_to = serializers.PrimaryKeyRelatedField(
+        source="parent", queryset=Message.objects.all(), required=False, allow_null=True
+    )
+
     class Meta:
         model = Message
-        fields = ["id", "room", "sender", "content", "created_at", "reply_to"]
-        read_only_fields = ["sender", "created_at", "room"]
+        fields = ["id", "room", "seq", "sender", "content", "created_at", "reply_to"]
+        read_only_fields = ["sender", "created_at", "room", "seq"]
+        extra_kwargs = {"content": {"allow_blank": False}}
         ref_name = "ChatRoomMessageSerializer"  # unique name
 
+    def get_room(self, obj):
+        room = self.context.get("room")
+        return room.id if room else obj.conversation.room.id
+
+    def validate_reply_to(self, parent):
+        room = self.context.get("room")
+        if parent and room and parent.conversation_id != room.conversation_id:
+            raise serializers.ValidationError("Reply target belongs to another room")
+        return parent
 
     def create(self, validated_data):
         room = self.context.get("room")
         user = self.context.get("user")
-        return Message.objects.create(room=room, sender=user, **validated_data)
+        return send_message(
+            sender=user,
+            conversation=room.conversation,
+            content=validated_data["content"],
+            parent=validated_data.get("parent"),
+        )
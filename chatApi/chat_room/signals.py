@@ -0,0 +1,50 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from chat.models import Conversation, ConversationParticipant, Message
+from chat.services import messages_committed
+from . import recent
+from .membership import is_mirroring_membership, membership_changed
+from .models import Room, RoomParticipant
+
+
+@receiver(post_save, sender=RoomParticipant)
+def add_conversation_participant(sender, instance, created, **kwargs):
+    if created:
+        conversation_id = Room.objects.filter(pk=instance.room_id).values_list("conversation_id", flat=True).first()
+        ConversationParticipant.objects.get_or_create(conversation_id=conversation_id, user_id=instance.user_id)
+        membership_changed(instance.room_id, added=[instance.user_id])
+
+
+@receiver(post_delete, sender=RoomParticipant)
+def remove_conversation_participant(sender, instance, **kwargs):
+    if is_mirroring_membership():
+        return
+    ConversationParticipant.objects.filter(
+        conversation__room=instance.room_id, user_id=instance.user_id
+    ).delete()
+    membership_changed(instance.room_id, removed=[instance.user_id])
+
+
+@receiver(post_delete, sender=Room)
+def delete_room_conversation(sender, instance, **kwargs):
+    if instance.conversation_id:
+        Conversation.objects.filter(pk=instance.conversation_id).delete()
+    recent.invalidate([instance.pk])
+
+
+@receiver(messages_committed)
+def update_recent_messages(sender, messages, action, **kwargs):
+    conversation_ids = {msg.conversation_id for msg in messages}
+    if action == "created":
+        recent.add_messages(conversation_ids, messages)
+    else:
+        recent.invalidate_conversations(conversation_ids)
+
+
+@receiver(post_save, sender=Message)
+@receiver(post_delete, sender=Message)
+def invalidate_recent_messages(sender, instance, **kwargs):
+    conversation_id = instance.conversation_id
+    transaction.on_commit(lambda: recent.invalidate_conversations([conversation_id]))
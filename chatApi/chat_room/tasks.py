@@ -0,0 +1,12 @@
+from celery import shared_task
+
+from .membership import apply_membership_change
+from .models import Room
+
+
+@shared_task(bind=True)
+def change_room_membership(self, room_id, user_ids, action):
+    room = Room.objects.filter(pk=room_id).first()
+    if room is None:
+        return 0
+    return len(apply_membership_change(room, user_ids, action, task_id=self.request.id))
@@ -1,14 +1,37 @@
+import json
+import tempfile
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.test import APITestCase
 from django.contrib.auth import get_user_model
-from chat_room.models import Room, RoomParticipant, Message
+from chatApi.routers import replica_reads
+from chat.archive import archive_old_messages
+from chat.models import ConversationParticipant, Message
+from chat.services import persist_messages, send_message
+from chat_room import recent
+from chat_room.buffer import WriteBuffer
+from chat_room.membership import is_room_member
+from chat_room.models import Room, RoomParticipant
+from chat_room.tasks import change_room_membership
 
 User = get_user_model()
 
+IN_MEMORY_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
 
 class ChatRoomTests(APITestCase):
     def setUp(self):
+        cache.clear()
         self.user1 = User.objects.create_user(username="user1", password="pass123")
         self.user2 = User.objects.create_user(username="user2", password="pass123")
         self.user3 = User.objects.create_user(username="user3", password="pass123")
@@ -16,7 +39,7 @@ class ChatRoomTests(APITestCase):
         self.client.force_authenticate(user=self.user1)
 
     def create_room_with_participants(self, is_group=False, participants=None, name=""):
-        room = Room.objects.create(is_group=is_group, name=name)
+        room = Room.objects.create(is_group=is_group, name=name, created_by=self.user1)
         RoomParticipant.objects.get_or_create(room=room, user=self.user1)
         if participants:
             for user in participants:
@@ -39,6 +62,7 @@ class ChatRoomTests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         room = Room.objects.get(id=response.data["id"])
         self.assertTrue(room.is_group)
+        self.assertEqual(room.created_by, self.user1)
 
     def test_send_message(self):
         room = self.create_room_with_participants(participants=[self.user2])
@@ -49,21 +73,55 @@ class ChatRoomTests(APITestCase):
         message = Message.objects.get(pk=response.data["id"])
         self.assertEqual(message.content, "Hello!")
         self.assertEqual(message.sender, self.user1)
-        self.assertEqual(message.room, room)
+        self.assertEqual(message.conversation, room.conversation)
+
+    def test_non_member_cannot_send_message(self):
+        room = self.create_room_with_participants(participants=[self.user2])
+        url = reverse("message-list-create", kwargs={"room_id": room.id})
+        self.client.force_authenticate(user=self.user3)
+        response = self.client.post(url, {"content": "let me in"}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertFalse(Message.objects.filter(conversation=room.conversation).exists())
+
+    def test_failed_publish_does_not_fail_the_saved_message(self):
+        room = self.create_room_with_participants(participants=[self.user2])
+        url = reverse("message-list-create", kwargs={"room_id": room.id})
+        with mock.patch("chat.services.publish_messages", side_effect=ConnectionError("layer down")):
+            with self.assertLogs(level="ERROR"):
+                with self.captureOnCommitCallbacks(execute=True):
+                    response = self.client.post(url, {"content": "saved"}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(Message.objects.filter(pk=response.data["id"]).exists())
+
+    def test_failed_buffer_batch_is_retried_with_fresh_seqs(self):
+        room = self.create_room_with_participants(participants=[self.user2])
+        good = Message(conversation_id=room.conversation_id, sender=self.user1, content="good")
+        bad = Message(conversation_id=room.conversation_id + 1000, sender=self.user1, content="bad")
+
+        buffer = WriteBuffer(lambda messages: persist_messages(messages, publish=False))
+        with self.assertLogs("chat_room.buffer", "ERROR"):
+            results = buffer._insert([good, bad])
+        self.assertEqual(results[0].seq, 1)
+        self.assertIsInstance(results[1], Exception)
+
+        later = send_message(self.user1, room.conversation, "later")
+        self.assertEqual(later.seq, 2)
+        room.conversation.refresh_from_db()
+        self.assertEqual(room.conversation.last_seq, 2)
 
     def test_message_reply(self):
         room = self.create_room_with_participants(participants=[self.user2])
-        parent_msg = Message.objects.create(room=room, sender=self.user1, content="Parent")
+        parent_msg = Message.objects.create(conversation=room.conversation, sender=self.user1, content="Parent")
         url = reverse("message-list-create", kwargs={"room_id": room.id})
         data = {"content": "Replying", "reply_to": parent_msg.id}
         response = self.client.post(url, data, format="json")
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         reply_msg = Message.objects.get(pk=response.data["id"])
-        self.assertEqual(reply_msg.reply_to, parent_msg)
+        self.assertEqual(reply_msg.parent, parent_msg)
 
     def test_unread_count_simulation(self):
         room = self.create_room_with_participants(participants=[self.user2])
-        Message.objects.create(room=room, sender=self.user2, content="Hi user1")
+        Message.objects.create(conversation=room.conversation, sender=self.user2, content="Hi user1")
         participant = RoomParticipant.objects.get(room=room, user=self.user1)
         self.assertIsNotNone(participant.id)  # updated placeholder
         participant.save()
@@ -74,3 +132,286 @@ class ChatRoomTests(APITestCase):
         self.client.force_authenticate(user=self.user3)
         response = self.client.get(url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_room_messages_share_conversation_storage(self):
+        room = self.create_room_with_participants(participants=[self.user2])
+        url = reverse("message-list-create", kwargs={"room_id": room.id})
+        self.client.post(url, {"content": "from the room"}, format="json")
+
+        listing = self.client.get(f"/api/messages/?conversation={room.conversation_id}")
+        self.assertEqual([m["content"] for m in listing.data["results"]], ["from the room"])
+
+        room.conversation.refresh_from_db()
+        self.assertIsNotNone(room.conversation.last_message_at)
+        cp = ConversationParticipant.objects.get(conversation=room.conversation, user=self.user2)
+        self.assertEqual(cp.unread_count, 1)
+
+    def test_removing_participant_revokes_conversation_access(self):
+        room = self.create_room_with_participants(participants=[self.user2])
+        RoomParticipant.objects.filter(room=room, user=self.user2).delete()
+        self.assertFalse(
+            ConversationParticipant.objects.filter(conversation=room.conversation, user=self.user2).exists()
+        )
+
+    @override_settings(RECENT_MESSAGES_LIMIT=3)
+    def test_newest_page_is_served_from_recent_cache(self):
+        room = self.create_room_with_participants(participants=[self.user2])
+        for i in range(4):
+            Message.objects.create(conversation=room.conversation, sender=self.user2, content=f"m{i}")
+        url = reverse("message-list-create", kwargs={"room_id": room.id})
+
+        with mock.patch("chat_room.recent.get_entry", return_value=None):
+            from_db = self.client.get(url, {"page_size": 2}).json()
+        with self.assertNumQueries(2):
+            miss = self.client.get(url, {"page_size": 2}).json()
+        with self.assertNumQueries(0):
+            hit = self.client.get(url, {"page_size": 2}).json()
+        self.assertEqual(miss, from_db)
+        self.assertEqual(hit, from_db)
+        self.assertEqual([m["content"] for m in hit["results"]], ["m3", "m2"])
+
+        older = self.client.get(hit["next"]).json()
+        self.assertEqual([m["content"] for m in older["results"]], ["m1", "m0"])
+        self.assertEqual(recent.get_stats()["hits"], 1)
+        self.assertEqual(recent.get_stats()["misses"], 1)
+
+    @override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+    def test_new_messages_are_written_through_to_recent_cache(self):
+        room = self.create_room_with_participants(participants=[self.user2])
+        url = reverse("message-list-create", kwargs={"room_id": room.id})
+        self.client.get(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(url, {"content": "fresh"}, format="json")
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url).json()
+        self.assertEqual([m["content"] for m in response["results"]], ["fresh"])
+        self.assertIsNone(response["next"])
+
+    @override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+    def test_edits_invalidate_recent_cache(self):
+        room = self.create_room_with_participants(participants=[self.user2])
+        msg = Message.objects.create(conversation=room.conversation, sender=self.user1, content="typo")
+        url = reverse("message-list-create", kwargs={"room_id": room.id})
+        self.client.get(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(f"/api/messages/{msg.pk}/", {"content": "fixed"}, format="json")
+
+        response = self.client.get(url).json()
+        self.assertEqual(response["results"][0]["content"], "fixed")
+
+    def test_room_history_reaches_archived_messages(self):
+        room = self.create_room_with_participants(participants=[self.user2])
+        old = Message.objects.create(conversation=room.conversation, sender=self.user2, content="old")
+        Message.objects.filter(pk=old.pk).update(created_at=timezone.now() - timedelta(days=10))
+        Message.objects.create(conversation=room.conversation, sender=self.user2, content="new")
+        room.conversation.retention_days = 5
+        room.conversation.save()
+        archive_old_messages()
+
+        url = reverse("message-list-create", kwargs={"room_id": room.id})
+        response = self.client.get(url).json()
+        self.assertEqual([m["content"] for m in response["results"]], ["new", "old"])
+        self.assertEqual(response["results"][1]["room"], room.id)
+
+    def test_db_pool_stats_are_admin_only(self):
+        url = reverse("db-pool-stats")
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_403_FORBIDDEN)
+
+        admin = User.objects.create_superuser(username="admin", password="pass123")
+        self.client.force_authenticate(user=admin)
+        stats = self.client.get(url).json()["results"][0]
+        self.assertEqual(stats["alias"], "default")
+        self.assertFalse(stats["pooled"])
+        self.assertEqual(stats["conn_max_age"], 0)
+
+    def run_db_loadtest(self, **database):
+        """db_loadtest against a throwaway file database; the in-memory test DB never closes."""
+        alias = "loadtest"
+        out = StringIO()
+        with tempfile.TemporaryDirectory() as tmp:
+            connections.settings[alias] = connections.configure_settings({
+                DEFAULT_DB_ALIAS: dict(connections.settings[DEFAULT_DB_ALIAS]),
+                alias: {"ENGINE": "django.db.backends.sqlite3", "NAME": f"{tmp}/loadtest.sqlite3", **database},
+            })[alias]
+            try:
+                with mock.patch.object(type(self), "databases", self.databases | {alias}):
+                    call_command("db_loadtest", calls=20, concurrency=5, database=alias, stdout=out)
+            finally:
+                connections[alias].close()
+                del connections[alias]
+                del connections.settings[alias]
+        return json.loads(out.getvalue())
+
+    def test_db_loadtest_reports_connection_use(self):
+        closing = self.run_db_loadtest(CONN_MAX_AGE=0)
+        self.assertEqual(closing["calls"], 20)
+        self.assertEqual(closing["connections_opened"], 20)
+
+        persistent = self.run_db_loadtest(CONN_MAX_AGE=60, CONN_HEALTH_CHECKS=True)
+        self.assertEqual(persistent["connections_opened"], 1)
+        self.assertEqual(persistent["pool"]["conn_max_age"], 60)
+
+    def test_room_list_is_scoped_and_summarised(self):
+        mine = self.create_room_with_participants(is_group=True, participants=[self.user2], name="mine")
+        Room.objects.create(is_group=True, name="not mine")
+        other = self.create_room_with_participants(is_group=True, participants=[self.user2, self.user3], name="busy")
+        Message.objects.create(conversation=other.conversation, sender=self.user2, content="ping")
+
+        # A fresh last_seen keeps the heartbeat write out of the count.
+        self.user1.last_seen = timezone.now()
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse("room-list-create"))
+        rooms = response.json()
+        self.assertEqual([r["name"] for r in rooms], ["busy", "mine"])
+        busy = rooms[0]
+        self.assertEqual(busy["participant_count"], 3)
+        self.assertEqual(busy["unread_count"], 1)
+        self.assertEqual(busy["last_message"]["content"], "ping")
+        self.assertNotIn("participants", busy)
+        self.assertIsNone(rooms[1]["last_message"])
+        self.assertEqual(self.client.get(reverse("room-detail", kwargs={"pk": mine.id})).json()["participant_count"], 2)
+
+    def test_room_participants_are_paginated_for_members_only(self):
+        room = self.create_room_with_participants(is_group=True, participants=[self.user2, self.user3])
+        url = reverse("room-participants", kwargs={"room_id": room.id})
+
+        first = self.client.get(url, {"page_size": 2}).json()
+        self.assertEqual([p["user"]["username"] for p in first["results"]], ["user1", "user2"])
+        second = self.client.get(first["next"]).json()
+        self.assertEqual([p["user"]["username"] for p in second["results"]], ["user3"])
+        self.assertIsNone(second["next"])
+
+        outsider = User.objects.create_user(username="outsider", password="pass123")
+        self.client.force_authenticate(user=outsider)
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_create_room_adds_members_in_bulk(self):
+        url = reverse("room-list-create")
+        data = {"is_group": True, "name": "team", "participant_ids": [self.user2.id, self.user3.id, self.user1.id]}
+        response = self.client.post(url, data, format="json")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        room = Room.objects.get(id=response.data["id"])
+        members = {self.user1.id, self.user2.id, self.user3.id}
+        self.assertEqual(set(room.participants.values_list("user_id", flat=True)), members)
+        self.assertEqual(
+            set(ConversationParticipant.objects.filter(conversation=room.conversation).values_list("user_id", flat=True)),
+            members,
+        )
+
+        data["participant_ids"] = [self.user2.id, 999999]
+        response = self.client.post(url, data, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("999999", str(response.data["participant_ids"]))
+
+    @override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+    def test_add_and_remove_room_members(self):
+        room = self.create_room_with_participants(is_group=True)
+        url = reverse("room-members", kwargs={"room_id": room.id})
+
+        response = self.client.post(url, {"user_ids": [self.user2.id, self.user3.id, self.user1.id]}, format="json")
+        self.assertEqual(response.data, {"added": [self.user2.id, self.user3.id]})
+        self.assertEqual(room.participants.count(), 3)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.delete(url, {"user_ids": [self.user2.id]}, format="json")
+        self.assertEqual(response.data, {"removed": [self.user2.id]})
+        self.assertFalse(ConversationParticipant.objects.filter(conversation=room.conversation, user=self.user2).exists())
+        self.assertFalse(is_room_member(room.id, self.user2.id))
+
+        self.client.force_authenticate(user=self.user2)
+        self.assertEqual(self.client.post(url, {"user_ids": [self.user2.id]}, format="json").status_code, 404)
+
+    @override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+    def test_only_the_creator_removes_other_members(self):
+        room = self.create_room_with_participants(is_group=True, participants=[self.user2, self.user3])
+        url = reverse("room-members", kwargs={"room_id": room.id})
+
+        self.client.force_authenticate(user=self.user2)
+        for user_ids in ([self.user3.id], [self.user1.id], [self.user2.id, self.user3.id]):
+            response = self.client.delete(url, {"user_ids": user_ids}, format="json")
+            self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(room.participants.count(), 3)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.delete(url, {"user_ids": [self.user2.id]}, format="json")
+        self.assertEqual(response.data, {"removed": [self.user2.id]})
+        self.assertFalse(ConversationParticipant.objects.filter(conversation=room.conversation, user=self.user2).exists())
+
+        self.client.force_authenticate(user=self.user1)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.delete(url, {"user_ids": [self.user3.id]}, format="json")
+        self.assertEqual(response.data, {"removed": [self.user3.id]})
+        self.assertFalse(is_room_member(room.id, self.user3.id))
+
+    @override_settings(ROOM_MEMBERSHIP_ASYNC_THRESHOLD=1, ROOM_MEMBERSHIP_BATCH_SIZE=1)
+    def test_large_membership_changes_run_in_a_task(self):
+        room = self.create_room_with_participants(is_group=True)
+        url = reverse("room-members", kwargs={"room_id": room.id})
+
+        def run_eagerly(args, task_id):
+            return change_room_membership.apply(args, task_id=task_id)
+
+        with mock.patch.object(change_room_membership, "apply_async", side_effect=run_eagerly):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(url, {"user_ids": [self.user2.id, self.user3.id]}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(room.participants.count(), 3)
+
+        progress = self.client.get(
+            reverse("room-membership-task", kwargs={"room_id": room.id, "task_id": response.data["task_id"]})
+        ).json()
+        self.assertEqual(progress["state"], "done")
+        self.assertEqual((progress["processed"], progress["total"], progress["changed"]), (2, 2, 2))
+
+    def test_fanout_loadtest_reports_latency_per_shard_count(self):
+        out = StringIO()
+        with override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS):
+            call_command("fanout_loadtest", sockets=50, messages=3, shards=[1, 4], stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual([run["shards"] for run in report], [1, 4])
+        self.assertTrue(all(run["latency"]["count"] == 3 for run in report))
+
+        self.client.force_authenticate(user=User.objects.create_superuser(username="root", password="pass123"))
+        stats = self.client.get(reverse("room-fanout-stats")).json()
+        self.assertEqual(stats["shards"], 1)
+
+    def test_outbound_queue_stats_are_admin_only(self):
+        url = reverse("outbound-queue-stats")
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_403_FORBIDDEN)
+        self.client.force_authenticate(user=User.objects.create_superuser(username="root", password="pass123"))
+        stats = self.client.get(url).json()
+        self.assertEqual(stats["sockets"], 0)
+        self.assertEqual(stats["deepest"], [])
+
+    @override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+    def test_direct_membership_changes_invalidate_cached_acl(self):
+        room = self.create_room_with_participants(is_group=True)
+        self.assertFalse(is_room_member(room.id, self.user3.id))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            participant = RoomParticipant.objects.create(room=room, user=self.user3)
+        self.assertTrue(is_room_member(room.id, self.user3.id))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            participant.delete()
+        self.assertFalse(is_room_member(room.id, self.user3.id))
+
+
+class ReplicaReadTests(TransactionTestCase):
+    databases = {"default", "replica"}
+
+    def test_membership_is_read_from_the_primary(self):
+        cache.clear()
+        user = User.objects.create_user(username="user1", password="pass123")
+        room = Room.objects.create(is_group=True, name="team")
+        RoomParticipant.objects.create(room=room, user=user)
+
+        token = replica_reads.set(True)
+        try:
+            with self.settings(DATABASE_REPLICAS=["replica"]):
+                with CaptureQueriesContext(connections["replica"]) as replica:
+                    self.assertTrue(is_room_member(room.id, user.pk))
+        finally:
+            replica_reads.reset(token)
+        self.assertEqual(replica.captured_queries, [])
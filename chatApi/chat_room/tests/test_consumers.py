@@ -0,0 +1,454 @@
+import asyncio
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TransactionTestCase, override_settings
+from rest_framework.test import APIClient
+
+from chat import encoding, fanout
+from chat_room.buffer import WriteBuffer, get_read_receipt_buffer
+from chat_room.membership import MEMBERSHIP_REVOKED_CLOSE_CODE, membership_changed
+from chat.models import ConversationParticipant, Message
+from chat_room.consumers import ChatConsumer
+from chat_room.models import Room, RoomParticipant
+from chat_room.outbound import SLOW_CONSUMER_CLOSE_CODE, queue_stats
+from chat_room.presence import connection_opened
+from chat_room.routing import websocket_urlpatterns
+
+User = get_user_model()
+
+IN_MEMORY_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, PRESENCE_OFFLINE_GRACE=0)
+class ChatConsumerTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user1 = User.objects.create_user(username="user1", password="pass123")
+        self.user2 = User.objects.create_user(username="user2", password="pass123")
+        self.room = Room.objects.create(name="general", is_group=True)
+        RoomParticipant.objects.create(room=self.room, user=self.user1)
+        RoomParticipant.objects.create(room=self.room, user=self.user2)
+
+    def communicator(self, user, room_id=None, query="", subprotocols=None):
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f"/ws/rooms/{room_id or self.room.id}/{query}", subprotocols=subprotocols
+        )
+        communicator.scope["user"] = user
+        return communicator
+
+    async def receive_chat(self, communicator):
+        while True:
+            event = await communicator.receive_json_from()
+            if event["type"] != "presence":
+                return event
+
+    async def test_messages_are_batched_and_broadcast(self):
+        alice = self.communicator(self.user1)
+        bob = self.communicator(self.user2)
+        self.assertTrue((await alice.connect())[0])
+        self.assertTrue((await bob.connect())[0])
+
+        for i in range(3):
+            await alice.send_json_to({"message": f"hello {i}"})
+        received = [await self.receive_chat(bob) for _ in range(3)]
+
+        self.assertEqual([e["message"] for e in received], ["hello 0", "hello 1", "hello 2"])
+        self.assertEqual(received[0]["sender"], "user1")
+        self.assertEqual(await sync_to_async(Message.objects.filter(conversation=self.room.conversation).count)(), 3)
+        bob_state = await sync_to_async(ConversationParticipant.objects.get)(
+            conversation=self.room.conversation, user=self.user2
+        )
+        self.assertEqual(bob_state.unread_count, 3)
+
+        await alice.disconnect()
+        await bob.disconnect()
+
+    @override_settings(ROOM_FANOUT_SHARDS=4)
+    async def test_room_fanout_is_sharded_and_coalesced(self):
+        fanout.latency.reset()
+        with mock.patch.object(fanout, "_room_fanout", fanout.RoomFanout(interval=0.2)):
+            alice = self.communicator(self.user1)
+            sockets = [self.communicator(self.user2) for _ in range(5)]
+            for communicator in [alice, *sockets]:
+                self.assertTrue((await communicator.connect())[0])
+
+            sub_groups = set(fanout.room_groups(self.room.id))
+            joined = {group for group in get_channel_layer().groups if group.startswith(f"chat_{self.room.id}.")}
+            self.assertEqual(len(sub_groups), 4)
+            self.assertTrue(joined and joined <= sub_groups)
+            self.assertNotIn(f"chat_{self.room.id}", get_channel_layer().groups)
+
+            for i in range(3):
+                await alice.send_json_to({"message": f"burst {i}"})
+            for bob in sockets:
+                frame = await self.receive_chat(bob)
+                self.assertEqual(frame["type"], "batch")
+                self.assertEqual([e["message"] for e in frame["events"]], ["burst 0", "burst 1", "burst 2"])
+
+        self.assertEqual(fanout.latency.snapshot(self.room.id)[self.room.id]["count"], 1)
+        for communicator in [alice, *sockets]:
+            await communicator.disconnect()
+
+    async def test_msgpack_frames_are_negotiated_per_socket(self):
+        alice = self.communicator(self.user1, subprotocols=["chat.msgpack"])
+        bob = self.communicator(self.user2)
+        self.assertEqual(await alice.connect(), (True, "chat.msgpack"))
+        self.assertEqual(await bob.connect(), (True, None))
+
+        await alice.send_to(bytes_data=encoding.CODECS["msgpack"].dumps({"message": "packed"}))
+        self.assertEqual((await self.receive_chat(bob))["message"], "packed")
+        while True:
+            frame = encoding.CODECS["msgpack"].loads(await alice.receive_from())
+            if frame["type"] != "presence":
+                break
+        self.assertEqual((frame["type"], frame["message"]), ("chat_message", "packed"))
+
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_room_messages_are_encoded_once_per_fanout(self):
+        alice = self.communicator(self.user1)
+        readers = [self.communicator(self.user2) for _ in range(3)]
+        readers.append(self.communicator(self.user2, subprotocols=["chat.msgpack"]))
+        for communicator in [alice, *readers]:
+            await communicator.connect()
+
+        with mock.patch.object(encoding, "encode", wraps=encoding.encode) as encode:
+            await alice.send_json_to({"message": "once"})
+            for reader in readers[:3]:
+                self.assertEqual((await self.receive_chat(reader))["message"], "once")
+            while True:
+                frame = encoding.CODECS["msgpack"].loads(await readers[3].receive_from())
+                if frame["type"] != "presence":
+                    break
+            self.assertEqual(frame["message"], "once")
+        message_encodes = [call for call in encode.call_args_list if call.args[0]["type"] == "chat_message"]
+        self.assertEqual(len(message_encodes), len(encoding.enabled_codecs()))
+
+        for communicator in [alice, *readers]:
+            await communicator.disconnect()
+
+    def stall_writes(self, user):
+        """Hold back every frame written to ``user``'s sockets until the returned event is set."""
+        gate = asyncio.Event()
+        write = ChatConsumer.write_encoded
+
+        async def stalled(consumer, payload):
+            if consumer.user.pk == user.pk:
+                await gate.wait()
+            await write(consumer, payload)
+
+        return gate, mock.patch.object(ChatConsumer, "write_encoded", stalled)
+
+    async def wait_for_messages(self, count):
+        while await sync_to_async(Message.objects.filter(conversation=self.room.conversation).count)() < count:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.1)
+
+    @override_settings(CHAT_OUTBOUND_HIGH_WATER=3)
+    async def test_slow_consumer_gets_one_resync_notice(self):
+        gate, stalled = self.stall_writes(self.user2)
+        with stalled:
+            alice = self.communicator(self.user1)
+            bob = self.communicator(self.user2)
+            await alice.connect()
+            await bob.connect()
+            for i in range(8):
+                await alice.send_json_to({"message": f"m{i}"})
+            await self.wait_for_messages(8)
+
+            stats = queue_stats()
+            slow = [socket for socket in stats["deepest"] if socket["user_id"] == self.user2.pk]
+            self.assertTrue(slow[0]["overflowing"])
+            self.assertEqual(stats["overflowing"], 1)
+
+            gate.set()
+            delivered = 0
+            while True:
+                frame = await self.receive_chat(bob)
+                if frame["type"] == "resync_required":
+                    break
+                delivered += 1
+            self.assertEqual(delivered + frame["missed"], 8)
+            self.assertEqual(frame["last_seq"], 8)
+            self.assertTrue(await bob.receive_nothing())
+
+            await alice.disconnect()
+            await bob.disconnect()
+
+    @override_settings(CHAT_OUTBOUND_HIGH_WATER=2, CHAT_OUTBOUND_OVERFLOW="close")
+    async def test_slow_consumer_can_be_disconnected(self):
+        gate, stalled = self.stall_writes(self.user2)
+        with stalled:
+            alice = self.communicator(self.user1)
+            bob = self.communicator(self.user2)
+            await alice.connect()
+            await bob.connect()
+            for i in range(4):
+                await alice.send_json_to({"message": f"m{i}"})
+
+            while True:
+                output = await bob.receive_output(timeout=2)
+                if output["type"] == "websocket.close":
+                    break
+            self.assertEqual(output["code"], SLOW_CONSUMER_CLOSE_CODE)
+            self.assertEqual((await self.receive_chat(alice))["message"], "m0")
+
+            await alice.disconnect()
+            await bob.wait()
+
+    def test_seqs_are_gap_free_per_conversation(self):
+        conversation = self.room.conversation
+        for i in range(3):
+            Message.objects.create(conversation=conversation, sender=self.user1, content=f"m{i}")
+        seqs = list(Message.objects.filter(conversation=conversation).order_by("pk").values_list("seq", flat=True))
+        self.assertEqual(seqs, [1, 2, 3])
+        conversation.refresh_from_db()
+        self.assertEqual(conversation.last_seq, 3)
+
+    async def test_reconnect_replays_missed_messages_once(self):
+        def post(count):
+            for i in range(count):
+                Message.objects.create(conversation=self.room.conversation, sender=self.user1, content=f"m{i}")
+
+        await sync_to_async(post)(4)
+        bob = self.communicator(self.user2, query="?since=1")
+        self.assertTrue((await bob.connect())[0])
+        replayed = [await self.receive_chat(bob) for _ in range(4)]
+        self.assertEqual([e["seq"] for e in replayed[:3]], [2, 3, 4])
+        self.assertEqual(replayed[3], {"type": "resync_complete", "last_seq": 4})
+
+        alice = self.communicator(self.user1)
+        await alice.connect()
+        await alice.send_json_to({"message": "live"})
+        live = await self.receive_chat(bob)
+        self.assertEqual(live["message"], "live")
+        self.assertTrue(await bob.receive_nothing())
+
+        await alice.disconnect()
+        await bob.disconnect()
+
+    @override_settings(CHAT_RESYNC_LIMIT=2)
+    async def test_reconnect_too_far_behind_requires_resync(self):
+        def post(count):
+            for i in range(count):
+                Message.objects.create(conversation=self.room.conversation, sender=self.user1, content=f"m{i}")
+
+        await sync_to_async(post)(3)
+        bob = self.communicator(self.user2, query="?since=0")
+        await bob.connect()
+        self.assertEqual(await self.receive_chat(bob), {"type": "resync_required", "last_seq": 3})
+        await bob.disconnect()
+
+    async def test_unknown_room_is_rejected(self):
+        communicator = self.communicator(self.user1, room_id=999999)
+        connected, code = await communicator.connect()
+        self.assertFalse(connected)
+        self.assertEqual(code, 4404)
+
+    @override_settings(CHAT_OPTIMISTIC_BROADCAST=True)
+    async def test_optimistic_broadcast_does_not_wait_for_insert(self):
+        alice = self.communicator(self.user1)
+        await alice.connect()
+        await alice.send_json_to({"message": "fast"})
+        event = await self.receive_chat(alice)
+        self.assertEqual(event["message"], "fast")
+        self.assertTrue(event["provisional"])
+        self.assertIsNone(event["id"])
+        self.assertIsNone(event["seq"])
+
+        confirmed = await self.receive_chat(alice)
+        stored = await sync_to_async(Message.objects.get)(content="fast")
+        self.assertEqual(confirmed["type"], "chat_message_confirmed")
+        self.assertEqual(confirmed["client_id"], event["client_id"])
+        self.assertEqual((confirmed["id"], confirmed["seq"]), (stored.pk, stored.seq))
+        self.assertEqual(confirmed["timestamp"], stored.created_at.isoformat())
+        await alice.disconnect()
+
+    async def test_failed_write_is_reported_to_the_sender(self):
+        def fail(messages):
+            raise RuntimeError("database is gone")
+
+        alice = self.communicator(self.user1)
+        await alice.connect()
+        with mock.patch("chat_room.buffer._message_buffer", WriteBuffer(fail)):
+            with self.assertLogs("chat_room.buffer", "ERROR"):
+                await alice.send_json_to({"message": "lost"})
+                frame = await self.receive_chat(alice)
+        self.assertEqual(frame, {"type": "error", "detail": "Message could not be saved."})
+        await alice.send_json_to({"message": "next"})
+        self.assertEqual((await self.receive_chat(alice))["message"], "next")
+        await alice.disconnect()
+
+    async def test_non_member_is_rejected(self):
+        outsider = await sync_to_async(User.objects.create_user)(username="outsider", password="pass123")
+        connected, code = await self.communicator(outsider).connect()
+        self.assertFalse(connected)
+        self.assertEqual(code, MEMBERSHIP_REVOKED_CLOSE_CODE)
+
+    async def test_receive_does_not_recheck_membership(self):
+        alice = self.communicator(self.user1)
+        await alice.connect()
+
+        # Membership is checked once at connect; later frames never look it up.
+        with mock.patch("chat_room.consumers.is_room_member") as is_room_member:
+            await alice.send_json_to({"message": "still here"})
+            self.assertEqual((await self.receive_chat(alice))["message"], "still here")
+        is_room_member.assert_not_called()
+        await alice.disconnect()
+
+    async def test_revoked_member_is_disconnected(self):
+        bob = self.communicator(self.user2)
+        await bob.connect()
+
+        def revoke():
+            RoomParticipant.objects.filter(room=self.room, user=self.user2).delete()
+            membership_changed(self.room.id, removed=[self.user2.pk])
+        await sync_to_async(revoke)()
+
+        output = await bob.receive_output()
+        self.assertEqual(output, {"type": "websocket.close", "code": MEMBERSHIP_REVOKED_CLOSE_CODE})
+        connected, code = await self.communicator(self.user2).connect()
+        self.assertFalse(connected)
+
+    async def test_presence_transitions_are_refcounted(self):
+        observer = self.communicator(self.user1)
+        await observer.connect()
+        await observer.receive_json_from()  # own online event
+
+        phone = self.communicator(self.user2)
+        laptop = self.communicator(self.user2)
+        await phone.connect()
+        await laptop.connect()
+        self.assertEqual(
+            await observer.receive_json_from(),
+            {"type": "presence", "user_id": self.user2.pk, "online": True},
+        )
+
+        await phone.disconnect()
+        self.assertTrue(await observer.receive_nothing(timeout=0.1))
+
+        await laptop.disconnect()
+        await asyncio.sleep(0.05)
+        self.assertEqual(
+            await observer.receive_json_from(),
+            {"type": "presence", "user_id": self.user2.pk, "online": False},
+        )
+        await observer.disconnect()
+
+    def test_presence_lookup_is_batched(self):
+        connection_opened(self.user2.pk)
+
+        client = APIClient()
+        client.force_authenticate(user=self.user1)
+        resp = client.get(f"/api/presence/?ids={self.user1.pk},{self.user2.pk}")
+        self.assertEqual(resp.status_code, 200)
+        online = {row["id"]: row["online"] for row in resp.data["results"]}
+        self.assertEqual(online, {self.user1.pk: False, self.user2.pk: True})
+
+        self.assertEqual(client.get("/api/presence/?ids=1,abc").status_code, 400)
+
+    async def test_typing_is_relayed_to_others_only(self):
+        alice = self.communicator(self.user1)
+        bob = self.communicator(self.user2)
+        await alice.connect()
+        await bob.connect()
+
+        await alice.send_json_to({"type": "typing", "is_typing": True})
+        event = await self.receive_chat(bob)
+        self.assertEqual(event, {"type": "typing", "user_id": self.user1.pk, "username": "user1", "is_typing": True})
+
+        await alice.send_json_to({"type": "message", "message": "done typing"})
+        self.assertEqual((await self.receive_chat(alice))["message"], "done typing")
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_read_receipts_are_coalesced(self):
+        alice = self.communicator(self.user1)
+        bob = self.communicator(self.user2)
+        await alice.connect()
+        await bob.connect()
+
+        for message_id in (1, 2, 3):
+            await alice.send_json_to({"type": "read", "message_id": message_id})
+        receipts = [await self.receive_chat(bob) for _ in range(3)]
+        self.assertEqual([r["message_id"] for r in receipts], [1, 2, 3])
+
+        def last_read():
+            return ConversationParticipant.objects.get(conversation=self.room.conversation, user=self.user1).last_read_at
+        self.assertIsNone(await sync_to_async(last_read)())
+
+        await get_read_receipt_buffer().flush()
+        self.assertEqual((await sync_to_async(last_read)()).isoformat(), receipts[-1]["read_at"])
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_unknown_frame_type_is_reported(self):
+        alice = self.communicator(self.user1)
+        await alice.connect()
+        await alice.send_json_to({"type": "dance"})
+        self.assertEqual((await self.receive_chat(alice))["type"], "error")
+        await alice.disconnect()
+
+    async def test_malformed_frames_are_reported(self):
+        alice = self.communicator(self.user1)
+        await alice.connect()
+        for text_data in ("[1, 2]", '"hi"', "{not json"):
+            await alice.send_to(text_data=text_data)
+            self.assertEqual((await self.receive_chat(alice))["type"], "error")
+        await alice.send_json_to({"message": "still open"})
+        self.assertEqual((await self.receive_chat(alice))["message"], "still open")
+        await alice.disconnect()
+
+    async def test_websocket_writes_publish_from_the_event_loop(self):
+        alice = self.communicator(self.user1)
+        await alice.connect()
+        with mock.patch("chat.services.publish_messages") as publish_messages:
+            await alice.send_json_to({"message": "buffered"})
+            self.assertEqual((await self.receive_chat(alice))["message"], "buffered")
+        publish_messages.assert_not_called()
+        await alice.disconnect()
+
+    async def test_rest_changes_are_pushed_to_room_and_direct_inboxes(self):
+        room_socket = self.communicator(self.user2)
+        inbox = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/inbox/")
+        inbox.scope["user"] = self.user2
+        await room_socket.connect()
+        self.assertTrue((await inbox.connect())[0])
+
+        client = APIClient()
+        client.force_authenticate(user=self.user1)
+        created = await sync_to_async(client.post)(
+            f"/api/rooms/{self.room.id}/messages/", {"content": "over http"}, format="json"
+        )
+        message_id = created.data["id"]
+
+        live = await self.receive_chat(room_socket)
+        self.assertEqual((live["type"], live["id"], live["message"]), ("chat_message", message_id, "over http"))
+
+        await sync_to_async(client.patch)(f"/api/messages/{message_id}/", {"content": "edited"}, format="json")
+        edited = await self.receive_chat(room_socket)
+        self.assertEqual((edited["type"], edited["message"]), ("chat_message_updated", "edited"))
+
+        await sync_to_async(client.delete)(f"/api/messages/{message_id}/")
+        deleted = await self.receive_chat(room_socket)
+        self.assertEqual((deleted["type"], deleted["id"]), ("chat_message_deleted", message_id))
+        # Room messages reach members through the room group only.
+        self.assertTrue(await inbox.receive_nothing())
+
+        direct = await sync_to_async(client.post)(
+            "/api/messages/", {"recipient_id": self.user2.id, "content": "just us"}, format="json"
+        )
+        pushed = await inbox.receive_json_from()
+        self.assertEqual((pushed["type"], pushed["id"]), ("message.created", direct.data["id"]))
+        await sync_to_async(client.delete)(f"/api/messages/{direct.data['id']}/")
+        self.assertEqual((await inbox.receive_json_from())["type"], "message.deleted")
+
+        await room_socket.disconnect()
+        await inbox.disconnect()
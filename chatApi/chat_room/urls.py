@@ -4,5 +4,16 @@ from . import views
 urlpatterns = [
     path("rooms/", views.RoomListCreateView.as_view(), name="room-list-create"),
     path("rooms/<int:pk>/", views.RoomDetailView.as_view(), name="room-detail"),
+    path("rooms/<int:room_id>/participants/", views.RoomParticipantListView.as_view(), name="room-participants"),
+    path("rooms/<int:room_id>/members/", views.RoomMembersView.as_view(), name="room-members"),
+    path(
+        "rooms/<int:room_id>/members/tasks/<str:task_id>/",
+        views.RoomMembershipTaskView.as_view(),
+        name="room-membership-task",
+    ),
     path("rooms/<int:room_id>/messages/", views.MessageListCreateView.as_view(), name="message-list-create"),
+    path("rooms/recent-cache/stats/", views.RecentMessagesCacheStatsView.as_view(), name="recent-cache-stats"),
+    path("rooms/fanout/stats/", views.RoomFanoutStatsView.as_view(), name="room-fanout-stats"),
+    path("rooms/outbound-queues/stats/", views.OutboundQueueStatsView.as_view(), name="outbound-queue-stats"),
+    path("presence/", views.PresenceView.as_view(), name="presence"),
 ]
@@ -1,25 +1,121 @@
+from types import SimpleNamespace
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.http import HttpResponse
 from rest_framework import generics, permissions, status
+from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.exceptions import NotFound
-from .models import Room, Message
-from .serializers import RoomSerializer, MessageSerializer
+from rest_framework.exceptions import NotFound, PermissionDenied, ValidationError
+from accounts.last_seen import get_last_seen_many
+from chatApi.routers import ReplicaReadsMixin
+from chat import fanout
+from chat.models import ArchivedMessage, Conversation, Message
+from chat.pagination import MessageCursorPagination
+from . import recent
+from .membership import add_members, change_membership, get_membership_progress, is_room_member
+from .models import Room, RoomParticipant
+from .outbound import queue_stats
+from .presence import get_online
+from .pagination import RoomParticipantCursorPagination
+from .serializers import MembershipChangeSerializer, MessageSerializer, RoomMemberSerializer, RoomSerializer
 
 
-class RoomListCreateView(generics.ListCreateAPIView):
-    queryset = Room.objects.all()
+class RoomListCreateView(ReplicaReadsMixin, generics.ListCreateAPIView):
     serializer_class = RoomSerializer
     permission_classes = [permissions.IsAuthenticated]
 
+    def get_queryset(self):
+        if getattr(self, "swagger_fake_view", False):
+            return Room.objects.none()
+        return Room.objects.listing_for(self.request.user)
 
-class RoomDetailView(generics.RetrieveAPIView):
-    queryset = Room.objects.all()
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        with transaction.atomic():
+            room = serializer.save(created_by=request.user)
+            add_members(room, [request.user.pk])
+            others = set(serializer.validated_data.get("participant_ids", [])) - {request.user.pk}
+            change = change_membership(room, others, "add") if others else {}
+        data = dict(serializer.data)
+        if "task_id" in change:
+            data["membership_task"] = change["task_id"]
+        headers = self.get_success_headers(data)
+        return Response(data, status=status.HTTP_201_CREATED, headers=headers)
+
+
+class RoomDetailView(ReplicaReadsMixin, generics.RetrieveAPIView):
     serializer_class = RoomSerializer
     permission_classes = [permissions.IsAuthenticated]
 
+    def get_queryset(self):
+        if getattr(self, "swagger_fake_view", False):
+            return Room.objects.none()
+        return Room.objects.listing_for(self.request.user)
+
+
+class RoomParticipantListView(ReplicaReadsMixin, generics.ListAPIView):
+    serializer_class = RoomMemberSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    pagination_class = RoomParticipantCursorPagination
+
+    def get_queryset(self):
+        room_id = self.kwargs.get("room_id")
+        if not is_room_member(room_id, self.request.user.pk):
+            raise NotFound(detail="Room not found.")
+        return RoomParticipant.objects.filter(room_id=room_id).select_related("user")
+
+
+class RoomMembersView(ReplicaReadsMixin, APIView):
+    """
+    POST adds ``user_ids`` to the room, DELETE removes them. Any member may
+    add people or leave; only the room's creator may remove someone else.
+    Changes larger than ROOM_MEMBERSHIP_ASYNC_THRESHOLD run in a Celery task
+    and answer 202 with a task id to poll at RoomMembershipTaskView.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_room(self):
+        room = Room.objects.filter(id=self.kwargs.get("room_id")).first()
+        if room is None or not is_room_member(room.id, self.request.user.pk):
+            raise NotFound(detail="Room not found.")
+        return room
+
+    def change(self, request, action):
+        room = self.get_room()
+        serializer = MembershipChangeSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        user_ids = serializer.validated_data["user_ids"]
+        others = set(user_ids) - {request.user.pk}
+        if action == "remove" and others and room.created_by_id != request.user.pk:
+            raise PermissionDenied("Only the room's creator can remove other members.")
+        result = change_membership(room, user_ids, action)
+        if "task_id" in result:
+            return Response(result, status=status.HTTP_202_ACCEPTED)
+        return Response(result)
+
+    def post(self, request, room_id):
+        return self.change(request, "add")
+
+    def delete(self, request, room_id):
+        return self.change(request, "remove")
+
+
+class RoomMembershipTaskView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, room_id, task_id):
+        progress = get_membership_progress(task_id)
+        if progress is None or progress["room_id"] != room_id or not is_room_member(room_id, request.user.pk):
+            raise NotFound(detail="Task not found.")
+        return Response(progress)
 
-class MessageListCreateView(generics.ListCreateAPIView):
+
+class MessageListCreateView(ReplicaReadsMixin, generics.ListCreateAPIView):
     serializer_class = MessageSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = MessageCursorPagination
 
     def get_queryset(self):
         room_id = self.kwargs.get("room_id")
@@ -28,13 +124,60 @@ class MessageListCreateView(generics.ListCreateAPIView):
         except Room.DoesNotExist:
             raise NotFound(detail="Room not found.")
 
-        return Message.objects.filter(room=room, room__participants__user=self.request.user)
+        self.room = room
+        if not is_room_member(room.id, self.request.user.pk):
+            return Message.objects.none()
+        return Message.objects.filter(conversation_id=room.conversation_id)
 
-    def create(self, request, *args, **kwargs):
+    def get_archive_queryset(self):
+        return ArchivedMessage.objects.filter(conversation_id=self.room.conversation_id)
+
+    def get_archive_horizon(self):
+        if not is_room_member(self.room.id, self.request.user.pk):
+            return None
+        return Conversation.objects.filter(pk=self.room.conversation_id).values_list("archived_until", flat=True).first()
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context["room"] = getattr(self, "room", None)
+        return context
+
+    def list(self, request, *args, **kwargs):
+        response = self.list_from_recent_cache(request)
+        if response is not None:
+            return response
+        return super().list(request, *args, **kwargs)
+
+    def list_from_recent_cache(self, request):
+        """
+        Serve the newest page of a room as pre-rendered JSON from the recent
+        messages cache. Returns None when the request has to go to the database.
+        """
+        paginator = self.paginator
         room_id = self.kwargs.get("room_id")
-        try:
-            room = Room.objects.get(id=room_id)
-        except Room.DoesNotExist:
+        page_size = paginator.get_page_size(request)
+        if (
+            request.query_params.get(paginator.cursor_query_param)
+            or request.accepted_renderer.format != "json"
+            or page_size > recent.get_limit()
+            or not is_room_member(room_id, request.user.pk)
+        ):
+            return None
+        entry = recent.get_entry(room_id)
+        if entry is None or not recent.covers_page(entry, page_size):
+            return None
+
+        items = entry["items"]
+        next_link = None
+        if items and (len(items) > page_size or not entry["complete"]):
+            created_at, pk, _ = items[min(page_size, len(items)) - 1]
+            paginator.base_url = request.build_absolute_uri()
+            next_link = paginator.encode_cursor(SimpleNamespace(created_at=created_at, pk=pk), reverse=False)
+        return HttpResponse(recent.render_page(entry, page_size, next_link), content_type="application/json")
+
+    def create(self, request, *args, **kwargs):
+        room = Room.objects.filter(id=self.kwargs.get("room_id")).first()
+        if room is None or not is_room_member(room.id, request.user.pk):
             raise NotFound(detail="Room not found.")
 
         serializer = self.get_serializer(
@@ -44,3 +187,54 @@ class MessageListCreateView(generics.ListCreateAPIView):
         self.perform_create(serializer)
         headers = self.get_success_headers(serializer.data)
         return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
+
+
+class RecentMessagesCacheStatsView(APIView):
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        return Response(recent.get_stats())
+
+
+class RoomFanoutStatsView(APIView):
+    """Per-room fan-out latency histograms of the process serving the request."""
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        return Response({
+            "shards": fanout.get_shard_count(),
+            "tick": fanout.get_room_fanout().interval,
+            "rooms": fanout.latency.snapshot(),
+        })
+
+
+class OutboundQueueStatsView(APIView):
+    """Websocket outbound queue depths of the process serving the request."""
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        return Response(queue_stats())
+
+
+class PresenceView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+    max_ids = 200
+
+    def get(self, request):
+        raw_ids = [part for part in request.query_params.get("ids", "").split(",") if part]
+        if not all(part.isdigit() for part in raw_ids):
+            raise ValidationError({"ids": "Expected a comma-separated list of user ids."})
+        if len(raw_ids) > self.max_ids:
+            raise ValidationError({"ids": f"At most {self.max_ids} ids per request."})
+
+        users = list(
+            get_user_model().objects.filter(pk__in={int(part) for part in raw_ids}).only("id", "last_seen")
+        )
+        online = get_online([user.pk for user in users])
+        last_seen = get_last_seen_many(users)
+        return Response({
+            "results": [
+                {"id": user.pk, "online": online[user.pk], "last_seen": last_seen[user.pk]}
+                for user in users
+            ]
+        })